@@ -27,14 +27,90 @@ bool pumpReverse[6][3] = {
 
 
 
+// Pumps run without blocking the serial loop so that valves (and other pumps) can be switched while a pump is
+// running. Each running pump occupies one slot; a pump cycle has six phases.
+const int maxPumps = 4;
+
+struct Pump {
+  bool active;
+  bool reverse;
+  int valves[3];
+  unsigned long phasePeriod; // microseconds per phase
+  unsigned long nextPhase;   // micros() time at which to advance to the next phase
+  long cyclesLeft;           // -1 pumps until interrupted
+  int phase;
+};
+
+Pump pumps[maxPumps];
+
+// A repeat program runs the body of a protocol loop on the board, so that the loop costs one command instead of one
+// per step and iteration. The body is a sequence of items:
+//   SnnPPSPPS...         - set nn pins, each a two digit pin number followed by a one digit state
+//   WMMMMMMMM            - wait MMMMMMMM milliseconds
+//   PdVVVVVVVVVRRRCCCCCC - start a pump, as in the pump command
+// Items run without blocking the serial loop; each wait is scheduled from the end of the previous one so that the
+// timing does not drift over many repeats.
+String program = "";           // body of the running program
+unsigned int programPos = 0;   // position of the next item in the body
+long repeatsLeft = 0;          // passes through the body left to run, 0 if no program is running
+unsigned long programNext = 0; // millis() time at which to run the next item
+
 //typedef void (*pumpCommand) (int * a);
 
+// A set pins command for more pins than fit in a frame (the input string reserves 200 characters) is sent in chunks:
+// every chunk but the last is an 8 command, 8PPSPPS..., which stages its pins and replies "Staged" and the number of
+// pins staged so far, and the last is the usual 2 command, which sets the staged pins and its own together, without
+// the stream interrupt running in between. An 8 command with no pins, or an identify command, drops staged pins.
+const int maxStaged = 68;
+byte stagedPins[maxStaged];
+byte stagedStates[maxStaged];
+int nStaged = 0;
+
+// Streaming mode plays a waveform sent by the host: frames of channel states, each stamped with the tick at which it
+// should be applied, are queued in a ring buffer and applied by the Timer1 compare interrupt, one per tick at most,
+// independently of the serial loop. The host may only send as many frames as it has credits; it starts with
+// streamCapacity credits and the board returns them as frames are played ("7C" messages), so the buffer never
+// overflows. A frame applied after its tick (the host did not send it in time) is counted as late, and the count is
+// reported in every "7C" message and when the stream finishes.
+//   7STTTTTTNNPPPP...  - set up a stream: tick in microseconds, number of channels and their two digit pins; replies
+//                        "Stream" and the capacity of the buffer
+//   7DSSSSMMMM...      - queue frames: a four hex digit tick stamp (modulo 65536) and one hex digit per four channels,
+//                        the first channel in the lowest bit of the last digit
+//   7R                 - start playing at tick 0; 7E - finish once the buffer is empty; 7X - stop now
+// The board sends "7Ccredits late" as frames are played and "7Fplayed late overflows" when the stream ends.
+const int streamCapacity = 64; // frames; a power of two so that the free running indices wrap with the buffer
+const int maxChannels = 32;
+
+struct StreamFrame {
+  unsigned int stamp;
+  unsigned long mask;
+};
+
+volatile StreamFrame streamBuffer[streamCapacity];
+volatile byte streamHead = 0;             // index of the next frame to queue, written by the serial loop
+volatile byte streamTail = 0;             // index of the next frame to play, written by the interrupt
+volatile unsigned int streamTick = 0;     // tick the interrupt handles next
+volatile unsigned int streamFreed = 0;    // frames played since the serial loop last returned credits
+volatile unsigned int streamLate = 0;     // frames played after their tick
+volatile unsigned long streamPlayed = 0;  // frames played
+int channelPins[maxChannels];
+int nChannels = 0;
+unsigned long channelStates = 0;
+unsigned long tickMicros = 1000;
+bool streamRunning = false;
+bool streamEnding = false;
+unsigned int streamOverflows = 0;         // frames dropped because the buffer was full
+unsigned int creditsOwed = 0;             // credits to return to the host
+unsigned int lateReported = 0;
+
+
 
 void setup() {
   // initialize serial:
   Serial.begin(9600);
   // reserve 200 bytes for the inputString:
   inputString.reserve(200);
+  program.reserve(250);
 //  for(int apin = 0; apin < 16, apin++){
      
 //  }
@@ -42,42 +118,339 @@ void setup() {
     pinMode(pin,OUTPUT);
   }
 }
-void pumpCycle(int rate, bool pumpStates[6][3], int valves[3]){
-    for(int s = 0; s < 6; s++){
+// writePumpPhase: sets the three valves of a pump to the states of its current phase.
+void writePumpPhase(Pump &p){
+  for(int v = 0; v < 3; v++){
+    if(p.reverse){
+      digitalWrite(p.valves[v], pumpReverse[p.phase][v]);
+    } else{
+      digitalWrite(p.valves[v], pumpForward[p.phase][v]);
+    }
+  }
+}
+
+// endPump: returns the solenoid valves of a pump to their normally open state and frees its slot.
+void endPump(Pump &p){
+  for(int v = 0; v < 3; v++){
+    digitalWrite(p.valves[v], 0);
+  }
+  p.active = false;
+}
+
+// stopPumps: interrupts every running pump.
+void stopPumps(){
+  for(int s = 0; s < maxPumps; s++){
+    if(pumps[s].active){
+      endPump(pumps[s]);
+    }
+  }
+}
+
+// stopPumpsUsing: interrupts the pumps that use any of the given valves, leaving other pumps running.
+void stopPumpsUsing(int valves[3]){
+  for(int s = 0; s < maxPumps; s++){
+    if(!pumps[s].active){
+      continue;
+    }
+    for(int v = 0; v < 3; v++){
+      for(int w = 0; w < 3; w++){
+        if(pumps[s].active && pumps[s].valves[v] == valves[w]){
+          endPump(pumps[s]);
+        }
+      }
+    }
+  }
+}
+
+// startPump: claims a slot for a new pump. A pump that shares a valve with the new one is replaced; otherwise the
+// first free slot is used, or the first slot if all are busy.
+void startPump(bool reverse, int valves[3], int rate, long nCycles){
+  int slot = -1;
+  for(int s = 0; s < maxPumps && slot < 0; s++){
+    if(!pumps[s].active){
+      continue;
+    }
+    for(int v = 0; v < 3; v++){
+      for(int w = 0; w < 3; w++){
+        if(pumps[s].valves[v] == valves[w]){
+          slot = s;
+        }
+      }
+    }
+  }
+  if(slot >= 0){
+    endPump(pumps[slot]);
+  }
+  for(int s = 0; s < maxPumps && slot < 0; s++){
+    if(!pumps[s].active){
+      slot = s;
+    }
+  }
+  if(slot < 0){
+    slot = 0;
+    endPump(pumps[slot]);
+  }
+  Pump &p = pumps[slot];
+  p.reverse = reverse;
+  for(int v = 0; v < 3; v++){
+    p.valves[v] = valves[v];
+  }
+  p.phasePeriod = 1000000UL/((unsigned long)rate*6);
+  p.cyclesLeft = nCycles;
+  p.phase = 0;
+  p.active = true;
+  writePumpPhase(p);
+  p.nextPhase = micros() + p.phasePeriod;
+}
+
+// runPumps: advances every running pump whose phase has elapsed. Called once per pass through loop().
+void runPumps(){
+  unsigned long now = micros();
+  for(int s = 0; s < maxPumps; s++){
+    Pump &p = pumps[s];
+    if(!p.active || (long)(now - p.nextPhase) < 0){
+      continue;
+    }
+    p.phase++;
+    if(p.phase == 6){
+      p.phase = 0;
+      if(p.cyclesLeft > 0){
+        p.cyclesLeft--;
+      }
+      if(p.cyclesLeft == 0){
+        endPump(p);
+        continue;
+      }
+    }
+    writePumpPhase(p);
+    p.nextPhase += p.phasePeriod;
+  }
+}
+
+// runProgram: runs the items of the repeat program that are due. Called once per pass through loop().
+void runProgram(){
+  while(repeatsLeft > 0 && (long)(millis() - programNext) >= 0){
+    if(programPos >= program.length()){ // end of a pass through the body
+      programPos = 0;
+      repeatsLeft--;
+      return; // let loop() handle serial input between passes, e.g. a command stopping the program
+    }
+    char item = program[programPos];
+    if(item == 'S'){
+      int nPins = program.substring(programPos + 1, programPos + 3).toInt();
+      for(int k = 0; k < nPins; k++){
+        int at = programPos + 3 + 3*k;
+        digitalWrite(program.substring(at, at + 2).toInt(), program.substring(at + 2, at + 3).toInt());
+      }
+      programPos += 3 + 3*nPins;
+    } else if(item == 'W'){
+      programNext += program.substring(programPos + 1, programPos + 9).toInt();
+      programPos += 9;
+    } else if(item == 'P'){
+      int valves [3];
       for(int v = 0; v < 3; v++){
-        digitalWrite(valves[v], pumpStates[s][v]);
+        valves[v] = program.substring(programPos + 2 + 3*v, programPos + 5 + 3*v).toInt();
       }
-      delay(1000.0/(rate *6));
-      if(Serial.available()){
-        //reset valves
-        for(int v = 0; v++; v < 3){
-          digitalWrite(valves[v],0);
+      startPump(program[programPos + 1] == 'r', valves, program.substring(programPos + 11, programPos + 14).toInt(),
+                program.substring(programPos + 14, programPos + 20).toInt());
+      programPos += 20;
+    } else{ // not a valid item: stop the program
+      repeatsLeft = 0;
+    }
+  }
+}
+
+// stagePins: stages the PPS pin and state triples of the input string, starting at a position.
+void stagePins(int from){
+  for(int at = from; at + 3 <= (int)inputString.length() && nStaged < maxStaged; at += 3){
+    stagedPins[nStaged] = 10*(inputString[at] - '0') + inputString[at + 1] - '0';
+    stagedStates[nStaged] = inputString[at + 2] - '0';
+    nStaged++;
+  }
+}
+
+// applyStaged: sets the staged pins, keeping the stream interrupt from applying a frame part way through.
+void applyStaged(){
+  byte timerMask = TIMSK1;
+  TIMSK1 &= ~(1 << OCIE1A);
+  for(int k = 0; k < nStaged; k++){
+    digitalWrite(stagedPins[k], stagedStates[k]);
+  }
+  TIMSK1 = timerMask;
+  nStaged = 0;
+}
+
+// playTick: applies the next frame if it is due, and moves on to the next tick. Called by the Timer1 interrupt.
+void playTick(){
+  if(streamHead != streamTail){
+    volatile StreamFrame &f = streamBuffer[streamTail % streamCapacity];
+    int wait = (int)(f.stamp - streamTick);
+    if(wait <= 0){
+      if(wait < 0){
+        streamLate++;
+      }
+      unsigned long changed = f.mask ^ channelStates;
+      for(int k = 0; k < nChannels; k++){
+        if(changed & (1UL << k)){
+          digitalWrite(channelPins[k], (f.mask >> k) & 1);
         }
-        break;
       }
+      channelStates = f.mask;
+      streamTail++;
+      streamFreed++;
+      streamPlayed++;
     }
+  }
+  streamTick++;
+}
+
+ISR(TIMER1_COMPA_vect){
+  playTick();
+}
+
+// startTimer: interrupts every tickMicros microseconds, using Timer1 in CTC mode.
+void startTimer(){
+  noInterrupts();
+  TCCR1A = 0;
+  TCCR1B = 0;
+  TCNT1 = 0;
+  if(tickMicros <= 32767){
+    OCR1A = tickMicros*2 - 1;                         // prescaler 8: 0.5 microsecond counts
+    TCCR1B = (1 << WGM12) | (1 << CS11);
+  } else{
+    OCR1A = tickMicros/4 - 1;                         // prescaler 64: 4 microsecond counts
+    TCCR1B = (1 << WGM12) | (1 << CS11) | (1 << CS10);
+  }
+  TIMSK1 |= (1 << OCIE1A);
+  interrupts();
+}
+
+void stopTimer(){
+  TIMSK1 &= ~(1 << OCIE1A);
+  TCCR1B = 0;
+}
+
+// hexValue: converts hex digits of a string to a number.
+unsigned long hexValue(String &s, int from, int to){
+  unsigned long value = 0;
+  for(int k = from; k < to; k++){
+    char d = s[k];
+    value = (value << 4) | (d <= '9' ? d - '0' : d - 'A' + 10);
+  }
+  return value;
+}
+
+// finishStream: stops playing and reports the frames played, late and dropped.
+void finishStream(){
+  stopTimer();
+  streamRunning = false;
+  streamEnding = false;
+  Serial.print("7F");
+  Serial.print(streamPlayed);
+  Serial.print(" ");
+  Serial.print(streamLate);
+  Serial.print(" ");
+  Serial.println(streamOverflows);
+}
+
+// reportStream: returns credits to the host once a quarter of the buffer has been played, when the buffer runs
+// empty or when a frame was late, and finishes the stream once it has been played out. Called once per pass through
+// loop().
+void reportStream(){
+  if(!streamRunning){
+    return;
+  }
+  noInterrupts();
+  unsigned int freed = streamFreed;
+  streamFreed = 0;
+  unsigned int late = streamLate;
+  bool empty = streamHead == streamTail;
+  interrupts();
+  creditsOwed += freed;
+  if(creditsOwed >= streamCapacity/4 || (creditsOwed > 0 && empty) || late != lateReported){
+    Serial.print("7C");
+    Serial.print(creditsOwed);
+    Serial.print(" ");
+    Serial.println(late);
+    creditsOwed = 0;
+    lateReported = late;
+  }
+  if(streamEnding && empty){
+    finishStream();
+  }
+}
+
+// streamCommand: handles the 7 commands (see above).
+void streamCommand(){
+  char sub = inputString[1];
+  if(sub == 'S'){
+    stopTimer();
+    streamRunning = false;
+    streamEnding = false;
+    tickMicros = inputString.substring(2, 8).toInt();
+    nChannels = min((int)inputString.substring(8, 10).toInt(), maxChannels);
+    for(int k = 0; k < nChannels; k++){
+      channelPins[k] = inputString.substring(10 + 2*k, 12 + 2*k).toInt();
+      channelStates &= ~(1UL << k);
+      channelStates |= (unsigned long)digitalRead(channelPins[k]) << k;
+    }
+    streamHead = streamTail = 0;
+    streamTick = 0;
+    streamFreed = streamLate = 0;
+    streamPlayed = 0;
+    streamOverflows = creditsOwed = lateReported = 0;
+    Serial.print("Stream");
+    Serial.println(streamCapacity);
+  } else if(sub == 'D'){
+    int width = 4 + (nChannels + 3)/4;
+    for(int at = 2; at + width <= (int)inputString.length(); at += width){
+      if((byte)(streamHead - streamTail) >= streamCapacity){
+        streamOverflows++;
+        continue;
+      }
+      volatile StreamFrame &f = streamBuffer[streamHead % streamCapacity];
+      f.stamp = hexValue(inputString, at, at + 4);
+      f.mask = hexValue(inputString, at + 4, at + width);
+      streamHead++;
+    }
+  } else if(sub == 'R'){
+    streamTick = 0;
+    streamRunning = true;
+    noInterrupts();
+    playTick();
+    interrupts();
+    startTimer();
+  } else if(sub == 'E'){
+    streamEnding = true;
+    if(!streamRunning){
+      finishStream();
+    }
+  } else if(sub == 'X'){
+    streamHead = streamTail;
+    finishStream();
+  }
 }
 
 void loop() {
   // print the string when a newline arrives:
+  if (stringComplete && inputString.length() == 0) {
+    // a lone 'c' interrupts all running pumps
+    stopPumps();
+    stringComplete = false;
+  }
   if (stringComplete) {
     int action = inputString[0] - '0';
-    Serial.print(inputString);
+    if(action != 7 && action != 8){ // stream frames and chunks are not echoed, so that the replies keep up with them
+      Serial.print(inputString);
+    }
     //int action = saction.toInt();
       switch (action){
         case 2: {//write pins
 
-          // First, find number of pins. The message will have a to character integer pin number
-          // followed by a one character boolian state. So nPins = (Length of message)/3.
-          String message = inputString.substring(1);
-          int nPins = message.length();
-          nPins = nPins/3;
-          for(int pin = 0; pin < nPins; pin++){
-            String pinNum =  message.substring(3*pin, 3*pin+2);            
-            String pinState = message.substring(3*pin+2, 3*pin+3);
-            digitalWrite(pinNum.toInt(), pinState.toInt());
-          }
-          
+          // The message has a two character integer pin number followed by a one character boolian state per pin.
+          // They are set together with any pins staged by 8 commands.
+          stagePins(1);
+          applyStaged();
           Serial.println("Set Pins");
           break;
         }
@@ -87,76 +460,80 @@ void loop() {
           inputString.remove(0,2);
           // get valves
           int valves [3];
-          //Serial.print("__Valves:");
           for(int v = 0; v < 3; v++){
             valves[v] = inputString.substring(0,3).toInt();
             inputString.remove(0,3);
           }
-          
+
           //get rate
           int rate = inputString.substring(0,3).toInt();
           inputString.remove(0,3);
-          //get time
-          int nCycles = inputString.substring(0,6).toInt();
-          if(polarity = 'r'){
-            if(nCycles == 0){ // if python sent -1, toInt() would return 0
-              while(1){
-                pumpCycle(rate, pumpReverse, valves);
-                if(Serial.available()){
-                  break;
-                }
-              }
-              //break;
-            } else{ 
-            for(int c = 0; c < nCycles; c++){
-              pumpCycle(rate, pumpReverse, valves);
-              if(Serial.available()){
-                //reset valves
-                for(int v = 0; v++; v < 3){
-                  digitalWrite(valves[v],0);
-                }
-                break;
-              }
-            }
-           }
-          } else{
-            if (nCycles == 0){ // if python sent -1, toInt() would return 0
-              while(1){  
-                pumpCycle(rate, pumpForward, valves);
-                if(Serial.available()){
-                  break;
-                }
-              }
-              //break;
-          } else{
-             for(int c = 0; c < nCycles; c++){
-                pumpCycle(rate, pumpForward, valves);
-                if(Serial.available()){
-                  //reset valves
-                  for(int v = 0; v++; v < 3){
-                    digitalWrite(valves[v],0);
-                  }
-                  break;
-                }
-             }
-            }
-           }
-          // Return solenoid valves to normally open state.
-           for(int v = 0; v < 3; v++){
-             digitalWrite(valves[v], 0);
-           }
-           break;
+          //get number of cycles
+          long nCycles = inputString.substring(0,6).toInt();
+          if(nCycles <= 0){ // if python sent -1, toInt() would return 0: pump until interrupted
+            nCycles = -1;
+          }
+          startPump(polarity == 'r', valves, rate, nCycles);
+          Serial.println("Pump");
+          break;
           }
           case 1: { //name
+            nStaged = 0;
             Serial.print("KATARA Arduino Firmware");
           }
           break;
+        case 4: { // read back the output states of pins 2-69 as 17 hex digits, most significant first: the first digit
+                  // holds pins 69-66 and the last pins 5-2.
+          for(int nibble = 16; nibble >= 0; nibble--){
+            int value = 0;
+            for(int b = 3; b >= 0; b--){
+              value = (value << 1) | digitalRead(2 + 4*nibble + b);
+            }
+            Serial.print(value, HEX);
+          }
+          Serial.println();
+          break;
+        }
+        case 5: { // stop the pumps using any of three valves, given as in the pump command
+          int valves [3];
+          for(int v = 0; v < 3; v++){
+            valves[v] = inputString.substring(1 + 3*v, 4 + 3*v).toInt();
+          }
+          stopPumpsUsing(valves);
+          Serial.println("Stop");
+          break;
+        }
+        case 6: { // run a repeat program: six digit number of repeats followed by the body. 0 repeats stops the
+                  // running program without touching the valves.
+          repeatsLeft = inputString.substring(1, 7).toInt();
+          program = inputString.substring(7);
+          programPos = 0;
+          programNext = millis();
+          Serial.println("Repeat");
+          break;
+        }
+        case 7: { // streaming mode, see streamCommand
+          streamCommand();
+          break;
+        }
+        case 8: { // stage a chunk of a set pins command, see stagePins
+          if(inputString.length() == 1){
+            nStaged = 0;
+          }
+          stagePins(1);
+          Serial.print("Staged");
+          Serial.println(nStaged);
+          break;
+        }
         //}
       }
     // clear the string:
     inputString = "";
     stringComplete = false;
   }
+  runProgram();
+  runPumps();
+  reportStream();
 }
 
 /*
@@ -166,7 +543,9 @@ void loop() {
  response.  Multiple bytes of data may be available.
  */
 void serialEvent() {
-  while (Serial.available()) {
+  // stop at the end of a frame: what follows it stays in the serial buffer until loop() has handled this one, so that
+  // frames sent back to back (stream data followed by 7E, for example) are not run together
+  while (Serial.available() && !stringComplete) {
     // get the new byte:
     char inChar = (char)Serial.read();
     if (inChar == 'c') {
@@ -175,9 +554,6 @@ void serialEvent() {
       // add it to the inputString:
       inputString += inChar;
     }
-      // if the incoming character is a newline, set a flag
-    // so the main loop can do something about it:
-    
   }
 }
 
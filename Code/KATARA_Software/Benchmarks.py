@@ -0,0 +1,456 @@
+#MIT License
+#
+#Copyright (c) 2017 Jonathan A. White
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+
+import sys
+import os
+import json
+import time
+import platform
+import threading
+import subprocess
+import tempfile
+from collections import OrderedDict
+try:
+    from Tkinter import * #python 2.7
+except:
+    from tkinter import * #python 3
+import config
+from SerialMetrics import clock
+from SimulatedDevice import SimulatedValveController
+from Protocol_Tools import Protocol, Routine, RoutineThread, Loop # before Step, which imports it back
+from Step import Step
+from StepDerivatives import PauseStep
+
+# Benchmarks times the hot paths of the software so that changes can be compared across commits. Everything runs
+# against a simulated device (see SimulatedDevice), so no Arduino is needed. Benchmarks that build protocols or GUI
+# widgets need Tk, and so a display; on a headless machine run them under a virtual display such as xvfb-run. Without
+# one they are reported as skipped.
+#
+# Usage: python Benchmarks.py [--out results.json] [--compare old.json] [--repeat n] [names...]
+# Results are written as JSON: the machine, the git commit, and for each benchmark the seconds per operation over the
+# repeats (min, median, mean, max).
+
+benchmarks = OrderedDict() # name: (function, needs Tk)
+
+
+# benchmark: decorator that registers a benchmark. The decorated function takes a context dictionary (holding 'root',
+#   the Tk root, when Tk is available) and returns (operation, number of operations per repeat, setup or None).
+def benchmark(name, needsTk = False):
+    def register(function):
+        benchmarks[name] = (function, needsTk)
+        return function
+    return register
+
+
+# measure: times an operation.
+#   Inputs:
+#       operation - function to time
+#       number - times to call it per repeat
+#       repeat - number of repeats
+#       setup - function called before each repeat, not timed
+#   Output: dictionary of seconds per operation statistics
+def measure(operation, number, repeat, setup = None):
+    times = []
+    for r in range(repeat):
+        if setup:
+            setup()
+        start = clock()
+        for n in range(number):
+            operation()
+        times.append((clock() - start)/number)
+    times.sort()
+    return OrderedDict([("number", number), ("repeat", repeat), ("min", times[0]),
+                        ("median", times[len(times)//2]), ("mean", sum(times)/len(times)), ("max", times[-1])])
+
+
+# savedProtocol: builds a saved protocol (the list stored by Protocol.save, without its header) of valve and pause
+#   steps nested in loops.
+#   Inputs:
+#       nSteps - number of steps in the innermost loop
+#       depth - number of nested loops
+#       iterations - iterations of each loop
+#   Output: the saved protocol list
+def savedProtocol(nSteps, depth = 0, iterations = 2):
+    steps = []
+    for k in range(nSteps):
+        if k % 5 == 4:
+            steps.append(["PauseStep", "0"])
+        else:
+            steps.append(["ValveStep", str(2 + k % 60) + "," + str(3 + k % 60), "1,0"])
+    for d in range(depth):
+        steps = [["Loop", ["PumpStep", "ValveStep", "PauseStep"], str(iterations)] + steps]
+    return steps
+
+
+# benchmark GUI: the KATARA GUI connected to a simulated device
+def simulatedGUI(context):
+    if 'gui' not in context:
+        from KATARAGUI import KATARAGUI
+
+        class BenchmarkGUI(KATARAGUI):
+            def setDeviceType(self):
+                self.devicetype = SimulatedValveController
+
+        context['gui'] = BenchmarkGUI(context['root'])
+        context['gui'].connect("benchmark")
+    return context['gui']
+
+
+@benchmark("recursiveIterCheck_depth5")
+def iterCheckBenchmark(context):
+    step = PauseStep.__new__(PauseStep) # the check does not use the step's widgets
+    iters = (6, 6, 6, 6, 6) # 7776 evaluations
+    return lambda: step.recursiveIterCheck(iters, "0.1*i[0] + i[4]", step.inputCheckForPause, ()), 1, None
+
+
+@benchmark("setPins_1_pin")
+def setPinBenchmark(context):
+    ctlr = SimulatedValveController("benchmark")
+    state = [0]
+    def operation():
+        state[0] = 1 - state[0]
+        ctlr.setPins([13], [state[0]])
+    return operation, 200, None
+
+
+@benchmark("setPins_32_pins")
+def setPinsBenchmark(context):
+    ctlr = SimulatedValveController("benchmark")
+    pins = list(range(2, 34))
+    state = [0]
+    def operation():
+        state[0] = 1 - state[0]
+        ctlr.setPins(pins, [state[0]]*len(pins))
+    return operation, 200, None
+
+
+# setPins_68_pins: setting every pin, which is sent to the firmware in two chunks.
+@benchmark("setPins_68_pins")
+def setAllPinsBenchmark(context):
+    ctlr = SimulatedValveController("benchmark")
+    pins = list(range(2, 70))
+    state = [0]
+    def operation():
+        state[0] = 1 - state[0]
+        ctlr.setPins(pins, [state[0]]*len(pins))
+    return operation, 200, None
+
+
+# PinCoalescer.burst_20_toggles: twenty toggles of different pins issued together, as quick clicks or a script's loop
+# make them, merged into one command by a 2 ms window; from the first toggle to the acknowledgement of the last.
+@benchmark("PinCoalescer.burst_20_toggles")
+def coalescerBenchmark(context):
+    from PinCoalescer import PinCoalescer
+    ctlr = SimulatedValveController("benchmark")
+    ctlr.attachCoalescer(PinCoalescer(ctlr, 0.002))
+    def operation():
+        updates = [ctlr.togglePinLater(pin)[1] for pin in range(2, 22)]
+        updates[-1].result()
+    return operation, 20, None
+
+
+@benchmark("runPump")
+def runPumpBenchmark(context):
+    ctlr = SimulatedValveController("benchmark")
+    pump = ctlr.specifyPump(2, 3, 4)
+    return lambda: pump.forward(100, 1000), 200, None
+
+
+@benchmark("Routine.load_2000_steps", needsTk = True)
+def loadBenchmark(context):
+    saved = savedProtocol(250, depth = 3)*8 # 8 copies of 250 steps nested in 3 loops
+    frame = [None]
+    def setup():
+        if frame[0]:
+            frame[0].destroy()
+        frame[0] = Frame(context['root'])
+        context['protocol'] = Protocol(frame[0], writable = False)
+    return lambda: context['protocol'].load(saved), 1, setup
+
+
+@benchmark("Protocol.run_10000_steps", needsTk = True)
+def runBenchmark(context):
+    gui = simulatedGUI(context)
+    protocol = gui.Protocol
+    protocol.load([["Loop", ["PumpStep", "ValveStep", "PauseStep"], "1000"] +
+                   [["ValveStep", str(2 + k) + "," + str(12 + k), "1," + str(k % 2)] for k in range(10)]])
+    timerWidget = Label(protocol.controlbox)
+    # Protocol.run without its button handling and thread: the same RoutineThread body runs in this thread. The loop
+    # runs step by step rather than as one repeat command, so that the per step overhead is measured.
+    def operation():
+        Loop.repeatOnDevice = False
+        try:
+            protocol.saveEntries()
+            protocol.numberSteps()
+            RoutineThread(Routine.run, protocol, threading.current_thread(), timerWidget = timerWidget).run()
+        finally:
+            Loop.repeatOnDevice = True
+    return operation, 1, None
+
+
+@benchmark("GUI.togglePin", needsTk = True)
+def toggleBenchmark(context):
+    gui = simulatedGUI(context)
+    def operation():
+        gui.togglePin(13)
+        context['root'].update_idletasks()
+    return operation, 200, None
+
+
+@benchmark("GUI.recolor_all_valves", needsTk = True)
+def recolorBenchmark(context):
+    gui = simulatedGUI(context)
+    state = [0]
+    def operation():
+        state[0] = 1 - state[0]
+        for key, cell in gui.btndict.items():
+            if key != "AvailablePinsStatement":
+                cell.config(bg = "green" if state[0] else "gray")
+        context['root'].update_idletasks()
+    return operation, 50, None
+
+
+@benchmark("StateExport.publish")
+def exportBenchmark(context):
+    from StateExport import StateExporter
+    exporter = StateExporter(os.path.join(tempfile.mkdtemp(), "state.bin"))
+    state = [0]
+    def operation():
+        state[0] = 1 - state[0]
+        exporter.publish(state[0] << 13)
+    return operation, 1000, None
+
+
+@benchmark("StateExport.read")
+def readStateBenchmark(context):
+    from StateExport import StateExporter, StateReader
+    path = os.path.join(tempfile.mkdtemp(), "state.bin")
+    StateExporter(path).publish(1 << 13)
+    reader = StateReader(path)
+    return reader.read, 1000, None
+
+
+# echoState: target of the reader process of the StateExport.round_trip benchmark. Waits for each update of the
+#   state file and writes its sequence number to the echo file, until the sequence number reaches stop.
+def echoState(path, echoPath, stop):
+    import mmap
+    from StateExport import StateReader, sequenceStruct
+    reader = StateReader(path)
+    with open(echoPath, 'r+b') as file:
+        echo = mmap.mmap(file.fileno(), sequenceStruct.size)
+        sequence = 0
+        while sequence < stop:
+            if reader.sequence() != sequence:
+                sequence = reader.read()['sequence']
+                sequenceStruct.pack_into(echo, 0, sequence)
+            time.sleep(0) # yield, in case both processes share a core
+
+
+# StateExport.round_trip: time from publishing a state until a reader in another process has read it and answered
+# through a second mapped file; the latency seen by a reader is about half of it.
+@benchmark("StateExport.round_trip")
+def stateLatencyBenchmark(context):
+    import mmap
+    from StateExport import StateExporter, StateReader, sequenceStruct
+    from ProcessExecutor import context as processes
+    directory = tempfile.mkdtemp()
+    path, echoPath = os.path.join(directory, "state.bin"), os.path.join(directory, "echo.bin")
+    exporter = StateExporter(path)
+    reader = StateReader(path)
+    with open(echoPath, 'wb') as file:
+        file.write(b'\0'*sequenceStruct.size)
+    echoFile = open(echoPath, 'r+b')
+    echo = mmap.mmap(echoFile.fileno(), sequenceStruct.size)
+    stop = 2**62
+    process = processes.Process(target = echoState, args = (path, echoPath, stop))
+    process.daemon = True
+    process.start()
+    state = [0]
+    def operation():
+        state[0] = 1 - state[0]
+        exporter.publish(state[0] << 13)
+        sequence = reader.sequence()
+        while sequenceStruct.unpack_from(echo, 0)[0] != sequence:
+            if not process.is_alive():
+                raise IOError("The reader process exited.")
+            time.sleep(0)
+    operation() # wait for the reader process to start
+    return operation, 1000, None
+
+
+@benchmark("SavedProtocol.plan_10000_steps")
+def planSavedBenchmark(context):
+    from SavedProtocol import planSaved
+    saved = savedProtocol(10, depth = 3, iterations = 10) # 10000 steps to run
+    pins = dict([(p, 0) for p in range(2, 70)])
+    return lambda: planSaved(saved, pins), 1, None
+
+
+# ProtocolBuilder.matrix_100000_rows: builds a protocol from a 100000 x 16 valve matrix in which each valve changes
+# on about 5% of the rows, about 160000 steps.
+@benchmark("ProtocolBuilder.matrix_100000_rows")
+def matrixBenchmark(context):
+    import numpy
+    from ProtocolBuilder import ProtocolBuilder
+    matrix = numpy.random.RandomState(0).random_sample((100000, 16)) < 0.05
+    return lambda: ProtocolBuilder().valveMatrix(matrix, range(2, 18), dt = 0.01), 1, None
+
+
+# MatrixImport.stream_1000000_rows: streams the steps of a 1000000 x 16 valve matrix, in which each valve changes on
+# about 0.2% of the rows, chunk by chunk.
+@benchmark("MatrixImport.stream_1000000_rows")
+def matrixImportBenchmark(context):
+    import numpy
+    from MatrixImport import matrixSteps
+    matrix = (numpy.random.RandomState(0).random_sample((1000000, 16)) < 0.002).astype('i1')
+    def operation():
+        for step in matrixSteps(matrix, range(2, 18), dt = 0.001):
+            pass
+    return operation, 1, None
+
+
+# ControlServer.set_32_pins: one HTTP request setting 32 pins through the control server, from connecting to reading
+# the reply.
+@benchmark("ControlServer.set_32_pins")
+def controlServerBenchmark(context):
+    try:
+        from urllib.request import urlopen, Request # python 3
+    except ImportError:
+        from urllib2 import urlopen, Request # python 2.7
+    from ControlServer import ControlServer
+    ctlr = SimulatedValveController("benchmark")
+    server = ControlServer(ctlr, ("127.0.0.1", 0))
+    server.start()
+    url = "http://%s:%d/commands" % server.address
+    state = [0]
+    def operation():
+        state[0] = 1 - state[0]
+        body = json.dumps({'commands': [{'op': "pins", 'pins': list(range(2, 34)), 'states': state[0]}]})
+        urlopen(Request(url, body.encode('utf-8'), {'Content-Type': "application/json"})).read()
+    return operation, 100, None
+
+
+# startupCommand: returns an operation that runs a command in a new python process from this directory, as a cold
+#   start of the program does.
+#   Input:
+#       arguments - arguments to the python interpreter
+#   Output: the operation
+def startupCommand(arguments):
+    directory = os.path.dirname(os.path.abspath(__file__))
+    def operation():
+        subprocess.check_call([sys.executable] + arguments, cwd = directory, stdout = open(os.devnull, 'w'))
+    return operation
+
+
+@benchmark("startup.import_KATARAGUI")
+def importBenchmark(context):
+    return startupCommand(["-c", "import KATARAGUI"]), 1, None
+
+
+@benchmark("startup.main_window", needsTk = True)
+def startupBenchmark(context):
+    return startupCommand(["main.py", "--startup-time"]), 1, None
+
+
+# runBenchmarks: runs benchmarks.
+#   Inputs:
+#       names - names of the benchmarks to run, or None for all
+#       repeat - number of repeats of each
+#   Output: the results, as saved to JSON
+def runBenchmarks(names = None, repeat = 5):
+    results = OrderedDict()
+    context = {}
+    try:
+        context['root'] = Tk()
+        context['root'].withdraw()
+        config.root = context['root']
+    except TclError as E:
+        tkError = str(E)
+    metricsFile, traceDirectory = config.metricsFile, config.traceDirectory
+    config.metricsFile, config.traceDirectory = None, None # keep benchmark controllers from writing files
+    stdout = sys.stdout
+    devnull = open(os.devnull, 'w')
+    try:
+        for name, (function, needsTk) in benchmarks.items():
+            if names and name not in names:
+                continue
+            if needsTk and 'root' not in context:
+                results[name] = {"skipped": "Tk is not available: " + tkError}
+            else:
+                sys.stdout = devnull # the code under test prints its serial traffic
+                try:
+                    operation, number, setup = function(context)
+                    results[name] = measure(operation, number, repeat, setup)
+                except Exception as E:
+                    results[name] = {"error": str(E)}
+                finally:
+                    sys.stdout = stdout
+            print(name + ": " + formatResult(results[name]))
+    finally:
+        sys.stdout = stdout
+        devnull.close()
+        config.metricsFile, config.traceDirectory = metricsFile, traceDirectory
+        if 'root' in context:
+            context['root'].destroy()
+    return OrderedDict([("timestamp", time.strftime("%Y-%m-%dT%H:%M:%S")), ("commit", gitCommit()),
+                        ("python", platform.python_version()), ("platform", platform.platform()),
+                        ("benchmarks", results)])
+
+
+# gitCommit: returns the commit of the working tree, or None if it is not a git checkout.
+def gitCommit():
+    try:
+        out = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd = os.path.dirname(os.path.abspath(__file__)),
+                                      stderr = open(os.devnull, 'w'))
+        return out.decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# formatResult: one line summary of a benchmark result.
+def formatResult(result):
+    if "median" not in result:
+        return result.get("skipped") or "error: " + result["error"]
+    return "median %.3f us, min %.3f us per operation" % (result["median"]*1e6, result["min"]*1e6)
+
+
+# compareResults: compares two sets of results, for example from two commits.
+#   Inputs:
+#       old - results loaded from an earlier JSON file
+#       new - results to compare to them
+#   Output: OrderedDict of benchmark name: new median / old median, for benchmarks that ran in both
+def compareResults(old, new):
+    ratios = OrderedDict()
+    for name, result in new["benchmarks"].items():
+        before = old["benchmarks"].get(name, {})
+        if "median" in result and "median" in before and before["median"] > 0:
+            ratios[name] = result["median"]/before["median"]
+    return ratios
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description = "Benchmark the KATARA software against a simulated device.")
+    parser.add_argument("names", nargs = "*", help = "benchmarks to run (default: all): " + ", ".join(benchmarks))
+    parser.add_argument("--out", default = "benchmark_results.json", help = "JSON file for the results")
+    parser.add_argument("--compare", help = "JSON results of an earlier run to compare to")
+    parser.add_argument("--repeat", type = int, default = 5, help = "repeats of each benchmark")
+    args = parser.parse_args()
+    results = runBenchmarks(args.names, args.repeat)
+    with open(args.out, 'w') as file:
+        json.dump(results, file, indent = 2)
+    if args.compare:
+        with open(args.compare) as file:
+            old = json.load(file)
+        print("Compared to " + str(old.get("commit")) + ":")
+        for name, ratio in compareResults(old, results).items():
+            print("%-30s %6.2fx %s" % (name, ratio, "slower" if ratio > 1 else "faster"))
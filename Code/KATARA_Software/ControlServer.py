@@ -0,0 +1,636 @@
+#MIT License
+#
+#Copyright (c) 2017 Jonathan A. White
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import json
+import threading
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler #python 2.7
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+except:
+    from http.server import HTTPServer, BaseHTTPRequestHandler #python 3
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+import config
+from SerialMetrics import clock
+from ValveLocks import ValveLockManager
+from ValveTrace import setStepContext
+from SavedProtocol import planSaved
+
+# ControlServer lets scripts drive a KATARA device over HTTP on localhost, without the GUI. Every request is handed to
+# one thread, the serial owner, which is the only thread that talks to the device; requests from many clients queue up
+# there and are carried out back to back, and protocols uploaded by clients run on the same thread between them. All
+# requests and replies are JSON:
+#
+#   GET  /status                    pin states, running pumps and protocol runs
+#   GET  /status/stream             the status as one JSON line every time it changes, until the client disconnects;
+#                                   ?interval=s sends at most one line every s seconds
+#   POST /commands                  {"commands": [command, ...]}, carried out in order with no other client's commands
+#                                   in between. Every command is checked before the first is sent. Commands are
+#                                   {"op": "pins", "pins": [2, 3], "states": [1, 0]} (one set pins frame; "states" may
+#                                   be a single state for every pin), {"op": "pump", "valves": [20, 21, 22], "rate": 5,
+#                                   "cycles": 10, "direction": "f"} (cycles -1 pumps until stopped) and
+#                                   {"op": "stopPump", "valves": [20, 21, 22]}
+#   POST /protocols                 {"protocol": saved protocol, "name": name} runs a protocol in the format saved by
+#                                   Protocol.save (see SavedProtocol); replies with the run's "id"
+#   GET  /protocols/<id>            the state of a run; ?wait=s waits up to s seconds for it to end
+#   POST /protocols/<id>/stop       cancels a run, stopping the pumps it started
+#
+# Valves used by a running protocol or pump are locked (see ValveLockManager); commands that would change them are
+# rejected. So that web pages open in a browser on the same computer cannot send requests, requests must name the
+# server by a local host name (or the address it listens on) in their Host header, any Origin header must be a local
+# one, and POST bodies must be sent as application/json. Usage: python ControlServer.py [--port COM3 | --emulate] [--address 127.0.0.1:8765]
+
+localHosts = ("localhost", "127.0.0.1", "::1") # host names accepted in the Host and Origin headers
+
+# states of a protocol run
+RUNNING, DONE, CANCELLED, FAILED = "running", "done", "cancelled", "failed"
+
+
+# Job: a function to call on the serial owner, and its result once it has been called.
+class Job:
+
+    # Job.__init__
+    #   Inputs:
+    #       function - function to call, with no arguments
+    #       changes - False if the function only reads the state
+    def __init__(self, function, changes = True):
+        self.function = function
+        self.changes = changes
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    # Job.run: calls the function, keeping its result or the error it raised. Called by the serial owner.
+    def run(self):
+        try:
+            self.result = self.function()
+        except Exception as E:
+            self.error = E
+        finally:
+            self.done.set()
+
+    # Job.wait: waits for the job to be carried out.
+    #   Input:
+    #       timeout - seconds to wait, None to wait for as long as it takes
+    #   Output: the function's result; raises the error it raised, or an IOError if the timeout passes first.
+    def wait(self, timeout = None):
+        if not self.done.wait(timeout):
+            raise IOError("Error: the device did not carry out the request in time.")
+        if self.error:
+            raise self.error
+        return self.result
+
+
+# ProtocolRun: a protocol uploaded by a client, planned into events (see SavedProtocol.planSaved).
+class ProtocolRun:
+
+    # ProtocolRun.__init__
+    #   Inputs:
+    #       runId - number of the run
+    #       name - name given by the client
+    #       events - list of events
+    #       duration - seconds the protocol takes
+    def __init__(self, runId, name, events, duration):
+        self.runId = runId
+        self.name = name
+        self.events = events
+        self.duration = duration
+        self.valves = set()
+        for event in events:
+            action = event[3]
+            if action[0] == "pins":
+                self.valves.update(action[1])
+            elif action[0] == "pump":
+                self.valves.update(action[2])
+        self.state = RUNNING
+        self.start = None # clock() time at which the run started
+        self.index = 0 # index of the next event to carry out
+        self.error = None
+
+    # ProtocolRun.nextTime: returns the clock() time of the next event, or of the end of the run.
+    def nextTime(self):
+        if self.index < len(self.events):
+            return self.start + self.events[self.index][0]
+        return self.start + self.duration
+
+    # ProtocolRun.describe: returns the state of the run as a JSON serializable dictionary.
+    def describe(self):
+        step, iters = 0, None
+        if self.index:
+            step, iters = self.events[self.index - 1][1:3]
+        return {'id': self.runId, 'name': self.name, 'state': self.state, 'step': step, 'iters': iters or [],
+                'events': len(self.events), 'eventsDone': self.index,
+                'duration': self.duration if self.duration != float('Inf') else None,
+                'elapsed': clock() - self.start if self.start is not None else 0, 'error': self.error}
+
+
+# RunningPump: a pump started by a client or a protocol run, until it ends or is stopped.
+class RunningPump:
+
+    # RunningPump.__init__
+    #   Inputs:
+    #       pump - the device's pump object
+    #       direction - 'f' or 'r'
+    #       end - clock() time at which the pump ends, inf if it runs until stopped
+    #       run - the ProtocolRun that started the pump, None if a client did
+    def __init__(self, pump, direction, end, run = None):
+        self.pump = pump
+        self.direction = direction
+        self.end = end
+        self.run = run
+
+
+# SerialOwner: the thread that carries out every request and protocol event on the device, in the order they are due.
+class SerialOwner(threading.Thread):
+
+    # SerialOwner.__init__
+    #   Inputs:
+    #       device - a connected ValveController
+    #       locks - ValveLockManager of the valves in use; a new one if None
+    def __init__(self, device, locks = None):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.device = device
+        self.locks = locks or ValveLockManager()
+        self.condition = threading.Condition()
+        self.jobs = []
+        self.runs = {} # runId: ProtocolRun
+        self.nextRunId = 1
+        self.pumps = [] # RunningPumps
+        self.stopping = False
+        self.version = 0 # incremented, under the condition, after every change of state
+
+    # SerialOwner.submit: queues a function to be called on the serial owner.
+    #   Inputs:
+    #       function - function to call, with no arguments
+    #       changes - False if the function only reads the state
+    #   Output: the Job, whose wait method returns the result
+    def submit(self, function, changes = True):
+        job = Job(function, changes)
+        with self.condition:
+            if self.stopping:
+                raise IOError("Error: the control server is shutting down.")
+            self.jobs.append(job)
+            self.condition.notify_all()
+        return job
+
+    # SerialOwner.stop: cancels every run, stops the pumps still running and ends the thread.
+    def stop(self):
+        self.submit(self._cancelAll).wait(10)
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        self.join(10)
+
+    # SerialOwner.run: target of the thread. Carries out the queued jobs, then the protocol events that are due, and
+    #   waits for the next job or event.
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.jobs and not self.stopping:
+                    timeout = self._nextTime() - clock()
+                    if timeout <= 0:
+                        break
+                    self.condition.wait(timeout if timeout != float('Inf') else None)
+                jobs, self.jobs = self.jobs, []
+                if self.stopping and not jobs:
+                    return
+            for job in jobs:
+                setStepContext(0) # records caused by clients belong to no step
+                job.run()
+            changed = bool([job for job in jobs if job.changes])
+            for run in [r for r in self.runs.values() if r.state == RUNNING]:
+                changed = self._advance(run) or changed
+            changed = self._endPumps() or changed
+            if changed:
+                self._changed()
+
+    # SerialOwner._nextTime: returns the clock() time at which the next event is due or a pump ends.
+    def _nextTime(self):
+        times = [r.nextTime() for r in self.runs.values() if r.state == RUNNING] + [p.end for p in self.pumps]
+        return min(times) if times else float('Inf')
+
+    # SerialOwner._changed: lets threads waiting for a change of state (see waitForChange) go on.
+    def _changed(self):
+        with self.condition:
+            self.version += 1
+            self.condition.notify_all()
+
+    # SerialOwner.waitForChange: waits for the state to change.
+    #   Inputs:
+    #       version - version of the state the caller has seen
+    #       timeout - seconds to wait at most
+    #   Output: the current version; the same as version if the timeout passed with no change
+    def waitForChange(self, version, timeout):
+        with self.condition:
+            if self.version == version:
+                self.condition.wait(timeout)
+            return self.version
+
+    # SerialOwner._advance: carries out the events of a run that are due, and ends the run once it has taken its
+    #   duration.
+    #   Input:
+    #       run - the ProtocolRun
+    #   Output: True if anything was done
+    def _advance(self, run):
+        changed = False
+        try:
+            while run.index < len(run.events) and run.nextTime() <= clock():
+                offset, step, iters, action = run.events[run.index]
+                setStepContext(step, iters)
+                if action[0] == "pins":
+                    self.device.setPins(action[1], action[2])
+                elif action[0] == "pump":
+                    self._startPump(action[2], action[1], action[3], action[4], run, run.start + offset)
+                run.index += 1
+                changed = True
+            if run.index == len(run.events) and run.nextTime() <= clock():
+                self._endRun(run, DONE)
+                changed = True
+        except Exception as E:
+            run.error = str(E)
+            self._endRun(run, FAILED)
+            changed = True
+        return changed
+
+    # SerialOwner._startPump: starts a pump and records it.
+    #   Inputs:
+    #       valves - the pump's three valves
+    #       direction - 'f' or 'r'
+    #       rate - cycles per second
+    #       cycles - number of cycles, -1 to pump until stopped
+    #       run - ProtocolRun starting the pump, None for a client
+    #       start - clock() time the pump starts at
+    #   Output: the RunningPump
+    def _startPump(self, valves, direction, rate, cycles, run = None, start = None):
+        pump = self.device.specifyPump(*valves)
+        if direction == 'r':
+            pump.reverse(rate, cycles)
+        else:
+            pump.forward(rate, cycles)
+        end = float('Inf') if cycles == -1 else (start or clock()) + float(cycles)/float(rate)
+        running = RunningPump(pump, direction, end, run)
+        self.pumps.append(running)
+        return running
+
+    # SerialOwner._endPumps: forgets pumps that have ended, freeing the valves of those started by clients.
+    #   Output: True if any pump ended
+    def _endPumps(self):
+        now = clock()
+        ended = [p for p in self.pumps if p.end <= now]
+        for pump in ended:
+            self.pumps.remove(pump)
+            if pump.run is None:
+                self.locks.release(pump)
+        return bool(ended)
+
+    # SerialOwner._stopPump: stops a running pump and forgets it.
+    def _stopPump(self, running):
+        if running in self.pumps:
+            self.pumps.remove(running)
+        if running.end > clock():
+            running.pump.stop()
+        if running.run is None:
+            self.locks.release(running)
+
+    # SerialOwner._endRun: ends a run, stopping its pumps if it did not finish, and frees its valves.
+    #   Inputs:
+    #       run - the ProtocolRun
+    #       state - DONE, CANCELLED or FAILED
+    def _endRun(self, run, state):
+        run.state = state
+        try:
+            for pump in [p for p in self.pumps if p.run is run]:
+                if state == DONE:
+                    self.pumps.remove(pump) # its time is up or it pumps on after the protocol, as in the GUI
+                else:
+                    self._stopPump(pump)
+        finally:
+            self.locks.release(run)
+
+    # SerialOwner._cancelAll: cancels every run and stops every pump. Called on the serial owner.
+    def _cancelAll(self):
+        for run in [r for r in self.runs.values() if r.state == RUNNING]:
+            self._endRun(run, CANCELLED)
+        for pump in list(self.pumps):
+            self._stopPump(pump)
+
+    # SerialOwner.status: returns the state of the device, pumps and runs as a JSON serializable dictionary.
+    def status(self):
+        return self.submit(self._status, False).wait(10)
+
+    # SerialOwner._status: status, on the serial owner.
+    def _status(self):
+        now = clock()
+        return {'version': self.version, 'pins': dict([(str(p), s) for p, s in self.device.pinStates.items()]),
+                'pumps': [{'valves': list(p.pump.valveKeys), 'direction': p.direction,
+                           'remaining': p.end - now if p.end != float('Inf') else None,
+                           'run': p.run.runId if p.run else None} for p in self.pumps],
+                'runs': [r.describe() for r in self.runs.values()]}
+
+    # SerialOwner.runCommands: checks a batch of commands, then carries them out. Called on the serial owner.
+    #   Input:
+    #       commands - list of command dictionaries (see the top of this file)
+    #   Output: list of results, one per command; raises a ValueError if a command is not valid, before sending any.
+    def runCommands(self, commands):
+        claimed = set() # valves of the pumps started by earlier commands of the batch
+        checked = [self._checkCommand(c, claimed) for c in commands]
+        results = []
+        for command in checked:
+            if command[0] == "pins":
+                self.device.setPins(command[1], command[2])
+                results.append({'pins': [str(p) for p in command[1]]})
+            elif command[0] == "pump":
+                valves, direction, rate, cycles = command[1:]
+                running = self._startPump(valves, direction, rate, cycles)
+                self.locks.acquire(running, valves, "a pump on valves " + ", ".join([str(v) for v in valves]))
+                results.append({'valves': [str(v) for v in valves], 'seconds': running.end - clock()
+                                if running.end != float('Inf') else None})
+            else:
+                for running in [p for p in self.pumps if p.run is None and list(p.pump.valveKeys) == command[1]]:
+                    self._stopPump(running)
+                results.append({'valves': [str(v) for v in command[1]]})
+        return results
+
+    # SerialOwner._checkCommand: checks a command and converts it to a tuple: ("pins", pins, states),
+    #   ("pump", valves, direction, rate, cycles) or ("stopPump", valves).
+    #   Inputs:
+    #       command - command dictionary
+    #       claimed - set of the valves of pumps started by earlier commands of the batch; pump commands add theirs
+    def _checkCommand(self, command, claimed):
+        if not isinstance(command, dict):
+            raise ValueError("Error: a command is a JSON object with an \"op\".")
+        op = command.get("op")
+        if op == "pins":
+            pins = [self._pin(p) for p in command.get("pins", [])]
+            states = command.get("states", [])
+            if not isinstance(states, list):
+                states = [states]*len(pins)
+            if len(states) != len(pins):
+                raise ValueError("The length of the pins and states entries must be the same.")
+            if len(set(pins)) < len(pins):
+                raise ValueError("There is a duplicate pin entry.")
+            for state in states:
+                if state not in (0, 1):
+                    raise ValueError("Pins must be set to either 0 or 1.")
+            self._checkFree(pins, claimed)
+            return ("pins", pins, states)
+        if op in ("pump", "stopPump"):
+            valves = [self._pin(v) for v in command.get("valves", [])]
+            if len(set(valves)) != 3 or len(valves) != 3:
+                raise ValueError("A pump has three different valves.")
+            if op == "stopPump":
+                return ("stopPump", valves)
+            self._checkFree(valves, claimed)
+            claimed.update(valves)
+            rate, cycles = command.get("rate"), command.get("cycles")
+            if type(rate) != int or rate < 1:
+                raise ValueError(str(rate) + " is not a valid rate for a pump. Rates must be positive integers.")
+            if type(cycles) != int or cycles < -1 or cycles == 0:
+                raise ValueError(str(cycles) + " is not a valid number of cycles for a pump. The number of cycles "
+                                 "must be a positive integer, or -1 to pump until stopped.")
+            direction = command.get("direction", 'f')
+            if direction not in ('f', 'r'):
+                raise ValueError("The direction of a pump is either \"f\" or \"r\".")
+            return ("pump", valves, direction, rate, cycles)
+        raise ValueError("Error: unknown command " + str(op) + ".")
+
+    # SerialOwner._pin: converts a pin from a request, such as 12, "12" or "B:12", to its key in the device's pin states.
+    def _pin(self, pin):
+        try:
+            pin = int(pin)
+        except (ValueError, TypeError):
+            pin = str(pin).strip()
+        if pin not in self.device.pinStates:
+            raise ValueError("Error: " + str(pin) + " is not an available pin.")
+        return pin
+
+    # SerialOwner._checkFree: raises a ValueError if any of the valves is held by a protocol run or a pump, or
+    #   claimed by a pump started earlier in the same batch.
+    def _checkFree(self, valves, claimed):
+        used = [v for v in valves if self.locks.owner(v) is not None or v in claimed]
+        if used:
+            raise ValueError("Error: " + ", ".join([str(v) + " is in use by " + (self.locks.owner(v) or "a pump")
+                                                    for v in used]) + ".")
+
+    # SerialOwner.startRun: plans a saved protocol and starts it, or raises a ValueError if it is not valid or uses
+    #   valves in use.
+    #   Inputs:
+    #       saved - the saved protocol list
+    #       name - name of the run
+    #   Output: the ProtocolRun
+    def startRun(self, saved, name):
+        events, duration = planSaved(saved, self.device.pinStates) # planned here, on the client's thread
+        def start():
+            run = ProtocolRun(self.nextRunId, name, events, duration)
+            self.locks.acquire(run, run.valves, "protocol " + name)
+            self.nextRunId += 1
+            self.runs[run.runId] = run
+            run.start = clock()
+            return run
+        return self.submit(start).wait(10)
+
+    # SerialOwner.stopRun: cancels a run.
+    #   Input:
+    #       runId - number of the run
+    #   Output: the state of the run (see ProtocolRun.describe)
+    def stopRun(self, runId):
+        def stop():
+            run = self._run(runId)
+            if run.state == RUNNING:
+                self._endRun(run, CANCELLED)
+            return run.describe()
+        return self.submit(stop).wait(10)
+
+    # SerialOwner._run: returns a run, or raises a KeyError if there is none with that number.
+    def _run(self, runId):
+        if runId not in self.runs:
+            raise KeyError(runId)
+        return self.runs[runId]
+
+    # SerialOwner.describeRun: returns the state of a run, first waiting up to wait seconds for it to end.
+    def describeRun(self, runId, wait = 0):
+        deadline = clock() + wait
+        version = self.version
+        while self._run(runId).state == RUNNING and clock() < deadline:
+            version = self.waitForChange(version, deadline - clock())
+        return self._run(runId).describe()
+
+
+# ControlRequestHandler: handles one HTTP request by handing it to the serial owner (see the top of this file).
+class ControlRequestHandler(BaseHTTPRequestHandler):
+    server_version = "KATARA"
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    # ControlRequestHandler.handle_request: routes a request and replies with JSON. Invalid requests get a 400 reply,
+    #   unknown paths and runs a 404 and device errors a 500, each with an "error" message.
+    #   Input:
+    #       method - "GET" or "POST"
+    def handle_request(self, method):
+        url = urlparse(self.path)
+        parts = [p for p in url.path.split('/') if p]
+        query = dict([(k, v[-1]) for k, v in parse_qs(url.query).items()])
+        owner = self.server.owner
+        if not self.fromLocalClient():
+            self.reply(403, {'error': "Error: requests must come from a local client."})
+            return
+        try:
+            if method == "POST":
+                contentType = (self.headers.get('Content-Type') or "").split(';')[0].strip().lower()
+                if contentType != "application/json":
+                    self.reply(415, {'error': "Error: the request body must be sent as application/json."})
+                    return
+                length = int(self.headers.get('Content-Length') or 0)
+                body = json.loads(self.rfile.read(length).decode('utf-8') or "{}")
+                if not isinstance(body, dict):
+                    raise ValueError("Error: the request body must be a JSON object.")
+            if method == "GET" and parts == ["status"]:
+                self.reply(200, owner.status())
+            elif method == "GET" and parts == ["status", "stream"]:
+                self.stream(float(query.get("interval", 0)))
+            elif method == "POST" and parts == ["commands"]:
+                commands = body.get("commands")
+                if not isinstance(commands, list):
+                    raise ValueError("Error: \"commands\" must be a list of commands.")
+                self.reply(200, {'results': owner.submit(lambda: owner.runCommands(commands)).wait(30)})
+            elif method == "POST" and parts == ["protocols"]:
+                run = owner.startRun(body.get("protocol"), str(body.get("name", "")))
+                self.reply(200, run.describe())
+            elif method == "GET" and len(parts) == 2 and parts[0] == "protocols":
+                self.reply(200, owner.describeRun(int(parts[1]), float(query.get("wait", 0))))
+            elif method == "POST" and len(parts) == 3 and parts[0] == "protocols" and parts[2] == "stop":
+                self.reply(200, owner.stopRun(int(parts[1])))
+            else:
+                self.reply(404, {'error': "Error: unknown request " + method + " " + url.path + "."})
+        except KeyError as E:
+            self.reply(404, {'error': "Error: there is no protocol run " + str(E) + "."})
+        except ValueError as E:
+            self.reply(400, {'error': str(E)})
+        except Exception as E: # IOError or Warning from the device
+            self.reply(500, {'error': str(E)})
+
+    # ControlRequestHandler.fromLocalClient: returns True if the Host header names this computer (or the address the
+    #   server listens on) and the Origin header, if any, is a page served from this computer. This keeps web pages,
+    #   including ones that rebind their name to 127.0.0.1, from using the server through the user's browser.
+    def fromLocalClient(self):
+        allowed = localHosts + (self.server.server_address[0],)
+        host = urlparse("//" + (self.headers.get('Host') or "")).hostname
+        if host not in allowed:
+            return False
+        origin = self.headers.get('Origin')
+        return origin is None or urlparse(origin).hostname in allowed
+
+    # ControlRequestHandler.reply: sends a JSON reply.
+    def reply(self, code, content):
+        data = json.dumps(content).encode('utf-8')
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    # ControlRequestHandler.stream: sends the status as a JSON line every time it changes, until the client
+    #   disconnects or the server shuts down.
+    #   Input:
+    #       interval - least number of seconds between lines
+    def stream(self, interval):
+        owner = self.server.owner
+        self.close_connection = True
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+        version = None
+        try:
+            while not owner.stopping:
+                status = owner.status()
+                if status['version'] != version:
+                    version = status['version']
+                    self.wfile.write((json.dumps(status) + "\n").encode('utf-8'))
+                    self.wfile.flush()
+                if interval:
+                    threading.Event().wait(interval)
+                owner.waitForChange(version, 1.0)
+        except (IOError, OSError): # the client disconnected
+            pass
+
+    # ControlRequestHandler.log_message: requests are not logged, so that busy clients do not flood the console.
+    def log_message(self, format, *args):
+        pass
+
+
+class ControlHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+# ControlServer: serves HTTP requests for a device from a background thread.
+#
+#   server = ControlServer(device)
+#   server.start()
+#   ...
+#   server.close()
+class ControlServer:
+
+    # ControlServer.__init__: opens the listening socket.
+    #   Inputs:
+    #       device - a connected ValveController
+    #       address - (host, port) to listen on; only clients on this computer can connect to the default host
+    def __init__(self, device, address = None):
+        self.owner = SerialOwner(device)
+        self.httpd = ControlHTTPServer(address or config.controlServerAddress, ControlRequestHandler)
+        self.httpd.owner = self.owner
+        self.address = self.httpd.server_address
+        self.thread = threading.Thread(target = self.httpd.serve_forever)
+        self.thread.setDaemon(True)
+
+    # ControlServer.start: starts the serial owner and serving requests.
+    def start(self):
+        self.owner.start()
+        self.thread.start()
+
+    # ControlServer.close: stops serving, cancels running protocols and stops pumps. The device is left open.
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.owner.stop()
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description = "Serve HTTP/JSON requests for a KATARA device.")
+    parser.add_argument("--port", help = "serial port of the device")
+    parser.add_argument("--emulate", action = "store_true", help = "serve an emulated device (see FirmwareEmulator)")
+    parser.add_argument("--address", default = "%s:%d" % config.controlServerAddress, help = "host:port to listen on")
+    args = parser.parse_args()
+    if args.emulate:
+        from FirmwareEmulator import FirmwareEmulator
+        args.port = FirmwareEmulator().port
+    elif not args.port:
+        parser.error("either --port or --emulate is required")
+    from KATARAValveController import KATARAValveController
+    device = KATARAValveController(args.port)
+    host, port = args.address.rsplit(':', 1)
+    server = ControlServer(device, (host, int(port)))
+    server.start()
+    print("Serving " + args.port + " on http://%s:%d/" % server.address)
+    try:
+        while True:
+            threading.Event().wait(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        device.close()
@@ -0,0 +1,159 @@
+#MIT License
+#
+#Copyright (c) 2017 Jonathan A. White
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+
+import os
+import time
+import select
+import threading
+try:
+    import Queue as queue #python 2.7
+except:
+    import queue #python 3
+from SerialMetrics import clock
+from SimulatedDevice import FirmwareModel
+
+# FirmwareEmulator runs the firmware model (see SimulatedDevice.FirmwareModel) behind a pseudo-terminal, so that the
+# unmodified controller classes can connect to it by port name as if it were an Arduino:
+#
+#   emulator = FirmwareEmulator()
+#   ctlr = KATARAValveController(emulator.port)
+#
+# The serial line is modelled at the emulator's baud rate: a frame is only handled once its last byte would have
+# arrived over the wire, and replies are released to the host once they would have been sent. Pumps change phase on
+# the firmware's schedule whether or not the host is talking to the device, and so do stream frames; messages the
+# firmware sends on its own while streaming are queued behind the replies like any other output. Every pin change is recorded in the model's
+# timeline. Requires a system with pseudo-terminals (Linux, macOS).
+
+class FirmwareEmulator:
+
+    # FirmwareEmulator.__init__: opens the pseudo-terminal and starts emulating.
+    #   Inputs:
+    #       baud - baud rate of the modelled serial line; the firmware uses 9600.
+    #       bitsPerByte - bits sent per byte, including start, stop and parity bits; 10 for the usual 8N1 format.
+    #       model - the FirmwareModel to run, a new one if None
+    def __init__(self, baud = 9600, bitsPerByte = 10, model = None):
+        import tty
+        self.baud = baud
+        self.bitsPerByte = bitsPerByte
+        self.byteTime = float(bitsPerByte)/baud # seconds to transfer one byte
+        self.model = model or FirmwareModel()
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave) # keep the slave open so the terminal survives the host closing it
+        self.start = clock()
+        self.rxDone = self.start # time the last byte received from the host finished arriving
+        self.bytesReceived = 0
+        self.bytesSent = 0
+        self.replies = queue.Queue()
+        self.stopEvent = threading.Event()
+        self.receiver = threading.Thread(target = self._receiveLoop)
+        self.sender = threading.Thread(target = self._sendLoop)
+        for thread in (self.receiver, self.sender):
+            thread.setDaemon(True)
+            thread.start()
+
+    # FirmwareEmulator._receiveLoop: target of the receiving thread. Reads what the host writes, waits for each frame
+    #   to finish arriving at the modelled baud rate, and runs it through the model. Between frames it advances the
+    #   running pumps.
+    def _receiveLoop(self):
+        while not self.stopEvent.isSet():
+            self.model.runPumps(clock())
+            self._queueOutput()
+            wait = 0.05
+            nextPhase = self.model.nextPhase()
+            if nextPhase is not None:
+                wait = min(wait, max(0, nextPhase - clock()))
+            try:
+                ready = select.select([self.master], [], [], wait)[0]
+                data = os.read(self.master, 1024).decode('ascii', 'replace') if ready else ""
+            except (OSError, ValueError): # closed
+                return
+            arrived = clock()
+            for char in data:
+                self.rxDone = max(self.rxDone, arrived) + self.byteTime
+                self.bytesReceived += 1
+                if char != 'c': # the model only acts on the end of a frame
+                    self.model.receive(char, self.rxDone)
+                    self._queueOutput()
+                    continue
+                self.sleepUntil(self.rxDone)
+                reply = self.model.receive(char, self.rxDone)
+                self._queueOutput()
+                if reply:
+                    self.replies.put((self.rxDone, reply))
+
+    # FirmwareEmulator._queueOutput: queues the messages the model has sent on its own, such as stream credits.
+    def _queueOutput(self):
+        for item in self.model.takeOutput():
+            self.replies.put(item)
+
+    # FirmwareEmulator._sendLoop: target of the sending thread. Releases replies to the host once they would have
+    #   been transferred at the modelled baud rate, one after another as the Arduino's serial port sends them.
+    def _sendLoop(self):
+        txDone = self.start
+        while not self.stopEvent.isSet():
+            try:
+                ready, reply = self.replies.get(timeout = 0.05)
+            except queue.Empty:
+                continue
+            txDone = max(txDone, ready) + len(reply)*self.byteTime
+            self.sleepUntil(txDone)
+            try:
+                os.write(self.master, reply.encode('ascii'))
+            except OSError: # closed
+                return
+            self.bytesSent += len(reply)
+
+    # FirmwareEmulator.sleepUntil: sleeps until a clock time.
+    def sleepUntil(self, when):
+        delay = when - clock()
+        if delay > 0:
+            time.sleep(delay)
+
+    # FirmwareEmulator.timeline: returns the pin changes the emulated device has made.
+    #   Inputs:
+    #       pin - only return changes of this pin, or None for all
+    #       relative - if True, times are seconds since the emulator started; otherwise they are SerialMetrics.clock
+    #           times, comparable with the times measured by the host in the same process.
+    #   Output: list of (time, pin, state)
+    def timeline(self, pin = None, relative = True):
+        self.model.runPumps(clock())
+        offset = self.start if relative else 0
+        return [(t - offset, p, s) for t, p, s in self.model.pinTimeline(pin)]
+
+    # FirmwareEmulator.close: stops emulating and closes the pseudo-terminal.
+    def close(self):
+        self.stopEvent.set()
+        self.receiver.join()
+        self.sender.join()
+        for fd in (self.master, self.slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description = "Emulate an Arduino running the KATARA firmware on a pseudo-terminal.")
+    parser.add_argument("--baud", type = int, default = 9600, help = "baud rate of the modelled serial line")
+    args = parser.parse_args()
+    emulator = FirmwareEmulator(args.baud)
+    print("Emulating a KATARA device on " + emulator.port + ". Press Ctrl-C to stop.")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    emulator.close()
+    for change in emulator.timeline():
+        print("%10.6f s  pin %2d -> %d" % change)
@@ -16,7 +16,9 @@ from Protocol_Tools import *
 from Step import Step
 from StepDerivatives import ValveStep # passes dictionary of available valves to ValveStep object
 from threading import Timer
+import weakref
 from no_wait_Dialog import no_wait_Dialog
+from ValveMap import ValveMap
 
 
 # KATARAGUI: the main class for the KATARA microfluidics controller GUI. Inherits from usbGUI which implements a shared
@@ -34,6 +36,17 @@ class KATARAGUI(usbGUI):
         self.setDeviceType()
         usbGUI.__init__(self, master)
         master.wm_title("KATARA")
+
+        # menu for adding more boards to the connected device (see MultiValveController)
+        self.boardmenu = Menu(self.menubar, tearoff=0)
+        self.boardmenu.config(postcommand = self.resetBoardMenu)
+        self.addPortMenu(self.boardmenu, self.addBoard)
+        self.menubar.add_cascade(label="Add Board", menu=self.boardmenu)
+        self.toolsmenu = Menu(self.menubar, tearoff=0)
+        self.toolsmenu.add_command(label="Verify Valve States", command=self.verifyValves)
+        self.toolsmenu.add_command(label="Memory Report", command=self.showMemoryReport)
+        self.menubar.add_cascade(label="Tools", menu=self.toolsmenu)
+        self.boardPanels = {} # (panel, valve map) of boards other than the first, by board name
         self.canvas.config(width = 460, height = 550)
         self.canvas.xview_moveto('0.0')
         self.canvas.yview_moveto('0.0')
@@ -72,8 +85,6 @@ class KATARAGUI(usbGUI):
         Step.btndict = self.btndict
         self.mainframe.bind("<<connection_warning>>", self.warning)
         self.mainframe.bind("<<disconnected_error>>", self.disconnected)
-        Protocol.holdErrorMessage = "You cannot start a protocol while a pump is running." #message to give user
-        #when Protocol.holdFlag==True, for this program, while a pump is running.
         ArduinoErrorProofedRoutine.vGUI = self
 
     # KATARAGUI.setDeviceType - Set the Driver for communicating with the valve controlling device. Overwrite
@@ -102,7 +113,8 @@ class KATARAGUI(usbGUI):
                 Step):
             self.Protocol.addStep(1)
 
-    # KATARAGUI.drawButtonPanel - draws a rectangular array of buttons
+    # KATARAGUI.drawButtonPanel - draws a rectangular array of valves on a valve map (see ValveMap). Each valve is
+    # keyed in btndict by pin number, to a ValveCell that colors it.
     # Inputs:
     #       buttonsAcross - The number of columns to draw in the button array
     #       buttonsDown - The number of rows to draw in the button array.
@@ -110,23 +122,55 @@ class KATARAGUI(usbGUI):
     def drawButtonPanel(self, buttonsAcross, buttonsDown):
         self.buttons_down = buttonsDown
         self.buttons_across = buttonsAcross
-        self.btn = [[0 for x in range(self.buttons_down)] for x in range(self.buttons_across)]
-        self.btnPanel = LabelFrame(self.mainframe)
-        self.btnPanel.grid(column=0, row=1, sticky=W)
+        self.valvePanels = Frame(self.mainframe) # holds the button panel of each board
+        self.valvePanels.grid(column=0, row=1, sticky=W)
+        self.btnPanel = LabelFrame(self.valvePanels)
+        self.btnPanel.grid(column=0, row=0, sticky=W)
         KATARAGUI.btndict["AvailablePinsStatement"] = "integer numbers 2-69"# to show in error messages where user enters
         # invalid pin number
+        self.valveMap = ValveMap(self.btnPanel, self.panelKeys(lambda pin: pin), self.togglePin)
+        self.valveMap.grid(column=0, row=0, sticky=W)
+        KATARAGUI.btndict.update(self.valveMap.cells)
 
+    # KATARAGUI.panelKeys - lays out the keys of a board's valves as drawn in its panel.
+    # Inputs:
+    #       key - function converting a pin number to its key in btndict
+    # Outputs: list of rows of keys, None where no pin is drawn
+    def panelKeys(self, key):
+        keys = []
         for y in range(self.buttons_down):
+            row = []
             for x in range(self.buttons_across):
                 pin_num = self.coordToPin(x, y)
-                if self.maxPinCondition(pin_num):
-                    break
-                self.btn[x][y] = Button(
-                    self.btnPanel, text=str(pin_num), bg="gray", width=5, height=2,
-                    command=lambda x1=x, y2=y: self.toggle(x1, y2)
-                )
-                KATARAGUI.btndict[pin_num] = self.btn[x][y]
-                self.btn[x][y].grid(column=x, row=y, sticky=W)
+                row.append(None if self.maxPinCondition(pin_num) else key(pin_num))
+            keys.append(row)
+        return keys
+
+    # KATARAGUI.drawBoardPanel - draws the valve map of an added board below the existing panels. Its valves are
+    # keyed in btndict by namespaced pin, for example "B:12".
+    # Inputs:
+    #       name - name of the board in the MultiValveController
+    # Outputs: None
+    def drawBoardPanel(self, name):
+        panel = LabelFrame(self.valvePanels, text = "Board " + name)
+        panel.grid(column=0, row=len(self.boardPanels) + 1, sticky=W)
+        valveMap = ValveMap(panel, self.panelKeys(lambda pin: self.device.pinKey(name, pin)), self.togglePin)
+        valveMap.grid(column=0, row=0, sticky=W)
+        self.boardPanels[name] = (panel, valveMap)
+        KATARAGUI.btndict.update(valveMap.cells)
+        KATARAGUI.btndict["AvailablePinsStatement"] = self.device.availablePinsStatement()
+
+    # KATARAGUI.removeBoardPanels - removes the button panels of added boards, e.g. when reconnecting.
+    # Inputs: None
+    # Outputs: None
+    def removeBoardPanels(self):
+        for panel, valveMap in self.boardPanels.values():
+            panel.destroy()
+        self.boardPanels = {}
+        for key in list(KATARAGUI.btndict):
+            if key != "AvailablePinsStatement" and type(key) != int:
+                del KATARAGUI.btndict[key]
+        KATARAGUI.btndict["AvailablePinsStatement"] = "integer numbers 2-69"
 
     # KATARAGUI.drawButtonPanelDim: Draw button panel with specified dimensions, buttons_accros by buttons_down.
     # Override for set ups that use fewer than 68 buttons
@@ -178,15 +222,92 @@ class KATARAGUI(usbGUI):
             return
 
         usbGUI.connect(self, port)
-        ValveStep.setValves = self.device.setPins
-        PumpStep.specifyPump = self.device.specifyPump
-        PumpStep.ctlr = self.device
+        self.removeBoardPanels()
+        self.bindDevice()
         if reset:
-            for btn in self.btndict:
-                self.btndict[btn].config(bg = 'gray')
+            self.valveMap.setAll('gray')
             for pump in ValveController.pPumps:
                 pump.ctlr = self.device
 
+    # KATARAGUI.bindDevice: points protocol steps at the connected device.
+    # Inputs: None
+    # Outputs: None
+    def bindDevice(self):
+        ValveStep.setValves = self.device.setPins
+        PumpStep.specifyPump = self.device.specifyPump
+        PumpStep.ctlr = self.device
+
+    # KATARAGUI.resetBoardMenu: Called when the user clicks on the "Add Board" dropdown menu- lists the connected USB
+    #   devices that could be added as another board, as the connect menu does (see usbGUI.resetConnectMenu).
+    # Inputs: None
+    # Outputs: None
+    def resetBoardMenu(self):
+        self.resetConnectMenu()
+
+    # KATARAGUI.addBoard: connects to another Arduino running the KATARA firmware and adds its valves to the GUI as a
+    #   new board, combining the boards in a MultiValveController.
+    # Inputs:
+    #       port - The com port to which the arduino is attached
+    # Outputs: None
+    def addBoard(self, port):
+        if not self.device or not self.device.isOpen():
+            tkMessageBox.showerror("Error", "Connect to the first board before adding another.")
+            return
+        if pumpGUI.runningPump or RoutineThread.protocolRunning:
+            no_wait_Dialog(self.master, "Error", "You cannot add a board while a pump or protocol is running.")
+            return
+        try:
+            board = self.devicetype(port)
+        except Exception as E:
+            tkMessageBox.showerror("Error", str(E))
+            return
+        from MultiValveController import MultiValveController # only needed once a second board is added
+        if not isinstance(self.device, MultiValveController):
+            self.device = MultiValveController([self.device])
+        name = self.device.addBoard(board)
+        self.bindDevice()
+        self.drawBoardPanel(name)
+
+    # KATARAGUI.verifyValves: Called from the Tools menu. Reads back the valve states from the device and corrects any
+    #   that were wrong (see KATARAGUI.syncValves).
+    # Inputs: None
+    # Outputs: None
+    def verifyValves(self):
+        if not self.device or not self.device.isOpen():
+            tkMessageBox.showerror("Error", "Not connected to arduino.")
+            return
+        if pumpGUI.runningPump or RoutineThread.protocolRunning:
+            no_wait_Dialog(self.master, "Error", "You cannot verify valve states while a pump or protocol is running.")
+            return
+        try:
+            self.syncValves(confirm = True)
+        except (IOError, Warning) as E:
+            tkMessageBox.showerror("Error", str(E))
+
+    # KATARAGUI.syncValves: Reads back the valve states from the device in one command, updates the recorded states
+    #   and button colors that were wrong, and tells the user about them. Also called when a protocol starts.
+    # Inputs:
+    #       confirm - if True, also tell the user when every valve was in its expected state.
+    # Outputs: list of the valves whose state was wrong
+    def syncValves(self, confirm = False):
+        changed = self.device.sync()
+        for pin in changed:
+            KATARAGUI.btndict[pin].config(bg = "green" if self.device.pinStates[pin] else "gray")
+        if changed:
+            no_wait_Dialog(self.master, "Warning", "The states of valves " + ", ".join([str(p) for p in changed]) +
+                           " did not match the device. They have been updated to the device's states.")
+        elif confirm:
+            tkMessageBox.showinfo("Verify Valve States", "Every valve is in its expected state.")
+        return changed
+
+    # KATARAGUI.showMemoryReport: shows what the program is holding in memory (see MemoryReport). Called from the Tools
+    #   menu.
+    # Inputs: None
+    # Outputs: None
+    def showMemoryReport(self):
+        from MemoryReport import memoryReport, formatMemoryReport # loads tracemalloc, so not imported at startup
+        tkMessageBox.showinfo("Memory Report", formatMemoryReport(memoryReport()))
+
     # KATARAGUI.toggle: accepts location of pin toggle button in grid, toggles button color and pin High/low. This
     # is attached to button objects in KATARAGUI.drawButtonPanel
     # Inputs:
@@ -194,7 +315,14 @@ class KATARAGUI(usbGUI):
     #       row - the row in which the calling button has been placed in the button panel
     # Output: None
     def toggle(self, col, row):
-        pin = self.coordToPin(col, row)
+        self.togglePin(self.coordToPin(col, row))
+
+    # KATARAGUI.togglePin: toggles a pin high/low and colors its button. Buttons of added boards call this directly
+    # with their namespaced pin.
+    # Inputs:
+    #       pin - the pin to toggle, as keyed in btndict
+    # Output: None
+    def togglePin(self, pin):
         if not self.device or not self.device.isOpen():
             tkMessageBox.showerror("Error", "Not connected to arduino")
             return
@@ -214,25 +342,49 @@ class KATARAGUI(usbGUI):
                 pumpGUI.runningPump.pumpOff()
                 pumpsRunning = True
         try:
-            pinHigh = self.device._togglePin(pin)
-        except Warning as W:
-            tkMessageBox.showerror("Warning", W.message)
-            for pGUI in pumpGUI.instances:
-                valves = pGUI.pump.valves
-                pGUI.pump = self.device.specifyPump(int(valves[0]), int(valves[1]), int(valves[2]))
-            pinHigh = self.device.pinStates[pin]
-        except IOError as E:
-            tkMessageBox.showerror("Error", E.message)
-            return
+            if self.device.coalescer: # merged with other clicks; the button shows the state asked for at once
+                pinHigh, update = self.device.togglePinLater(pin)
+                self.master.after(10, self.checkToggle, pin, update)
+            else:
+                pinHigh = self.device._togglePin(pin)
         except Exception as E:
-            print(E.message)
-            tkMessageBox.showerror("Error", E.message)
-            return
+            if not self.toggleFailed(E):
+                return
+            pinHigh = self.device.pinStates[pin]
 
         if pinHigh or pumpsRunning:
-            self.btn[col][row].config(bg="green")
+            KATARAGUI.btndict[pin].config(bg="green")
         else:  # valve open and green, toggle to closed and gray
-            self.btn[col][row].config(bg="gray")
+            KATARAGUI.btndict[pin].config(bg="gray")
+
+    # KATARAGUI.checkToggle: waits, without blocking the GUI, for a toggle sent through the device's coalescer to be
+    # acknowledged, and reports it if it failed.
+    # Inputs:
+    #       pin - the pin toggled
+    #       update - the PinUpdate of the toggle
+    # Output: None
+    def checkToggle(self, pin, update):
+        if not update.done():
+            self.master.after(10, self.checkToggle, pin, update)
+        elif update.error and self.toggleFailed(update.error):
+            KATARAGUI.btndict[pin].config(bg="green" if self.device.pinStates[pin] else "gray")
+
+    # KATARAGUI.toggleFailed: tells the user that toggling a pin raised an error. A Warning means the connection was
+    # lost and restored, so the pumps are specified again on the new connection.
+    # Input:
+    #       E - the error
+    # Output: True if the pin states were restored despite the error, False if the toggle failed.
+    def toggleFailed(self, E):
+        if isinstance(E, Warning):
+            tkMessageBox.showerror("Warning", str(E))
+            for pGUI in pumpGUI.instances:
+                valves = pGUI.pump.valveKeys
+                pGUI.pump = self.device.specifyPump(valves[0], valves[1], valves[2])
+            return True
+        if not isinstance(E, IOError):
+            print(str(E))
+        tkMessageBox.showerror("Error", str(E))
+        return False
 
     #KATARAGUI.addPump: Add (draw) a pump control module to the KATARAGUI pump panel
     # Inputs: None
@@ -248,7 +400,9 @@ class KATARAGUI(usbGUI):
         try:
             valves = []
             for v in self.valveEntries:
-                vn = int(v.get())
+                vn = v.get().strip()
+                if ':' not in vn: # namespaced pins such as B:12 address added boards
+                    vn = int(vn)
                 self.device._checkPin(vn)
                 valves.append(vn)
 
@@ -295,8 +449,8 @@ class KATARAGUI(usbGUI):
 
 #this class implements pump controlling GUI modules
 class pumpGUI:
-    names = []
-    instances = []
+    names = weakref.WeakValueDictionary() # pump interfaces by name; entries go away with their interfaces
+    instances = weakref.WeakSet()
     panelPumps = []  # keep track of references to pumps displayed in main window. Pumps displayed in new windows
     runningPump = None
 
@@ -318,8 +472,8 @@ class pumpGUI:
         self.running = False
 
         # Keep track of all pumpGUI objects created.
-        pumpGUI.names.append(name)
-        pumpGUI.instances.append(self)
+        pumpGUI.names[name] = self
+        pumpGUI.instances.add(self)
 
         self.ctlr = _ctlr
         self.pump = self.ctlr.specifyPump(_v1, _v2, _v3) #reference to peristalsic pump object
@@ -389,6 +543,11 @@ class pumpGUI:
                 runningPump.pumpOff()
                 if runningPump is self:
                     return
+        try: # protocols started while the pump runs may use every other valve
+            RoutineThread.valveLocks.acquire(self, self.pump.valveKeys, "pump " + self.name)
+        except ValueError as E:
+            tkMessageBox.showerror("Error", str(E))
+            return
         try:
             if self.reverse.get():
                 self.pump.reverse(int(self.rate.get()), int(self.cycles.get()))
@@ -403,23 +562,25 @@ class pumpGUI:
                     self.pump.forward(int(self.rate.get()), int(self.cycles.get()))
             except Exception as E:
                 tkMessageBox.showerror(E.message)
+                RoutineThread.valveLocks.release(self)
                 return
         except IOError as E:
             print("IOError")
             tkMessageBox.showerror("Error", E.message)
+            RoutineThread.valveLocks.release(self)
             return
         except Exception as E:
             print("Exception")
             tkMessageBox.showerror("Error", E.message)
+            RoutineThread.valveLocks.release(self)
             return
         self.running = True
         pumpGUI.runningPump = self
         self.changeValveColor("Blue")
         self.startButton.config(text="Stop",bg="red")
-        for v in self.pump.valves:
+        for v in self.pump.valveKeys:
             self.ctlr.pinStates[v]=0 # The KATARA firmware automatically de-energizes valves after pumping, so this
                     # line this line ensures our accounting be in order after the pump sequence ends.
-        Protocol.holdFlag = True
         if self.cycles.get() != "-1":
             self.offtimer = Timer(float(self.cycles.get()) / float(self.rate.get()), self.pumpOff)
             self.offtimer.setDaemon(True)
@@ -430,8 +591,8 @@ class pumpGUI:
     #       color - the color to which to change the toggle buttons.
     #   Output: None
     def changeValveColor(self, color):
-        for v in self.pump.valves:
-            btn = KATARAGUI.btndict[int(v)]
+        for v in self.pump.valveKeys:
+            btn = KATARAGUI.btndict[v]
             btn.config(bg=color)
 
     # pumpGUI.pumpOff: resets the GUI after a pumping sequence.
@@ -442,7 +603,7 @@ class pumpGUI:
         self.changeValveColor("gray")
         self.running = False
         pumpGUI.runningPump = None
-        Protocol.holdFlag = False
+        RoutineThread.valveLocks.release(self)
 
 
     # pumpGUI.remove: Attached to the "Delete" button on a pump interface- allows user to delete a the pump interface.
@@ -452,8 +613,8 @@ class pumpGUI:
         if self.running:
             tkMessageBox.showerror("Error", "You can't delete a pump while it is running.")
             return
-        pumpGUI.names.remove(self.name)
-        pumpGUI.instances.remove(self)
+        pumpGUI.names.pop(self.name, None)
+        pumpGUI.instances.discard(self)
         if not self.winPump:
             pumpGUI.panelPumps.remove(self)
             self.pumpFrame.grid_forget()
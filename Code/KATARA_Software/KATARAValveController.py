@@ -9,23 +9,33 @@
 #THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 
+from collections import deque
 from ValveController import *
+from ValveTrace import PUMP_FORWARD, PUMP_REVERSE, PUMP_STOP
 
 # The KATARAValveController class provides an interface to communicate with an arduino mega running the KATARA firmware.
 class KATARAValveController(ValveController):
     deviceType = "Arduino Mega"
+    resetDelay = 1 # seconds the Arduino takes to reset after the serial port is opened
+    byteTime = 10.0/9600 # seconds to transfer a character at the firmware's 9600 baud
+    maxCommandFrame = 200 # longest command, in characters with its 'c'; the firmware reserves 200 for a frame
+    maxRepeatFrame = maxCommandFrame # longest repeat command sent to the firmware (see runRepeat)
+    maxStreamFrame = maxCommandFrame # longest stream data command (see playWaveform)
+    streamGap = 30000 # most ticks between stream frames, so that the firmware's 16 bit stamps stay unambiguous
 
     #KATARAValveController.__init__: Connects by calling base class constructor, sets up dictionary to keep track of pin
     #       states which also denotes available pins.
     #   Input:
     #       port - the string name of the serial port to connect to.
-    def __init__(self, port):
-        ValveController.__init__(self, port)
+    #       reset - False to connect without resetting the Arduino (see ValveController.openSerial)
+    def __init__(self, port, reset = True):
+        ValveController.__init__(self, port, reset)
         self.port = port
         for p in range(2,70):
             self.pinStates[p]=0
         # specify KATARAPumps
         self.pump = KATARAPump
+        self.repeatEnds = 0 # clock time at which the repeat program running on the board ends
 
     # KATARAValveController.setPins: sets a tuple, list, or set of pins to the corresopnding state in the tuple
     # or list of states.
@@ -43,14 +53,48 @@ class KATARAValveController(ValveController):
         if len(pins) != len(states):
             raise ValueError("The length of the pins and states entries must be the same.")
 
-        message = "2" #2 is the case for writing multiple pins in the arduino firmware switch/case structure
+        encoded = []
         for pinNum in range(len(pins)):
-            message += self._handleSetPinsInput(pins[pinNum], states[pinNum])
-        self._write(message)
-        response = self.ser.readline()
-        print(response)
+            encoded.append(self._handleSetPinsInput(pins[pinNum], states[pinNum]))
+        with self.serLock:
+            start = clock()
+            # if writing a chunk fails, _recover drops the staged pins and sends the whole command again
+            resend = lambda: self._sendPins(encoded, lambda out: self._serialWrite(out + 'c'))
+            response = self._sendPins(encoded, lambda out: self._write(out, resend))
+            self.metrics.recordRoundTrip('2', clock() - start)
+            self._recordTransition()
+        if config.debugSerial:
+            print(response)
         return response
 
+    # KATARAValveController._sendPins: Sends a set pins command, split into chunks if it is longer than maxCommandFrame
+    #   (68 pins take 206 characters): every chunk but the last is staged with an 8 command, which the firmware
+    #   acknowledges with the number of pins it has staged, and the last is sent as the usual 2 command, on which the
+    #   firmware sets the staged pins and its own together. The caller holds the serial lock.
+    # Inputs:
+    #       encoded - list of encoded pins, see _encodePin
+    #       write - function that sends a command given without its terminating 'c'
+    # Outputs: the reply to the set pins command. Raises an IOError if a chunk is not acknowledged, after telling the
+    #   firmware to drop the staged pins.
+    def _sendPins(self, encoded, write):
+        perChunk = (self.maxCommandFrame - 2)//3
+        nChunks = max(1, -(-len(encoded)//perChunk))
+        size = -(-len(encoded)//nChunks) # as even as possible
+        chunks = ["".join(encoded[k:k + size]) for k in range(0, len(encoded), size)] or [""]
+        # the reply to the 2 command starts with its echo, so a long command takes twice its length to answer
+        self.ser.timeout = 0.1 + 2*(len(chunks[0]) + 2)*self.byteTime
+        try:
+            for staged, chunk in enumerate(chunks[:-1], 1):
+                write("8" + chunk) #8 stages a chunk of pins in the firmware
+                if self._serialReadline().strip() != "Staged%d" % (staged*size):
+                    write("8")
+                    self._serialReadline()
+                    raise IOError("The device did not acknowledge a chunk of a set pins command.")
+            write("2" + chunks[-1]) #2 sets the staged pins and these together
+            return self._serialReadline()
+        finally:
+            self.ser.timeout = 0.1
+
     # KATARAValveController._handleSetPinsInput: A helper method to setPins. It verifies the input is valid, throws an
     #           error if it is not, and processes the input to prepare it for writing as a serial command.
     # Inputs:
@@ -63,6 +107,14 @@ class KATARAValveController(ValveController):
         if state not in (0, 1):
             raise ValueError("Pin " + str(pin) + " must be set to either 0 or 1.")
         self.pinStates[pin] = state
+        return self._encodePin(pin, state)
+
+    # KATARAValveController._encodePin: Encodes a pin and state for a set pins command.
+    # Inputs:
+    #       pin - number of a pin to set
+    #       state - the state to set the pin to
+    # Output: A three character string with the pin number in the first two characters and the state in the third.
+    def _encodePin(self, pin, state):
         if pin < 10:
             pin = '0' + str(int(pin))
         else:
@@ -75,9 +127,12 @@ class KATARAValveController(ValveController):
     # Outputs: None
     def testConnection(self):
         self.ser.timeout  = 1
-        time.sleep(1) # wait after initializing connection to arduino to give it time to reset.
-        self.ser.write("1c")
-        response = self.ser.readline()
+        if self.resetOnOpen:
+            time.sleep(self.resetDelay) # wait after initializing connection to arduino to give it time to reset.
+        start = clock()
+        self._serialWrite("1c")
+        response = self._serialReadline()
+        self.metrics.recordRoundTrip('1', clock() - start)
         self.ser.timeout = 0.1 # tell the serial object to time out and throw an error if the Arduino takes longer than
                                # 0.1 seconds to respond to a serial command.
         print(response)
@@ -97,33 +152,308 @@ class KATARAValveController(ValveController):
     # KATARAValveController._write: This method sends all serial messages and handles IO errors.
     # Inputs:
     #       out - serial message to send (string)
+    #       retry - function that redoes the whole operation the message belongs to after the connection has been
+    #               restored, e.g. all chunks of a set pins command; None to resend just the message (see _recover)
     # Outputs: None
-    def _write(self, out):
+    def _write(self, out, retry = None):
         try:
-            print("Writing")
-            self.ser.write(str(out))
-            self.ser.write('c')
-            print("Sent:", str(out) + "c")
+            self._serialWrite(str(out) + 'c')
+            if config.debugSerial:
+                print("Sent:", str(out) + "c")
         except Exception as E:
             print("Error:")
-            print(E.message)
+            print(str(E))
+            self._recover(retry or str(out) + 'c')
+
+    # KATARAValveController._recover: Called, with the serial lock held, when writing a command fails. Reopens the
+    #   connection, drops any pins the firmware has staged for a set pins command, rebuilds the state of every pin
+    #   with a single set pins command, confirms it with one readback, and then resends the failed command and reads
+    #   its reply. The time taken is recorded in the metrics.
+    # Inputs:
+    #       out - the command that failed, including its terminating 'c', or a function that redoes the whole
+    #               operation it belongs to
+    # Outputs: None, but raises an IOError if the connection cannot be restored, or a Warning once it has been.
+    def _recover(self, out):
+        start = clock()
+        self.ser.close()
+        try:
+            self.resetOnOpen = True
+            self.ser = self.openSerial(self.port, 1)
+            self.metrics.recordReconnect()
+            self.testConnection()
+            self._serialWrite("8c") # a bare 8 drops the staged pins, which the next 2 command would otherwise set
+            self._serialReadline()
+            self._restoreState()
+            if self.verify():
+                raise IOError("The device did not confirm the restored valve states.")
+            self.metrics.recordRetry()
+            if callable(out):
+                out()
+            else:
+                self._serialWrite(out)
+                self._serialReadline()
+        except Exception as E:
+            print(str(E))
             self.ser.close()
+            raise IOError(
+                "The connection to the arduino was lost. Check to make sure it is still plugged in and reconnect.")
+        finally:
+            self.metrics.recordRecovery(clock() - start)
+        raise Warning("There was a problem in the connection. The connection has been reset and the valve states have been restored.")
+
+    # KATARAValveController._restoreState: Sets every pin to its state in self.pinStates with one set pins command, sent
+    #   in chunks (see _sendPins).
+    # Inputs: None
+    # Outputs: None
+    def _restoreState(self):
+        encoded = [self._encodePin(pin, self.pinStates[pin]) for pin in sorted(self.pinStates)]
+        start = clock()
+        self._sendPins(encoded, lambda out: self._serialWrite(out + 'c'))
+        self.metrics.recordRoundTrip('2', clock() - start)
+
+    # KATARAValveController.releasePort: Closes the serial port so that another process can open it (see
+    #   ProcessExecutor). The controller must not send commands until reclaimPort is called.
+    # Inputs: None
+    # Outputs: None
+    def releasePort(self):
+        with self.serLock:
+            self.ser.close()
+
+    # KATARAValveController.reclaimPort: Reopens the serial port after releasePort, without resetting the Arduino, and
+    #   sends the state every pin was left in, with one set pins command, so that the board matches it.
+    # Inputs:
+    #       pinStates - dictionary of the state of each pin
+    # Outputs: None, but raises an IOError if the device does not answer.
+    def reclaimPort(self, pinStates):
+        with self.serLock:
+            self.resetOnOpen = False
+            self.ser = self.openSerial(self.port, 1, False)
+            self.testConnection()
+            self.pinStates.update(pinStates)
+            self._restoreState()
+
+    # KATARAValveController.encodeRepeat: Encodes actions (see ValveController.runRepeat) as the body of the firmware's
+    #   repeat command: SnnPPS... sets nn pins, WMMMMMMMM waits milliseconds and PdVVVVVVVVVRRRCCCCCC starts a pump.
+    # Inputs:
+    #       actions - list of actions
+    # Outputs: the body, or None if an action cannot be encoded or the command would be too long.
+    def encodeRepeat(self, actions):
+        body = ""
+        for action in actions:
+            if action[0] == "pins":
+                pins, states = action[1], action[2]
+                if len(pins) > 99 or [p for p in pins if p not in self.pinStates] or \
+                        [s for s in states if s not in (0, 1)]:
+                    return None
+                body += "S%02d" % len(pins) + "".join([self._encodePin(p, s) for p, s in zip(pins, states)])
+            elif action[0] == "pause":
+                milliseconds = int(round(action[1]*1000))
+                if not 0 <= milliseconds <= 99999999:
+                    return None
+                body += "W%08d" % milliseconds
+            elif action[0] == "pump":
+                direction, valves, rate, cycles = action[1:]
+                if [v for v in valves if v not in self.pinStates] or not 1 <= rate <= 999 or not 1 <= cycles <= 999999:
+                    return None
+                body += "P" + direction + "".join(["%03d" % v for v in valves]) + "%03d%06d" % (rate, cycles)
+            else:
+                return None
+        if len(body) + 8 > self.maxRepeatFrame:
+            return None
+        return body
+
+    # KATARAValveController.runRepeat: Sends actions to the firmware as one repeat command, which runs them count
+    #   times on the board. Only one program runs on the board at a time, so this returns None while another is
+    #   running. The recorded pin states are set to the states the program leaves the pins in.
+    # Inputs:
+    #       actions - list of actions, see ValveController.runRepeat
+    #       count - number of times to run the actions, 1-999999
+    # Outputs: the number of seconds the board will take, or None if it cannot run the actions now. Actions without a
+    #   pause of at least a millisecond are not sent, since the board would run every pass at once.
+    def runRepeat(self, actions, count):
+        body = self.encodeRepeat(actions)
+        milliseconds = sum([int(round(a[1]*1000)) for a in actions if a[0] == "pause"])
+        if body is None or not 1 <= count <= 999999 or milliseconds == 0:
+            return None
+        duration = count*milliseconds*1e-3 # whole milliseconds
+        with self.serLock:
+            if clock() < self.repeatEnds:
+                return None
+            self.ser.timeout = 1 # a long command and its echo take a few tenths of a second at 9600 baud
+            start = clock()
             try:
-                self.ser = serial.Serial(self.port, timeout=1)
-                for pump in ValveController.pPumps:
-                    pump.ser = self.ser
-                self.testConnection()
+                self._write("6%06d" % count + body)
+                self._serialReadline()
+            finally:
                 self.ser.timeout = 0.1
-            except Exception as E:
-                print(E.message)
-                self.ser.close()
-                raise IOError(
-                    "The connection to the arduino was lost. Check to make sure it is still plugged in and reconnect.")
-            for pin in self.pinStates:
-                if self.pinStates[pin]:
-                    self.setPin(pin, 1)
-            self.ser.write(str(out) + "c")
-            raise Warning("There was a problem in the connection. The connection has been reset and the valve states have been restored.")
+            self.metrics.recordRoundTrip('6', clock() - start)
+            self.repeatEnds = start + duration
+            for action in actions:
+                if action[0] == "pins":
+                    for pin, state in zip(action[1], action[2]):
+                        self.pinStates[pin] = state
+                elif action[0] == "pump": # the firmware returns the valves to 0 when a pump ends
+                    for valve in action[2]:
+                        self.pinStates[valve] = 0
+            self._recordTransition()
+        return duration
+
+    # KATARAValveController.stopRepeat: Stops the repeat program running on the board. Pumps it started keep running;
+    #   stop them with their pump objects.
+    # Inputs: None
+    # Outputs: None
+    def stopRepeat(self):
+        with self.serLock:
+            self._write("6000000")
+            self._serialReadline()
+            self.repeatEnds = 0
+
+    # KATARAValveController.playWaveform: Streams a waveform to the firmware's stream buffer (see the firmware's 7
+    #   commands) and plays it on the board's timer. The buffer is filled before the board starts; after that frames are
+    #   sent as the board returns credits for the ones it has played, so the buffer never overflows and, as long as the
+    #   serial line keeps up, every frame is applied at its tick. Frames that arrive too late are applied at the next
+    #   tick and counted. The serial lock is held for the whole waveform. The recorded pin states are set to the last
+    #   frame's states when the waveform ends.
+    # Inputs:
+    #       pins - list of up to 32 pins the waveform drives
+    #       tick - seconds per tick, 0.0005-0.26
+    #       frames - iterable of (tick, states), see ValveController.playWaveform. Frames may be generated as the
+    #           waveform plays.
+    #       timeout - seconds to wait for the board beyond the time its next message is due
+    # Outputs: dictionary with the frames 'sent', 'played', 'late' and dropped ('overflows'), the 'seconds' the
+    #   waveform took and the 'waits' for credits. Raises a ValueError for invalid input and an IOError if the board
+    #   does not answer, after stopping the stream.
+    def playWaveform(self, pins, tick, frames, timeout = 1):
+        if not 0 < len(pins) <= 32 or len(set(pins)) < len(pins):
+            raise ValueError("A waveform drives 1-32 distinct pins.")
+        for pin in pins:
+            self._checkPin(pin)
+        micros = int(round(tick*1e6))
+        if not 500 <= micros <= 262140:
+            raise ValueError("The tick must be 0.0005-0.26 seconds.")
+        width = 4 + (len(pins) + 3)//4 # characters per frame
+        perCommand = (self.maxStreamFrame - 3)//width
+        stats = {'sent': 0, 'played': 0, 'late': 0, 'overflows': 0, 'seconds': 0, 'waits': 0}
+        with self.serLock:
+            self._serialWrite("7S%06d%02d" % (micros, len(pins)) + "".join(["%02d" % p for p in pins]) + 'c')
+            reply = self._serialReadline().strip()
+            if not reply.startswith("Stream"):
+                raise IOError("The device did not start a stream. Make sure it runs the latest KATARA firmware.")
+            credits = int(reply[6:])
+            inFlight = deque() # ticks of the frames sent and not yet played
+            state = {'start': None, 'capacity': credits}
+            batch = []
+            try:
+                states = [self.pinStates[p] for p in pins]
+                for stamp, states in self._streamFrames(frames, states):
+                    while not credits:
+                        if batch:
+                            self._serialWrite("7D" + "".join(batch) + 'c', len(batch))
+                            batch = []
+                        if state['start'] is None:
+                            self._startStream(state)
+                        stats['waits'] += 1
+                        returned = self._awaitStream(state, stats, inFlight, tick, timeout)
+                        if returned is None:
+                            raise IOError("The device ended the stream early.")
+                        credits += returned
+                    batch.append("%04X%0*X" % (stamp & 0xFFFF, width - 4, sum([s << k for k, s in enumerate(states)])))
+                    inFlight.append(stamp)
+                    credits -= 1
+                    stats['sent'] += 1
+                    if len(batch) == perCommand:
+                        self._serialWrite("7D" + "".join(batch) + 'c', len(batch))
+                        batch = []
+                if batch:
+                    self._serialWrite("7D" + "".join(batch) + 'c', len(batch))
+                if state['start'] is None:
+                    self._startStream(state)
+                self._serialWrite("7Ec")
+                while self._awaitStream(state, stats, inFlight, tick, timeout, True) is not None:
+                    pass
+            except BaseException:
+                self._serialWrite("7Xc")
+                while self._serialReadline().strip()[:2] not in ("7F", ""):
+                    pass
+                self.sync()
+                raise
+            stats['seconds'] = clock() - state['start']
+            for pin, s in zip(pins, states):
+                self.pinStates[pin] = s
+            self._recordTransition()
+        return stats
+
+    # KATARAValveController._streamFrames: checks the frames of a waveform and adds a frame repeating the previous
+    #   states wherever frames would otherwise be more than streamGap ticks apart.
+    # Inputs:
+    #       frames - iterable of (tick, states)
+    #       states - the pin states before the waveform
+    # Outputs: generator of (tick, states)
+    def _streamFrames(self, frames, states):
+        last = None
+        for stamp, nextStates in frames:
+            stamp = int(stamp)
+            if stamp < 0 or (last is not None and stamp <= last):
+                raise ValueError("Waveform frames must have increasing ticks from 0.")
+            if len(nextStates) != len(states) or [s for s in nextStates if s not in (0, 1)]:
+                raise ValueError("Each waveform frame needs a 0 or 1 state per pin.")
+            while stamp - (last or 0) > self.streamGap:
+                last = (last or 0) + self.streamGap
+                yield last, states
+            last, states = stamp, list(nextStates)
+            yield stamp, states
+
+    # KATARAValveController._startStream: starts the board playing the stream at tick 0.
+    def _startStream(self, state):
+        self._serialWrite("7Rc")
+        state['start'] = clock()
+
+    # KATARAValveController._awaitStream: reads the board's next stream message.
+    # Inputs:
+    #       state - dictionary holding the clock time the stream started and the capacity of the board's buffer
+    #       stats - statistics of the run, updated with the board's counts
+    #       inFlight - ticks of the frames not yet played; the ones the board has returned credits for are removed
+    #       tick - seconds per tick
+    #       timeout - seconds to wait beyond the time the message is due
+    #       ending - True once the stream has been told to end: the board's next message is due when its last frame
+    #           plays rather than when a quarter of its buffer has played
+    # Outputs: the number of credits returned, or None once the stream has ended. Raises an IOError if the board does
+    #   not answer in time.
+    def _awaitStream(self, state, stats, inFlight, tick, timeout, ending = False):
+        due = 0
+        if inFlight:
+            due = inFlight[-1] if ending else inFlight[min(len(inFlight), state['capacity']//4) - 1]
+        deadline = state['start'] + due*tick + timeout
+        while True:
+            line = self._serialReadline().strip()
+            if line.startswith("7C"):
+                credits, stats['late'] = [int(n) for n in line[2:].split()]
+                for k in range(min(credits, len(inFlight))):
+                    inFlight.popleft()
+                return credits
+            if line.startswith("7F"):
+                stats['played'], stats['late'], stats['overflows'] = [int(n) for n in line[2:].split()]
+                return None
+            if clock() > deadline:
+                raise IOError("The device stopped answering while streaming a waveform.")
+
+    # KATARAValveController.readPins: Reads back the output state of every pin with the firmware's readback command:
+    #   '4', answered with 17 hex digits holding pins 69-2, most significant first.
+    # Inputs: None
+    # Outputs: integer bit mask as returned by pinMask; bit n is set if pin n is high.
+    def readPins(self):
+        with self.serLock:
+            start = clock()
+            self._write("4")
+            response = self._serialReadline()
+            self.metrics.recordRoundTrip('4', clock() - start)
+        digits = response.strip()[1:] # after the echoed opcode
+        try:
+            if len(digits) != 17:
+                raise ValueError(digits)
+            return int(digits, 16) << 2
+        except ValueError:
+            raise IOError("The device did not report its pin states. Make sure it runs the latest KATARA firmware.")
 
 
 # KATARAPump derived peristalticPump for sending USB signals to to the KATARA shield instructing it to run peristaltic
@@ -150,45 +480,39 @@ class KATARAPump(perstalticPump):
         toWrite += '0' * (3 - len(rate)) + rate  # rate is a three character string
         cycles = str(cycles)
         toWrite += '0' * (6 - len(cycles)) + cycles  # time is a four character string
-        try:
-            self.ctlr.ser.write(toWrite + 'c')
-        except Exception as E:
-            self.ctlr.ser.close()
-            try:
-                self.ctlr.ser = serial.Serial(self.ctlr.port, timeout=1)
-                self.ctlr.testConnection()
-                self.ctlr.ser.timeout = 0.1
-                for pump in ValveController.pPumps:
-                    pump.ser = self.ctlr.ser
-            except Exception as E:
-                print(E.message)
-                self.ctlr.ser.close()
-                raise IOError(
-                    "The connection to the arduino was lost. Check to make sure it is still plugged in and reconnect.")
-            for pin in self.ctlr.pinStates:
-                if self.ctlr.pinStates[pin]:
-                    self.ctlr.setPin(pin, 1)
-            self.ctlr.ser.write(toWrite + 'c')
-            raise Warning(
-                "There was a problem in the connection. The connection has been reset and the valve states have been restored.")
-
-        for valve in self.valves:
-            self.ctlr.pinStates[int(valve)] = 0
+        with self.ctlr.serLock:
+            self._sendPumpCommand(toWrite)
+            for valve in self.valves:
+                self.ctlr.pinStates[int(valve)] = 0
+            self.ctlr._recordTransition(PUMP_REVERSE if direction == 'r' else PUMP_FORWARD,
+                                        [int(v) for v in self.valves],
+                                        float('Inf') if int(cycles) == -1 else float(cycles)/float(rate))
         if wait: #pause thread until pump cycle is complete
             time.sleep(float(cycles)/float(rate))
-        self.ctlr.ser.readline()
 
-        ret = '1'
-        while ret:
-            try:
-                ret = self.ctlr.ser.readline()
-                print(ret)
-            except:
-                break
+    # KATARAPump._sendPumpCommand: helper to _runPump; writes the pump command and reads the firmware's reply, the
+    #           echoed command followed by "Pump". The caller holds the controller's serial lock.
+    # Inputs:
+    #       toWrite - the pump command, without its terminating 'c'.
+    # Outputs: None, but raises an IOError if the device does not acknowledge the command.
+    def _sendPumpCommand(self, toWrite):
+        start = clock()
+        try:
+            self.ctlr._serialWrite(toWrite + 'c')
+        except Exception:
+            self.ctlr._recover(toWrite + 'c') # raises an IOError, or a Warning once the connection is restored
+
+        reply = self.ctlr._serialReadline().strip()
+        self.ctlr.metrics.recordRoundTrip('3', clock() - start)
+        if not reply.endswith("Pump"):
+            raise IOError("The device did not acknowledge the pump command.")
 
-    # KATARAPump.stop: Sends a serial signal to stop a pumping sequence before completing all indicated cycles
+    # KATARAPump.stop: Sends a serial signal to stop this pump before completing all indicated cycles. Other pumps
+    #   keep running, so protocols running at the same time can stop their own pumps.
     #   Input: None
     #   Output: None
     def stop(self):
-        self.ctlr.ser.write("c")
-        self.ctlr.ser.readline()
\ No newline at end of file
+        with self.ctlr.serLock:
+            self.ctlr._serialWrite("5" + "".join(self.valves) + "c")
+            self.ctlr._recordTransition(PUMP_STOP, [int(v) for v in self.valves])
+            self.ctlr._serialReadline()
\ No newline at end of file
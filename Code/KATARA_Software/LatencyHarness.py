@@ -0,0 +1,343 @@
+#MIT License
+#
+#Copyright (c) 2017 Jonathan A. White
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+
+import sys
+import os
+import json
+import time
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+try:
+    from Tkinter import * #python 2.7
+except:
+    from tkinter import * #python 3
+import config
+from SerialMetrics import clock
+from FirmwareEmulator import FirmwareEmulator
+
+# LatencyHarness measures end to end latency: the time from a protocol step starting to the emulated device (see
+# FirmwareEmulator) actually changing the step's first pin, and how far step start times drift from the protocol's
+# schedule. Protocols run either through the GUI (KATARAGUI and Protocol, as when the user presses "Run Protocol"),
+# headless, straight through the controller API, or as one repeat command that the device runs by itself (see
+# Loop.compileRepeat); the bytes sent are reported for each. Each configuration sets the baud rate, the serial frame
+# format and, for the GUI path, a background GUI load. The GUI path runs loops step by step.
+#
+# Usage: python LatencyHarness.py [--out latency.json] [--protocols names] [--paths gui headless repeat]
+# The GUI path needs Tk and so a display (or xvfb-run); without one those configurations are reported as skipped.
+
+# Representative protocols, in the format saved by Protocol.save (without its header). Entries must be literal values
+# rather than loop expressions so the headless path can run them.
+protocols = OrderedDict([
+    ("toggle", [["Loop", ["ValveStep", "PauseStep"], "40",
+                 ["ValveStep", "2", "1"], ["PauseStep", "0.02"], ["ValveStep", "2", "0"], ["PauseStep", "0.02"]]]),
+    ("manyValves", [["Loop", ["ValveStep", "PauseStep"], "20",
+                     ["ValveStep", ",".join([str(p) for p in range(2, 18)]), "1"], ["PauseStep", "0.03"],
+                     ["ValveStep", ",".join([str(p) for p in range(2, 18)]), "0"], ["PauseStep", "0.03"]]]),
+    ("allValves", [["Loop", ["ValveStep", "ValveStep"], "10", # set pins commands long enough to be sent in chunks
+                    ["ValveStep", ",".join([str(p) for p in range(2, 70)]), "1"],
+                    ["ValveStep", ",".join([str(p) for p in range(2, 70)]), "0"]]]),
+    ("pump", [["Loop", ["PumpStep", "ValveStep"], "5",
+               ["PumpStep", "20", "4", "20", "21", "22"], ["ValveStep", "30", "1"], ["ValveStep", "30", "0"]]]),
+])
+
+# Configurations: name, baud rate, bits per byte (10 for 8N1, 11 for 8E1 or 8N2), GUI load (updates per second).
+configurations = (("9600 8N1", 9600, 10, 0), ("9600 8E1", 9600, 11, 0), ("115200 8N1", 115200, 10, 0),
+                  ("9600 8N1 busy GUI", 9600, 10, 100))
+
+
+# planSteps: expands the loops of a saved protocol into the sequence of steps it runs.
+#   Input:
+#       saved - saved protocol list
+#   Output: list of dictionaries with the step's 'type', the 'pins' and 'states' it sets first (empty for pauses), and
+#       its scheduled 'duration' in seconds
+def planSteps(saved):
+    plan = []
+    for item in saved:
+        if item[0] == "Loop":
+            plan += planSteps(item[3:])*int(item[2])
+        elif item[0] == "ValveStep":
+            pins = [int(v) for v in item[1].split(',')]
+            states = [int(s) for s in item[2].split(',')]
+            plan.append({'type': "ValveStep", 'pins': pins, 'states': states*len(pins) if len(states) == 1 else states,
+                         'duration': 0.0})
+        elif item[0] == "PauseStep":
+            plan.append({'type': "PauseStep", 'pins': [], 'states': [], 'duration': float(item[1])})
+        elif item[0] == "PumpStep":
+            rate, cycles, valves = int(item[1]), int(item[2]), [int(v) for v in item[3:6]]
+            plan.append({'type': "PumpStep", 'pins': valves[:1], 'states': [1], 'rate': rate, 'cycles': cycles,
+                         'valves': valves, 'duration': float(cycles)/rate})
+        else:
+            raise ValueError("Error: " + str(item[0]) + " steps are not supported by the latency harness.")
+    return plan
+
+
+# runHeadless: runs a planned protocol straight through the controller API, as the steps' run methods would.
+#   Inputs:
+#       ctlr - the valve controller
+#       plan - list returned by planSteps
+#   Output: list of step start times
+def runHeadless(ctlr, plan):
+    starts = []
+    for step in plan:
+        starts.append(clock())
+        if step['type'] == "ValveStep":
+            ctlr.setPins(step['pins'], step['states'])
+        elif step['type'] == "PumpStep":
+            ctlr.specifyPump(*step['valves']).forward(step['rate'], step['cycles'])
+        if step['duration']:
+            time.sleep(step['duration'])
+    return starts
+
+
+# planRepeat: compiles a saved protocol that is one loop of valve, pause and pump steps into repeat command actions,
+#   as Loop.compileRepeat would.
+#   Input:
+#       saved - saved protocol list
+#   Output: (list of actions, number of repeats), see ValveController.runRepeat
+def planRepeat(saved):
+    if len(saved) != 1 or saved[0][0] != "Loop":
+        raise ValueError("Error: only protocols made of one loop can be repeated on the device.")
+    actions = []
+    for step in planSteps(saved[0][3:]):
+        if step['type'] == "ValveStep":
+            actions.append(("pins", step['pins'], step['states']))
+        elif step['type'] == "PumpStep":
+            actions.append(("pump", 'f', step['valves'], step['rate'], step['cycles']))
+        if step['duration']:
+            actions.append(("pause", step['duration']))
+    return actions, int(saved[0][2])
+
+
+# runRepeat: runs a saved protocol as one repeat command and waits for the device to finish it.
+#   Inputs:
+#       ctlr - the valve controller
+#       saved - saved protocol list
+#       plan - list returned by planSteps
+#   Output: list of step start times, as scheduled on the device from when the command was sent
+def runRepeat(ctlr, saved, plan):
+    actions, count = planRepeat(saved)
+    start = clock()
+    duration = ctlr.runRepeat(actions, count)
+    if duration is None:
+        raise ValueError("Error: the device cannot repeat this protocol.")
+    time.sleep(duration)
+    starts = []
+    for step in plan:
+        starts.append(start)
+        start += round(step['duration']*1000)*1e-3 # the firmware waits whole milliseconds
+    return starts
+
+
+# runGUI: runs a saved protocol through the KATARA GUI's protocol panel, with the protocol thread started the same way
+#   Protocol.run starts it, while the main thread runs the Tk event loop.
+#   Inputs:
+#       root - Tk root
+#       port - port of the emulated device
+#       saved - saved protocol list
+#       load - background GUI updates per second, 0 for none
+#   Output: list of step start times
+def runGUI(root, port, saved, load):
+    from KATARAGUI import KATARAGUI
+    from Protocol_Tools import Routine, RoutineThread, Loop
+    from StepDerivatives import ValveStep, PumpStep, PauseStep
+    starts = []
+    originals = {}
+    for stepClass in (ValveStep, PumpStep, PauseStep):
+        originals[stepClass] = stepClass.run
+        def run(step, *args, **kwargs):
+            starts.append(clock())
+            return originals[step.__class__](step, *args, **kwargs)
+        stepClass.run = run
+    window = None
+    Loop.repeatOnDevice = False # step start times are recorded by the steps' run methods
+    try:
+        window = Toplevel(root)
+        gui = KATARAGUI(window)
+        gui.connect(port)
+        gui.Protocol.load(saved)
+        gui.Protocol.saveEntries()
+        gui.Protocol.numberSteps()
+        thread = Routine.pRun = RoutineThread(Routine.run, gui.Protocol, threading.current_thread(),
+                                              timerWidget = Label(gui.Protocol.controlbox))
+        buttons = [b for k, b in gui.btndict.items() if k != "AvailablePinsStatement"][40:60]
+        def update(n = [0]):
+            n[0] += 1
+            for button in buttons: # recolor buttons the protocol does not use and relayout the window
+                button.config(bg = "green" if n[0] % 2 else "gray")
+            gui.canvas.configure(scrollregion = gui.canvas.bbox("all"))
+            if thread.is_alive():
+                root.after(int(1000/load), update)
+        if load:
+            root.after(0, update)
+        thread.start()
+        while thread.is_alive():
+            root.update()
+            time.sleep(0.001)
+        gui.device.close()
+    finally:
+        for stepClass, run in originals.items():
+            stepClass.run = run
+        Loop.repeatOnDevice = True
+        if window:
+            window.destroy()
+    return starts
+
+
+# percentile: returns the q'th percentile (0-100) of a list of values, None if it is empty.
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q/100.0*(len(values) - 1))))]
+
+
+# measureLatency: matches the steps of a run with the pin changes of the emulated device.
+#   Inputs:
+#       plan - list returned by planSteps
+#       starts - step start times
+#       timeline - emulator timeline in clock time (FirmwareEmulator.timeline(relative = False))
+#   Output: dictionary with the latency ('p50', 'p99', 'max', 'mean', seconds) from each step starting to its first pin
+#       reaching its new state, the number of steps measured ('samples') and missed ('missed'), and the schedule drift
+#       of step starts ('maxDrift', 'finalDrift', seconds later than planned relative to the first step)
+def measureLatency(plan, starts, timeline):
+    changes = {} # pin: ([times], [states])
+    for t, pin, state in timeline:
+        changes.setdefault(pin, ([], []))
+        changes[pin][0].append(t)
+        changes[pin][1].append(state)
+    latencies = []
+    missed = 0
+    drifts = []
+    planned = 0.0
+    for step, start in zip(plan, starts):
+        drifts.append((start - starts[0]) - planned)
+        planned += step['duration']
+        if not step['pins']:
+            continue
+        pin, state = step['pins'][0], step['states'][0]
+        times, states = changes.get(pin, ([], []))
+        k = bisect_left(times, start)
+        while k < len(times) and states[k] != state:
+            k += 1
+        if k < len(times):
+            latencies.append(times[k] - start)
+        else:
+            missed += 1
+    return OrderedDict([("samples", len(latencies)), ("missed", missed + len(plan) - len(starts)),
+                        ("p50", percentile(latencies, 50)), ("p99", percentile(latencies, 99)),
+                        ("max", max(latencies) if latencies else None),
+                        ("mean", sum(latencies)/len(latencies) if latencies else None),
+                        ("maxDrift", max(drifts, key = abs) if drifts else None),
+                        ("finalDrift", drifts[-1] if drifts else None)])
+
+
+# runHarness: runs every protocol in every configuration and path.
+#   Inputs:
+#       protocolNames - names of the protocols to run, None for all
+#       paths - "gui", "headless" and/or "repeat"
+#       configs - configurations to run, as in the configurations tuple
+#   Output: results dictionary, as saved to JSON
+def runHarness(protocolNames = None, paths = ("headless", "repeat", "gui"), configs = configurations):
+    from KATARAValveController import KATARAValveController
+    root = None
+    tkError = None
+    if "gui" in paths:
+        try:
+            root = Tk()
+            root.withdraw()
+            config.root = root
+        except TclError as E:
+            tkError = str(E)
+    metricsFile, traceDirectory = config.metricsFile, config.traceDirectory
+    config.metricsFile, config.traceDirectory = None, None
+    stdout = sys.stdout
+    devnull = open(os.devnull, 'w')
+    results = []
+    try:
+        for name, baud, bitsPerByte, load in configs:
+            for path in paths:
+                if path != "gui" and load:
+                    continue # GUI load only applies to the GUI path
+                for protocolName, saved in protocols.items():
+                    if protocolNames and protocolName not in protocolNames:
+                        continue
+                    result = OrderedDict([("configuration", name), ("path", path), ("protocol", protocolName),
+                                          ("baud", baud), ("bitsPerByte", bitsPerByte), ("guiLoad", load)])
+                    if path == "gui" and not root:
+                        result["skipped"] = "Tk is not available: " + tkError
+                        results.append(result)
+                        continue
+                    plan = planSteps(saved)
+                    emulator = FirmwareEmulator(baud, bitsPerByte)
+                    sys.stdout = devnull # the controllers print their serial traffic
+                    try:
+                        if path == "gui":
+                            starts = runGUI(root, emulator.port, saved, load)
+                        else:
+                            ctlr = KATARAValveController(emulator.port)
+                            try:
+                                sent = ctlr.metrics.snapshot()['bytesWritten']
+                                starts = runHeadless(ctlr, plan) if path == "headless" else runRepeat(ctlr, saved, plan)
+                                result["bytesSent"] = ctlr.metrics.snapshot()['bytesWritten'] - sent
+                            finally:
+                                ctlr.close()
+                        time.sleep(0.1) # let the last replies and pin changes arrive
+                        result.update(measureLatency(plan, starts, emulator.timeline(relative = False)))
+                    except Exception as E:
+                        result["error"] = str(E)
+                    finally:
+                        sys.stdout = stdout
+                        emulator.close()
+                    print(formatRow(result))
+                    results.append(result)
+    finally:
+        sys.stdout = stdout
+        devnull.close()
+        config.metricsFile, config.traceDirectory = metricsFile, traceDirectory
+        if root:
+            root.destroy()
+    return OrderedDict([("timestamp", time.strftime("%Y-%m-%dT%H:%M:%S")), ("results", results)])
+
+
+# formatRow: one line of the report table for a result.
+def formatRow(result):
+    row = "%-20s %-9s %-11s" % (result["configuration"], result["path"], result["protocol"])
+    if "skipped" in result or "error" in result:
+        return row + " " + (result.get("skipped") or "error: " + result["error"])
+    ms = lambda v: "%9.2f" % (v*1000) if v is not None else "%9s" % "-"
+    return row + " %7d %6d" % (result["samples"], result["missed"]) + \
+           "".join([ms(result[k]) for k in ("p50", "p99", "max", "maxDrift", "finalDrift")]) + \
+           " %7s" % result.get("bytesSent", "-")
+
+
+# formatReport: formats results as a table comparing configurations.
+def formatReport(results):
+    header = "%-20s %-9s %-11s %7s %6s%9s%9s%9s%9s%9s %7s" % ("configuration", "path", "protocol", "samples", "missed",
+                                                             "p50 ms", "p99 ms", "max ms", "drift ms", "final ms",
+                                                             "bytes")
+    return "\n".join([header] + [formatRow(r) for r in results["results"]])
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description = "Measure step to pin latency against an emulated KATARA device.")
+    parser.add_argument("--out", default = "latency_results.json", help = "JSON file for the results")
+    parser.add_argument("--protocols", nargs = "*", help = "protocols to run: " + ", ".join(protocols))
+    parser.add_argument("--paths", nargs = "*", default = ["headless", "repeat", "gui"],
+                        choices = ["headless", "repeat", "gui"])
+    args = parser.parse_args()
+    results = runHarness(args.protocols, args.paths)
+    with open(args.out, 'w') as file:
+        json.dump(results, file, indent = 2)
+    print("")
+    print(formatReport(results))
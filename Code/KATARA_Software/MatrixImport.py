@@ -0,0 +1,196 @@
+#MIT License
+#
+#Copyright (c) 2017 Jonathan A. White
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import json
+import itertools
+from ProtocolBuilder import changedRows, entry
+from SavedProtocol import header
+
+# MatrixImport turns a valve schedule designed as a time x valve matrix, one row of valve states per time step, into a
+# protocol: a valve step wherever valves change, setting only the valves that change, followed by a pause until the
+# next change, so runs of identical rows become one pause. The matrix may be a CSV file, a .npy file (memory-mapped,
+# not loaded) or an array, including a numpy.memmap. It is read a chunk of rows at a time and the steps are produced as
+# they are found, so schedules larger than memory can be written to a protocol file (writeProtocol) or planned into
+# events for a run (matrixEvents) without holding the whole schedule. Smaller schedules can be added to a
+# ProtocolBuilder (importMatrix). Schedules faster than the host can time steps can instead be streamed to the board
+# and played on its timer (matrixFrames, see KATARAValveController.playWaveform). Requires NumPy.
+#
+# Usage: python MatrixImport.py schedule.csv --dt 0.01 [--valves 2 3 4] [--time-column 0] --out protocol.txt
+
+chunkRows = 65536 # rows read at a time
+
+
+# readChunks: reads a matrix a chunk of rows at a time.
+#   Inputs:
+#       source - path of a CSV or .npy file, or a 2D array
+#       delimiter - delimiter of CSV files
+#       rows - number of rows per chunk
+#   Output: (list of column names from the CSV header, or None, iterator of 2D float arrays)
+def readChunks(source, delimiter = ',', rows = chunkRows):
+    import numpy
+    if not isinstance(source, str):
+        array = numpy.asarray(source) if not hasattr(source, 'shape') else source
+        return None, (array[k:k + rows] for k in range(0, len(array), rows))
+    if source.endswith(".npy"):
+        array = numpy.load(source, mmap_mode = 'r')
+        return None, (array[k:k + rows] for k in range(0, len(array), rows))
+    file = open(source, 'r')
+    first = file.readline()
+    names = None
+    try:
+        [float(field) for field in first.split(delimiter)]
+        lines = itertools.chain([first], file)
+    except ValueError:
+        names = [field.strip() for field in first.split(delimiter)]
+        lines = file
+
+    def chunks():
+        with file:
+            while True:
+                block = [line for line in itertools.islice(lines, rows) if line.strip()]
+                if not block:
+                    return
+                yield numpy.loadtxt(block, delimiter = delimiter, ndmin = 2)
+    return names, chunks()
+
+
+# matrixSteps: produces the steps of a matrix one at a time, as saved lists (see Routine.save).
+#   Inputs:
+#       source - path of a CSV or .npy file, or a 2D array
+#       valves - the valve of each valve column; the CSV header's column names, or pins 2, 3, ... if None
+#       dt - seconds each row lasts; with a time column, the seconds the last row lasts (0 if None)
+#       timeColumn - index of a column holding the time each row starts, in seconds, or None to use dt
+#       delimiter - delimiter of CSV files
+#       rows - number of rows read at a time
+#   Output: iterator of saved steps; raises a ValueError if the matrix does not fit the valves or times go back
+def matrixSteps(source, valves = None, dt = None, timeColumn = None, delimiter = ',', rows = chunkRows):
+    import numpy
+    names, chunks = readChunks(source, delimiter, rows)
+    if timeColumn is None and (dt is None or dt <= 0):
+        raise ValueError("Error: each row of the matrix must last a positive number of seconds, dt.")
+    previous = None # the last row of the previous chunk
+    pending = 0.0 # time of the last valve step, whose pause ends at the next change; rows start at time 0
+    start = 0 # index of the first row of the chunk
+    lastTime = None
+    for chunk in chunks:
+        if chunk.ndim != 2:
+            raise ValueError("Error: the matrix must have one row per time step.")
+        if timeColumn is not None:
+            times = numpy.asarray(chunk[:, timeColumn], dtype = float)
+            chunk = numpy.delete(chunk, timeColumn, axis = 1)
+            if (numpy.diff(times) < 0).any() or (lastTime is not None and len(times) and times[0] < lastTime):
+                raise ValueError("Error: the times of the rows must not decrease.")
+            lastTime = float(times[-1])
+        else:
+            times = (start + numpy.arange(len(chunk)))*float(dt)
+        if valves is None:
+            columnNames = names[:] if names else None
+            if columnNames and timeColumn is not None:
+                del columnNames[timeColumn]
+            valves = columnNames or list(range(2, 2 + chunk.shape[1]))
+        valveEntries = [entry(v) for v in valves]
+        if chunk.shape[1] != len(valveEntries):
+            raise ValueError("Error: the matrix must have one column per valve.")
+        matrix = chunk != 0
+        changes = numpy.empty(matrix.shape, dtype = bool)
+        if previous is None:
+            changes[0] = True # the first row sets every valve
+        else:
+            numpy.not_equal(matrix[0], previous, out = changes[0])
+        numpy.not_equal(matrix[1:], matrix[:-1], out = changes[1:])
+        changed, valveSets, stateSets = changedRows(changes, matrix, valveEntries)
+        stepTimes = times[changed].tolist()
+        for k in range(len(changed)):
+            if round(stepTimes[k] - pending, 9) > 0:
+                yield ["PauseStep", repr(round(stepTimes[k] - pending, 9))]
+            yield ["ValveStep", valveSets[k], stateSets[k]]
+            pending = stepTimes[k]
+        previous = matrix[-1].copy()
+        start += len(chunk)
+    if start:
+        end = (lastTime + (dt or 0)) if timeColumn is not None else start*float(dt)
+        if round(end - pending, 9) > 0:
+            yield ["PauseStep", repr(round(end - pending, 9))]
+
+
+# matrixFrames: produces the frames of a waveform (see ValveController.playWaveform) from a matrix, one per row that
+#   differs from the row before it, a chunk of rows at a time.
+#   Inputs:
+#       source - path of a CSV or .npy file, or a 2D array, with one column per pin of the waveform
+#       ticksPerRow - ticks each row lasts
+#       delimiter - delimiter of CSV files
+#       rows - number of rows read at a time
+#   Output: iterator of (tick, states)
+def matrixFrames(source, ticksPerRow = 1, delimiter = ',', rows = chunkRows):
+    import numpy
+    previous = None # the last row of the previous chunk
+    start = 0 # index of the first row of the chunk
+    for chunk in readChunks(source, delimiter, rows)[1]:
+        matrix = (numpy.asarray(chunk) != 0).astype(int)
+        changed = numpy.empty(len(matrix), dtype = bool)
+        changed[0] = previous is None or (matrix[0] != previous).any()
+        changed[1:] = (matrix[1:] != matrix[:-1]).any(axis = 1)
+        for k in numpy.flatnonzero(changed).tolist():
+            yield (start + k)*ticksPerRow, matrix[k].tolist()
+        previous = matrix[-1].copy()
+        start += len(matrix)
+
+
+# writeProtocol: writes the steps of a matrix to a protocol file that Protocol.loadProtocol can load, one step at a
+#   time (see matrixSteps for the inputs).
+#   Inputs:
+#       path - the protocol file to write
+#   Output: the number of steps written
+def writeProtocol(path, source, valves = None, dt = None, timeColumn = None, delimiter = ','):
+    count = 0
+    with open(path, 'w') as file:
+        file.write("[" + json.dumps(header))
+        for step in matrixSteps(source, valves, dt, timeColumn, delimiter):
+            file.write(", " + json.dumps(step))
+            count += 1
+        file.write("]")
+    return count
+
+
+# importMatrix: adds the steps of a matrix to a protocol being built (see matrixSteps for the inputs).
+#   Inputs:
+#       builder - a ProtocolBuilder, or any RoutineBuilder
+#   Output: the builder
+def importMatrix(builder, source, valves = None, dt = None, timeColumn = None, delimiter = ','):
+    return builder.extend(matrixSteps(source, valves, dt, timeColumn, delimiter))
+
+
+# matrixEvents: plans the steps of a matrix into the timed events SavedProtocol.planSaved would give for them, one at a
+#   time, so that schedules larger than memory can be run (see matrixSteps for the inputs).
+#   Output: iterator of (seconds from the start, step number, None, action) events
+def matrixEvents(source, valves = None, dt = None, timeColumn = None, delimiter = ','):
+    offset = 0.0
+    for stepId, step in enumerate(matrixSteps(source, valves, dt, timeColumn, delimiter), 1):
+        if step[0] == "PauseStep":
+            yield (offset, stepId, None, ("step",))
+            offset += float(step[1])
+        else:
+            pins = [int(v) if v.isdigit() else v for v in step[1].split(',')]
+            yield (offset, stepId, None, ("pins", pins, [int(s) for s in step[2].split(',')]))
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description = "Convert a time x valve matrix into a KATARA protocol file.")
+    parser.add_argument("matrix", help = "CSV or .npy file with one row of valve states per time step")
+    parser.add_argument("--out", required = True, help = "protocol file to write")
+    parser.add_argument("--dt", type = float, help = "seconds each row lasts (the last row, with --time-column)")
+    parser.add_argument("--valves", nargs = "*", help = "valve of each column (default: the CSV header, or 2, 3, ...)")
+    parser.add_argument("--time-column", type = int, help = "column holding the start time of each row, in seconds")
+    parser.add_argument("--delimiter", default = ",", help = "CSV delimiter")
+    args = parser.parse_args()
+    count = writeProtocol(args.out, args.matrix, args.valves, args.dt, args.time_column, args.delimiter)
+    print("Wrote " + str(count) + " steps to " + args.out)
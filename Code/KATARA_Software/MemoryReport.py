@@ -0,0 +1,76 @@
+#MIT License
+#
+#Copyright (c) 2017 Jonathan A. White
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+
+import gc
+import sys
+from collections import OrderedDict
+try:
+    import tracemalloc
+except ImportError: #python 2.7
+    tracemalloc = None
+
+# MemoryReport summarizes what the program is holding in memory, so that growth over long sessions can be traced to
+# the objects responsible. The GUI shows it from its Tools menu. Start python with -X tracemalloc (or call
+# tracemalloc.start()) to also get the allocated size and the lines that allocated the most memory.
+
+# modules whose objects are counted
+modules = ("ValveController", "KATARAValveController", "MultiValveController", "SimulatedDevice", "Step",
+           "StepDerivatives", "Protocol_Tools", "KATARAGUI", "USB_GUI", "LabelEntry", "SerialMetrics", "ValveTrace",
+           "ValveMap", "StateExport", "PinCoalescer")
+
+
+# memoryReport: collects the report.
+#   Input:
+#       top - number of allocation sites to list when tracemalloc is tracing
+#   Output: OrderedDict with the sizes of the pump and protocol registries, live object counts by class for the
+#       program's own classes, the total number of objects tracked by the garbage collector and, when tracing, the
+#       traced memory and the top allocation sites.
+def memoryReport(top = 5):
+    gc.collect()
+    report = OrderedDict()
+    if "ValveController" in sys.modules:
+        report["registered pumps"] = len(sys.modules["ValveController"].ValveController.pPumps)
+    if "KATARAGUI" in sys.modules:
+        report["pump interfaces"] = len(sys.modules["KATARAGUI"].pumpGUI.instances)
+    objects = gc.get_objects()
+    report["gc objects"] = len(objects)
+    counts = {}
+    for obj in objects:
+        cls = getattr(obj, '__class__', None)
+        if getattr(cls, '__module__', None) in modules:
+            counts[cls.__name__] = counts.get(cls.__name__, 0) + 1
+    report["objects"] = OrderedDict(sorted(counts.items(), key = lambda item: -item[1]))
+    if tracemalloc and tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        report["traced bytes"] = current
+        report["peak traced bytes"] = peak
+        stats = tracemalloc.take_snapshot().statistics('lineno')[:top]
+        report["top allocations"] = [(str(stat.traceback[0]), stat.size, stat.count) for stat in stats]
+    return report
+
+
+# formatMemoryReport: formats a report as text.
+#   Input:
+#       report - OrderedDict returned by memoryReport
+#   Output: string
+def formatMemoryReport(report):
+    lines = []
+    for key, value in report.items():
+        if key == "objects":
+            lines.append("Live objects:")
+            lines += ["    %-28s %d" % item for item in value.items()]
+        elif key == "top allocations":
+            lines.append("Top allocations:")
+            lines += ["    %s: %d bytes in %d blocks" % item for item in value]
+        else:
+            lines.append("%s: %s" % (key[0].upper() + key[1:], value))
+    return "\n".join(lines)
@@ -0,0 +1,294 @@
+#MIT License
+#
+#Copyright (c) 2017 Jonathan A. White
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+
+from ValveController import *
+from KATARAValveController import KATARAValveController
+from threading import Thread
+from collections import OrderedDict
+
+# MultiValveController combines several valve controllers (one per Arduino) into one logical controller so that chips
+# needing more than 68 valves can be driven through the same ValveController interface the GUI and protocols use.
+# Boards are named 'A', 'B', 'C'... in the order they are added. Pins are namespaced by board, for example "B:12"; plain
+# integer pins (and "A:12") refer to the first board so that single board protocols keep working unchanged.
+# setPins splits each call by board and sends the parts to all boards at the same time, so a call touching several
+# boards takes as long as the slowest board rather than the sum of all of them.
+class MultiValveController(ValveController):
+    deviceType = "KATARA board group"
+
+    # MultiValveController.__init__: Groups already connected controllers. Unlike the base class, no serial port is
+    #       opened here; each board owns its own connection, metrics, recorder and exporter.
+    #   Input:
+    #       boards - list of connected ValveController objects (e.g. KATARAValveController). The first is board A.
+    def __init__(self, boards):
+        self.boards = OrderedDict()
+        self.serLock = threading.RLock()
+        self.pinStates = BoardPinStates(self)
+        self.metrics = SerialMetrics("board group") # the group sends nothing itself, see metricsSnapshot
+        self.recorder = None # attached to the first board, see attachRecorder
+        self.exporter = None # attached to the first board, see attachExporter
+        self.pump = perstalticPump
+        self.pumpCache = weakref.WeakValueDictionary() # pumps are cached by the boards that run them, see specifyPump
+        for board in boards:
+            self.addBoard(board)
+        self.coalescer = None # merges pin updates across boards, see ValveController.attachCoalescer
+        if config.coalesceWindow:
+            self.attachCoalescer(PinCoalescer(self, config.coalesceWindow))
+
+    # MultiValveController.addBoard: Adds a connected controller as the next board.
+    #   Input:
+    #       board - a connected ValveController object
+    #   Output: the name of the new board
+    def addBoard(self, board):
+        name = chr(ord('A') + len(self.boards))
+        self.boards[name] = board
+        return name
+
+    # MultiValveController.connectBoard: Connects to a KATARA Arduino on a port and adds it as the next board.
+    #   Input:
+    #       port - string name of the serial port to open.
+    #   Output: the name of the new board
+    def connectBoard(self, port, deviceType = KATARAValveController):
+        return self.addBoard(deviceType(port))
+
+    # MultiValveController.splitPin: Splits a namespaced pin into the board name and the board's own pin number.
+    #   Input:
+    #       pin - an integer pin on the first board, or a string such as "12" or "B:12"
+    #   Output: tuple (board name, pin number on that board). Raises ValueError if the pin cannot be parsed.
+    def splitPin(self, pin):
+        names = list(self.boards)
+        if isinstance(pin, int):
+            return names[0], pin
+        name, sep, local = str(pin).strip().partition(':')
+        if not sep:
+            name, local = names[0], name
+        if name not in self.boards:
+            raise ValueError("Error: there is no board named " + name + ".")
+        try:
+            return name, int(local)
+        except ValueError:
+            raise ValueError("Error: invalid pin " + str(pin) + ".")
+
+    # MultiValveController.pinKey: Inverse of splitPin. Pins on the first board are plain integers, the others are
+    #       "B:12" style strings. These are the keys used in pinStates and in the GUI button dictionary.
+    #   Inputs:
+    #       name - board name
+    #       pin - pin number on that board
+    #   Output: the namespaced pin
+    def pinKey(self, name, pin):
+        if name == list(self.boards)[0]:
+            return pin
+        return name + ":" + str(pin)
+
+    # MultiValveController.testConnection: Each board tests its own connection when it is created.
+    def testConnection(self):
+        for board in self.boards.values():
+            board.testConnection()
+
+    # MultiValveController.close: closes the connection to every board.
+    def close(self):
+        self.attachCoalescer(None)
+        for board in self.boards.values():
+            board.close()
+
+    # MultiValveController.isOpen: True only if every board is connected.
+    def isOpen(self):
+        return all([board.isOpen() for board in self.boards.values()])
+
+    # MultiValveController.verify: Reads back every board's pins and compares them with the expected states.
+    # Inputs: None
+    # Outputs: list of the namespaced pins whose actual state differs from the expected one
+    def verify(self):
+        mismatched = []
+        for name, board in self.boards.items():
+            mismatched += [self.pinKey(name, pin) for pin in board.verify()]
+        return mismatched
+
+    # MultiValveController.sync: Updates every board's pin states to the states read back from it.
+    # Inputs: None
+    # Outputs: list of the namespaced pins whose state was wrong
+    def sync(self):
+        changed = []
+        for name, board in self.boards.items():
+            changed += [self.pinKey(name, pin) for pin in board.sync()]
+        return changed
+
+    # MultiValveController.firstBoard: returns board A, whose pins are the plain integer pins.
+    def firstBoard(self):
+        return list(self.boards.values())[0]
+
+    # MultiValveController.pinMask: returns the first board's pin states as a bit mask. A mask holds plain integer pins
+    #   (bit n is pin n), as do the valve trace and state export formats built on it, so it describes board A only;
+    #   the other boards are compared pin by pin in verify and sync.
+    # Inputs: None
+    # Outputs: integer
+    def pinMask(self):
+        return self.firstBoard().pinMask()
+
+    # MultiValveController.readPins: reads back the first board's pins as a bit mask (see pinMask).
+    # Inputs: None
+    # Outputs: integer bit mask
+    def readPins(self):
+        return self.firstBoard().readPins()
+
+    # MultiValveController.attachRecorder: records the valve transitions of the first board (see pinMask). The other
+    #   boards keep their own recorders.
+    # Inputs:
+    #       recorder - a ValveTraceRecorder, or None to stop recording
+    # Outputs: None
+    def attachRecorder(self, recorder):
+        self.firstBoard().attachRecorder(recorder)
+        self.recorder = recorder
+
+    # MultiValveController.attachExporter: publishes the state of the first board (see pinMask). The other boards keep
+    #   their own exporters.
+    # Inputs:
+    #       exporter - a StateExporter, or None to stop exporting
+    # Outputs: None
+    def attachExporter(self, exporter):
+        self.firstBoard().attachExporter(exporter)
+        self.exporter = exporter
+
+    # MultiValveController.metricsSnapshot: returns the serial link statistics of every board.
+    # Inputs: None
+    # Outputs: dictionary of SerialMetrics.snapshot dictionaries by board name
+    def metricsSnapshot(self):
+        snapshots = {}
+        for name, board in self.boards.items():
+            snapshots[name] = board.metricsSnapshot()
+        return snapshots
+
+    # MultiValveController.setPins: sets pins on any of the boards. The pins are grouped by board and each board's part
+    #       is sent from its own thread.
+    #   Inputs:
+    #       pins - a tuple, list, or set of namespaced pins. It must be the same length as states
+    #       states - a tuple or list of states to set the pins. Must be the same length as pins.
+    #   Output: dictionary of the responding message from each board that was written to.
+    def setPins(self, pins, states):
+        if type(pins) not in (tuple, list, set):
+            raise ValueError("'pins' entry must be a tuple, list or set.")
+        if type(states) not in (tuple, list):
+            raise ValueError("'states' entry must be a tuple, list or set.")
+        pins = list(pins)
+        if len(pins) != len(states):
+            raise ValueError("The length of the pins and states entries must be the same.")
+
+        # Check everything before writing so that a bad pin cannot leave some boards set and others not.
+        parts = OrderedDict()
+        keys = set()
+        for pin, state in zip(pins, states):
+            name, local = self.splitPin(pin)
+            self.boards[name]._checkPin(local)
+            if state not in (0, 1):
+                raise ValueError("Pin " + str(pin) + " must be set to either 0 or 1.")
+            if (name, local) in keys:
+                raise ValueError("There is a duplicate pin entry.")
+            keys.add((name, local))
+            parts.setdefault(name, ([], []))
+            parts[name][0].append(local)
+            parts[name][1].append(state)
+
+        responses = {}
+        errors = []
+
+        # send is the target of each board's thread.
+        def send(name):
+            try:
+                responses[name] = self.boards[name].setPins(parts[name][0], parts[name][1])
+            except Exception as E:
+                errors.append(E)
+
+        if len(parts) == 1: # no need for a thread
+            send(list(parts)[0])
+        else:
+            threads = [Thread(target=send, args=(name,)) for name in parts]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        if errors: # raise the first IOError if a board was lost, otherwise the first warning or error
+            for E in errors:
+                if isinstance(E, IOError):
+                    raise E
+            raise errors[0]
+        return responses
+
+    # MultiValveController.specifyPump: Creates a pump on the board its valves belong to. All three valves must be on
+    #       the same board.
+    # Inputs:
+    #       v1, v2, v3 - the namespaced valves of the peristaltic pump
+    # Output:
+    #       returns the board's peristaltic pump object. Its valveKeys hold the namespaced valves.
+    def specifyPump(self, v1, v2, v3):
+        split = [self.splitPin(v) for v in (v1, v2, v3)]
+        name = split[0][0]
+        if any([s[0] != name for s in split]):
+            raise ValueError("Error: all three valves of a pump must be on the same board.")
+        pPump = self.boards[name].specifyPump(split[0][1], split[1][1], split[2][1])
+        pPump.valveKeys = tuple([self.pinKey(name, s[1]) for s in split])
+        return pPump
+
+    # MultiValveController._checkPin: raises an error if the namespaced pin is not available on its board.
+    def _checkPin(self, pin):
+        name, local = self.splitPin(pin)
+        self.boards[name]._checkPin(local)
+
+    # MultiValveController.availablePinsStatement: Describes the available pins for error messages.
+    #   Output: string
+    def availablePinsStatement(self):
+        names = list(self.boards)
+        statement = "integer numbers 2-69"
+        for name in names[1:]:
+            statement += ", " + name + ":2-" + name + ":69"
+        return statement
+
+
+# BoardPinStates: A dictionary-like view of the pin states of every board in a MultiValveController, keyed by
+# namespaced pin. Reads and writes go straight to the boards' own pinStates so the two can never disagree.
+class BoardPinStates(object):
+
+    # BoardPinStates.__init__
+    #   Input:
+    #       ctlr - the MultiValveController whose boards are viewed
+    def __init__(self, ctlr):
+        self.ctlr = ctlr
+
+    def __getitem__(self, pin):
+        name, local = self.ctlr.splitPin(pin)
+        return self.ctlr.boards[name].pinStates[local]
+
+    def __setitem__(self, pin, state):
+        name, local = self.ctlr.splitPin(pin)
+        self.ctlr.boards[name].pinStates[local] = state
+
+    def __contains__(self, pin):
+        try:
+            name, local = self.ctlr.splitPin(pin)
+        except ValueError:
+            return False
+        return local in self.ctlr.boards[name].pinStates
+
+    def __iter__(self):
+        for name, board in self.ctlr.boards.items():
+            for pin in board.pinStates:
+                yield self.ctlr.pinKey(name, pin)
+
+    def __len__(self):
+        return sum([len(board.pinStates) for board in self.ctlr.boards.values()])
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [self[pin] for pin in self]
+
+    def items(self):
+        return [(pin, self[pin]) for pin in self]
@@ -0,0 +1,197 @@
+#MIT License
+#
+#Copyright (c) 2017 Jonathan A. White
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+
+
+import threading
+from collections import OrderedDict
+from SerialMetrics import clock
+
+# PinCoalescer merges pin updates issued close together into one set pins command. Each click on a valve button, and
+# each setPins call in a script's loop, is otherwise a frame of its own and a round trip the caller waits for. With a
+# coalescer attached to a controller (ValveController.attachCoalescer, or config.coalesceWindow), setPinsLater and
+# togglePinLater queue the update and return at once; the updates queued within the window that follows the first one
+# are sent together, a later update to a pin replacing an earlier one, and each caller gets a PinUpdate that completes
+# when the device has acknowledged the merged command:
+#
+#   update = ctlr.setPinsLater([2, 3], [1, 1])
+#   ...
+#   update.result() # the device's reply; raises the error setPins raised, if any
+#
+# Updates are sent in the order they were queued, but after any setPins call made directly on the controller in the
+# meantime; call flush first when the order matters.
+
+
+# PinUpdate: the outcome of a queued pin update, available once the command carrying it has been acknowledged.
+class PinUpdate:
+
+    # PinUpdate.__init__
+    #   Input: None
+    def __init__(self):
+        self.response = None
+        self.error = None
+        self.event = threading.Event()
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+    # PinUpdate.done: returns True once the update has been acknowledged or has failed.
+    def done(self):
+        return self.event.isSet()
+
+    # PinUpdate.result: waits for the update.
+    #   Input:
+    #       timeout - seconds to wait, None to wait for as long as it takes
+    #   Output: the device's reply to the command that carried the update; raises the error the command raised, or an
+    #       IOError if the timeout passes first.
+    def result(self, timeout = None):
+        if not self.event.wait(timeout):
+            raise IOError("Error: the pin update was not acknowledged in time.")
+        if self.error:
+            raise self.error
+        return self.response
+
+    # PinUpdate.addDoneCallback: calls a function with the update once it is done, at once if it already is. The
+    #   function runs in the coalescer's thread; GUI code should poll done instead.
+    #   Input:
+    #       callback - function of one argument, the PinUpdate
+    def addDoneCallback(self, callback):
+        with self.lock:
+            if not self.done():
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+    # PinUpdate.finish: records the outcome of the command and runs the callbacks. Called by the coalescer.
+    #   Inputs:
+    #       response - the device's reply
+    #       error - the error the command raised, or None
+    def finish(self, response, error = None):
+        with self.lock:
+            self.response, self.error = response, error
+            self.event.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+
+# PinCoalescer: queues pin updates for a controller and sends them as one command per window, from its own thread.
+class PinCoalescer:
+
+    # PinCoalescer.__init__
+    #   Inputs:
+    #       ctlr - the ValveController to send the updates through
+    #       window - seconds to wait after an update for others to merge with it
+    def __init__(self, ctlr, window = 0.002):
+        self.ctlr = ctlr
+        self.window = window
+        self.pending = OrderedDict() # pin: state of the updates waiting to be sent
+        self.updates = [] # PinUpdates of the pending updates
+        self.sending = {} # pin: state of the command being sent
+        self.sendingUpdate = None # PinUpdate of the last update in the command being sent
+        self.deadline = None # clock time at which the pending updates are sent
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target = self._run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    # PinCoalescer.setPins: queues an update of pins, checked as setPins checks them.
+    #   Inputs:
+    #       pins - a tuple, list or set of pins
+    #       states - a tuple or list of states, one per pin
+    #   Output: a PinUpdate; raises a ValueError at once for invalid input.
+    def setPins(self, pins, states):
+        if type(pins) not in (tuple, list, set):
+            raise ValueError("'pins' entry must be a tuple, list or set.")
+        if type(states) not in (tuple, list) or len(pins) != len(states):
+            raise ValueError("The length of the pins and states entries must be the same.")
+        if len(set(pins)) < len(pins):
+            raise ValueError("There is a duplicate pin entry.")
+        for pin, state in zip(pins, states):
+            self.ctlr._checkPin(pin)
+            if state not in (0, 1):
+                raise ValueError("Pin " + str(pin) + " must be set to either 0 or 1.")
+        update = PinUpdate()
+        with self.condition:
+            if self.closed:
+                raise IOError("Error: the pin coalescer has been closed.")
+            for pin, state in zip(pins, states):
+                self.pending.pop(pin, None) # keep the pins in the order of their last update
+                self.pending[pin] = state
+            self.updates.append(update)
+            if self.deadline is None:
+                self.deadline = clock() + self.window
+                self.condition.notify()
+        return update
+
+    # PinCoalescer.togglePin: queues an update inverting a pin's state, counting the updates not yet sent.
+    #   Input:
+    #       pin - the pin to toggle
+    #   Output: (the new state, a PinUpdate)
+    def togglePin(self, pin):
+        with self.condition:
+            state = 1 - self.state(pin)
+            return state, self.setPins((pin,), (state,))
+
+    # PinCoalescer.state: returns the state a pin will have once the queued updates have been sent.
+    def state(self, pin):
+        with self.condition:
+            if pin in self.pending:
+                return self.pending[pin]
+            if pin in self.sending:
+                return self.sending[pin]
+            return self.ctlr.pinStates[pin]
+
+    # PinCoalescer.flush: sends the pending updates now and waits for them, or for the command being sent if nothing
+    #   is pending.
+    #   Input: None
+    #   Output: None; raises the error the command raised, if any.
+    def flush(self):
+        with self.condition:
+            if self.updates:
+                update = self.updates[-1]
+                self.deadline = clock()
+                self.condition.notify()
+            else:
+                update = self.sendingUpdate
+        if update is not None:
+            update.result()
+
+    # PinCoalescer.close: sends the pending updates and stops the thread.
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+
+    # PinCoalescer._run: target of the coalescer's thread. Waits for the window of the first pending update to pass,
+    #   then sends the pending updates with one setPins call and completes their PinUpdates.
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.closed and (self.deadline is None or clock() < self.deadline):
+                    self.condition.wait(None if self.deadline is None else self.deadline - clock())
+                if not self.updates:
+                    return # closed with nothing pending
+                pins, states = list(self.pending), list(self.pending.values())
+                updates, self.sending, self.sendingUpdate = self.updates, self.pending, self.updates[-1]
+                self.pending, self.updates, self.deadline = OrderedDict(), [], None
+            response, error = None, None
+            try:
+                response = self.ctlr.setPins(pins, states)
+            except Exception as E:
+                error = E
+            with self.condition:
+                self.sending = {}
+            for update in updates:
+                update.finish(response, error)
+            with self.condition:
+                self.sendingUpdate = None
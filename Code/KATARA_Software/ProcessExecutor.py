@@ -0,0 +1,259 @@
+#MIT License
+#
+#Copyright (c) 2017 Jonathan A. White
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+
+
+import time
+import multiprocessing
+import config
+from SerialMetrics import clock
+from ValveTrace import setStepContext
+
+# ProcessExecutor runs a protocol in a separate process that owns the serial port while the protocol runs, so that
+# dragging windows, scrolling or loading files in the GUI cannot delay the valves. The protocol is first compiled into
+# timed events (see Routine.planEvents), which the worker process carries out on its own clock. The GUI process hands
+# the port over (KATARAValveController.releasePort), follows the run through a status block in shared memory, stops it
+# through a command pipe, and takes the port back when the worker exits (KATARAValveController.reclaimPort). Both
+# sides open the port without asserting DTR, which would reset the Arduino and drop every valve while it restarts.
+
+# states of a run, as published in the status block
+STARTING, RUNNING, DONE, CANCELLED, FAILED = range(5)
+
+# layout of the status block: a sequence number, the state, the step running, the time it started (time.time()), the
+# index of the last event carried out, the number of loop iterations and the iterations themselves (the innermost
+# loop first), followed by the state of every pin by pin number: 0 low, 1 high, 2 pumping.
+SEQUENCE, STATE, STEP, STEP_START, EVENT, DEPTH, ITERS = range(7)
+maxDepth = 8
+PINS = ITERS + maxDepth
+nPins = 70
+
+spinTime = 0.002 # the worker waits the last seconds before an event in a busy loop, since sleeps are not that precise
+tickTime = 0.05 # longest wait between checks for the stop command and for pumps that have ended
+
+try:
+    context = multiprocessing.get_context("spawn") # a fresh interpreter, rather than a fork of the GUI
+except AttributeError: # python 2.7
+    context = multiprocessing
+
+
+# StatusBlock: the state of a run, in shared memory. It has one writer, the worker process, which makes the sequence
+# number odd while it writes; readers copy the block and retry if the number was odd or changed (a seqlock).
+class StatusBlock:
+
+    # StatusBlock.__init__: allocates the shared memory.
+    def __init__(self):
+        self.values = context.Array('d', PINS + nPins, lock = False)
+
+    # StatusBlock.publish: writes the state of the run.
+    #   Inputs:
+    #       state - one of STARTING, RUNNING, DONE, CANCELLED, FAILED
+    #       pins - dictionary of the state of each pin (0, 1 or 2)
+    #       step - number of the step running, 0 for none
+    #       stepStart - time.time() at which the step started
+    #       event - index of the last event carried out
+    #       iters - tuple of loop iterations, None outside loops
+    #   Output: None
+    def publish(self, state, pins, step = 0, stepStart = 0, event = -1, iters = None):
+        values = self.values
+        sequence = values[SEQUENCE]
+        values[SEQUENCE] = sequence + 1
+        values[STATE] = state
+        values[STEP] = step
+        values[STEP_START] = stepStart
+        values[EVENT] = event
+        iters = tuple(iters or ())[:maxDepth]
+        values[DEPTH] = len(iters)
+        for k, i in enumerate(iters):
+            values[ITERS + k] = i
+        for pin, pinState in pins.items():
+            values[PINS + pin] = pinState
+        values[SEQUENCE] = sequence + 2
+
+    # StatusBlock.read: returns a consistent copy of the block.
+    #   Inputs: None
+    #   Output: dictionary with the state, step, stepStart, event, iters and pins (a list indexed by pin number)
+    def read(self):
+        while True:
+            sequence = self.values[SEQUENCE]
+            values = self.values[:]
+            if sequence % 2 == 0 and self.values[SEQUENCE] == sequence:
+                break
+            time.sleep(0)
+        return {"state": int(values[STATE]), "step": int(values[STEP]), "stepStart": values[STEP_START],
+                "event": int(values[EVENT]), "iters": tuple([int(i) for i in values[ITERS:ITERS + int(values[DEPTH])]]),
+                "pins": [int(p) for p in values[PINS:]]}
+
+
+# executePlan: the target of the worker process. Connects to the device, restores the GUI's pin states, carries out
+#   the events at their times and publishes the state of the run after each of them. A "stop" sent through the pipe
+#   cancels the run and stops the pumps it started. If the run fails, the error is sent back through the pipe.
+#   Inputs:
+#       deviceClass - class of the controller to connect with, e.g. KATARAValveController
+#       port - serial port of the device
+#       pinStates - dictionary of the state of each pin when the run starts
+#       events - timed events (see Routine.planEvents)
+#       duration - seconds the protocol takes
+#       status - the StatusBlock
+#       pipe - the worker's end of the command pipe
+#       traceDirectory - config.traceDirectory of the GUI process
+#       stateExportFile - config.stateExportFile of the GUI process
+#   Output: None
+def executePlan(deviceClass, port, pinStates, events, duration, status, pipe, traceDirectory = None,
+                stateExportFile = None):
+    config.metricsFile = None # the GUI process keeps the metrics of the connection
+    config.traceDirectory = traceDirectory
+    config.stateExportFile = stateExportFile # readers of the state file follow the worker while it runs
+    device = None
+    pumps = [] # (time the pump ends, pump) for pumps started by the run
+    state = FAILED
+    step, stepStart, index, iters = 0, 0, -1, None
+
+    # pinStatus: the pin states to publish, with the valves of running pumps marked as pumping
+    def pinStatus():
+        pins = dict(device.pinStates) if device else dict(pinStates)
+        for end, pump in pumps:
+            for valve in pump.valveKeys:
+                pins[valve] = 2
+        return pins
+
+    # tick: forgets pumps that have ended, publishing the change
+    def tick():
+        now = clock()
+        if [p for p in pumps if p[0] <= now]:
+            pumps[:] = [p for p in pumps if p[0] > now]
+            status.publish(RUNNING, pinStatus(), step, stepStart, index, iters)
+
+    status.publish(STARTING, pinStatus())
+    try:
+        device = deviceClass(port, reset = False) # the valves keep their states while the port changes hands
+        device.pinStates.update(pinStates)
+        device._restoreState() # in case the board did reset
+        start = clock()
+        state = RUNNING
+        status.publish(RUNNING, pinStatus())
+        for index, (offset, step, iters, action) in enumerate(events):
+            if waitUntil(pipe, start + offset, tick):
+                state = CANCELLED
+                break
+            stepStart = time.time()
+            setStepContext(step, iters)
+            if action[0] == "pins":
+                device.setPins(action[1], action[2])
+            elif action[0] == "pump":
+                direction, valves, rate, cycles = action[1:]
+                pump = device.specifyPump(*valves)
+                if direction == 'r':
+                    pump.reverse(rate, cycles)
+                else:
+                    pump.forward(rate, cycles)
+                pumps.append((float('Inf') if cycles == -1 else start + offset + float(cycles)/float(rate), pump))
+            status.publish(RUNNING, pinStatus(), step, stepStart, index, iters)
+        if state == RUNNING:
+            state = CANCELLED if waitUntil(pipe, start + duration, tick) else DONE
+        if state == CANCELLED:
+            for end, pump in pumps:
+                if end > clock():
+                    pump.stop()
+            pumps = []
+    except Exception as E:
+        state = FAILED
+        pipe.send(("error", str(E)))
+    finally:
+        status.publish(state, pinStatus(), step, stepStart, index, iters)
+        if device:
+            device.close()
+
+
+# waitUntil: waits for a time on the worker's clock, or for the stop command.
+#   Inputs:
+#       pipe - the worker's end of the command pipe
+#       deadline - clock() time to wait for
+#       tick - function called at least every tickTime seconds while waiting
+#   Output: True if the stop command was received, False once the time is reached
+def waitUntil(pipe, deadline, tick):
+    while True:
+        remaining = deadline - clock()
+        if remaining <= 0:
+            return False
+        if remaining > spinTime:
+            if pipe.poll(min(remaining - spinTime, tickTime)) and pipe.recv() == "stop":
+                return True
+            tick()
+
+
+# ProcessExecutor: the GUI side of a run in a worker process.
+class ProcessExecutor:
+
+    # ProcessExecutor.__init__
+    #   Inputs:
+    #       device - the connected controller; it must have releasePort and reclaimPort (see KATARAValveController)
+    #       events - timed events of the protocol (see Routine.planEvents)
+    #       duration - seconds the protocol takes
+    def __init__(self, device, events, duration):
+        self.device = device
+        self.status = StatusBlock()
+        self.pipe, workerPipe = context.Pipe()
+        self.process = context.Process(target = executePlan,
+                                       args = (type(device), device.port, dict(device.pinStates), events, duration,
+                                               self.status, workerPipe, config.traceDirectory,
+                                               config.stateExportFile))
+        self.process.daemon = True
+        self.error = None # message of the error that stopped the run, if any
+
+    # ProcessExecutor.start: hands the serial port to a new worker process and starts the run.
+    #   Inputs: None
+    #   Output: None
+    def start(self):
+        self.device.releasePort()
+        try:
+            self.process.start()
+        except Exception:
+            self.device.reclaimPort(self.device.pinStates)
+            raise
+
+    # ProcessExecutor.stop: tells the worker to cancel the run.
+    #   Inputs: None
+    #   Output: None
+    def stop(self):
+        try:
+            self.pipe.send("stop")
+        except (IOError, OSError, EOFError): # the worker has exited
+            pass
+
+    # ProcessExecutor.wait: waits for the worker to exit.
+    #   Input:
+    #       timeout - seconds to wait, None to wait until it exits
+    #   Output: True if the worker has exited
+    def wait(self, timeout = None):
+        self.process.join(timeout)
+        return not self.process.is_alive()
+
+    # ProcessExecutor.finish: waits for the worker to exit, stopping it if it does not, and takes the serial port back
+    #   with the pin states the run left. Sets self.error if the run failed.
+    #   Inputs: None
+    #   Output: the final status (see StatusBlock.read)
+    def finish(self):
+        if not self.wait(10):
+            self.process.terminate()
+            self.process.join()
+            self.error = "The protocol process did not stop and was terminated."
+        try:
+            while self.pipe.poll():
+                message = self.pipe.recv()
+                if message[0] == "error":
+                    self.error = message[1]
+        except (IOError, OSError, EOFError): # nothing more from the worker
+            pass
+        status = self.status.read()
+        if status["state"] in (STARTING, RUNNING) and not self.error:
+            self.error = "The protocol process exited unexpectedly."
+        self.device.reclaimPort(dict([(pin, 1 if status["pins"][pin] == 1 else 0) for pin in self.device.pinStates]))
+        return status
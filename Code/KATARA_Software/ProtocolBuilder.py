@@ -0,0 +1,289 @@
+#MIT License
+#
+#Copyright (c) 2017 Jonathan A. White
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import json
+from SavedProtocol import header, planSaved
+
+# ProtocolBuilder builds protocols from code, without Tk, as the lists Protocol.save writes to protocol files, so that
+# what it builds can be saved and loaded into the GUI, run by ControlServer or planned by SavedProtocol:
+#
+#   protocol = ProtocolBuilder()
+#   protocol.valves([2, 3], 1).pause(0.5)
+#   loop = protocol.loop(10)
+#   loop.pump(20, 21, 22, rate = 5, cycles = 10).valves(4, "i[0] % 2")
+#   protocol.valveMatrix(matrix, valves = range(2, 18), dt = 0.01) # one row of valve states every 10 ms
+#   protocol.save("protocol.txt")
+#
+# Entries are stored as the strings the GUI's entries hold, so loop expressions of i can be used wherever the GUI
+# accepts them. The array constructors need NumPy.
+
+stepTypes = ["PumpStep", "ValveStep", "PauseStep"] # the steps users may add to loaded loops (see KATARAGUI.__init__)
+
+
+# entry: converts a value to the string of an entry. Floats are written so that they read back exactly.
+def entry(value):
+    if hasattr(value, 'dtype'): # a NumPy number
+        return entry(value.item())
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+# changedRows: finds the rows of a valve matrix in which valves change, and the entries of the valve steps that change
+#   them (see RoutineBuilder.valveMatrix).
+#   Inputs:
+#       changes - boolean matrix, True where a valve changes
+#       matrix - boolean matrix of the valve states
+#       valves - the entry of each column's valve
+#   Output: (list of the rows with a change, list of the valve entry of each, list of the state entry of each)
+def changedRows(changes, matrix, valves):
+    import numpy
+    rows, columns = numpy.nonzero(changes)
+    starts = numpy.flatnonzero(numpy.r_[True, rows[1:] != rows[:-1]]) if len(rows) else rows
+    stateStrings = numpy.where(matrix[rows, columns], "1", "0").tolist()
+    columns = columns.tolist()
+    bounds = starts.tolist() + [len(columns)]
+    valveEntries = []
+    stateEntries = []
+    for k in range(len(starts)):
+        a, b = bounds[k], bounds[k + 1]
+        valveEntries.append(",".join([valves[c] for c in columns[a:b]]))
+        stateEntries.append(",".join(stateStrings[a:b]))
+    return rows[starts].tolist(), valveEntries, stateEntries
+
+
+# RoutineBuilder: a list of steps, loops and parallel blocks run one after another. The methods adding steps return the
+# builder, so calls can be chained; loop and parallel return the new loop or block.
+class RoutineBuilder(object):
+
+    # RoutineBuilder.__init__
+    #   Inputs: None
+    def __init__(self):
+        self.items = [] # saved steps (lists) and builders of loops and parallel blocks
+
+    # RoutineBuilder.valves: adds a valve step.
+    #   Inputs:
+    #       valves - a valve, or a list of valves; valves on other boards are strings such as "B:12", and inside loops
+    #           valves may be python expressions of i
+    #       states - a state (0 or 1) for every valve, or a list of one state per valve
+    #   Output: the builder
+    def valves(self, valves, states):
+        if not isinstance(valves, (list, tuple)) and not hasattr(valves, '__array__'):
+            valves = [valves]
+        if not isinstance(states, (list, tuple)) and not hasattr(states, '__array__'):
+            states = [states]
+        self.items.append(["ValveStep", ",".join([entry(v) for v in valves]), ",".join([entry(s) for s in states])])
+        return self
+
+    # RoutineBuilder.pump: adds a pump step, which pumps forward.
+    #   Inputs:
+    #       v1, v2, v3 - the pump's valves
+    #       rate - cycles per second
+    #       cycles - number of cycles, -1 to pump until the protocol is stopped (only as its last step)
+    #   Output: the builder
+    def pump(self, v1, v2, v3, rate, cycles):
+        self.items.append(["PumpStep", entry(rate), entry(cycles), entry(v1), entry(v2), entry(v3)])
+        return self
+
+    # RoutineBuilder.pause: adds a pause step.
+    #   Input:
+    #       seconds - time to pause, or a python expression of i inside loops
+    #   Output: the builder
+    def pause(self, seconds):
+        self.items.append(["PauseStep", entry(float(seconds) if isinstance(seconds, int) else seconds)])
+        return self
+
+    # RoutineBuilder.loop: adds a loop. Add its steps to the builder returned.
+    #   Input:
+    #       iterations - number of iterations
+    #   Output: a LoopBuilder
+    def loop(self, iterations):
+        loop = LoopBuilder(iterations)
+        self.items.append(loop)
+        return loop
+
+    # RoutineBuilder.parallel: adds a parallel block. Add its branches to the builder returned.
+    #   Inputs: None
+    #   Output: a ParallelBuilder
+    def parallel(self):
+        block = ParallelBuilder()
+        self.items.append(block)
+        return block
+
+    # RoutineBuilder.extend: adds saved items, as Routine.save returns them, or the items of another builder.
+    #   Input:
+    #       items - list of saved items, or a RoutineBuilder
+    #   Output: the builder
+    def extend(self, items):
+        self.items += items.items if isinstance(items, RoutineBuilder) else list(items)
+        return self
+
+    # RoutineBuilder.valveMatrix: adds the steps that set valves to the rows of a time x valve matrix in turn. The first
+    #   row sets every valve; each later row sets only the valves that change. Rows equal to the row before add no
+    #   step, only lengthen the pause.
+    #   Inputs:
+    #       matrix - 2D array of valve states, one row per time step and one column per valve; nonzero is energized
+    #       valves - the valve of each column
+    #       dt - seconds each row lasts
+    #       times - instead of dt, the times at which the rows start followed by the time the last row ends, in seconds
+    #   Output: the builder
+    def valveMatrix(self, matrix, valves, dt = None, times = None):
+        import numpy
+        matrix = numpy.asarray(matrix) != 0
+        valves = [entry(v) for v in valves]
+        if matrix.ndim != 2 or matrix.shape[1] != len(valves):
+            raise ValueError("Error: the matrix must have one column per valve.")
+        if not len(matrix):
+            return self
+        if times is None:
+            if dt is None or dt <= 0:
+                raise ValueError("Error: each row of the matrix must last a positive number of seconds, dt.")
+            times = numpy.arange(len(matrix) + 1)*float(dt)
+        times = numpy.asarray(times, dtype = float)
+        if times.shape != (len(matrix) + 1,):
+            raise ValueError("Error: times must hold the start of every row and the end of the last row.")
+        if (numpy.diff(times) < 0).any():
+            raise ValueError("Error: times must not decrease.")
+        changes = numpy.empty(matrix.shape, dtype = bool)
+        changes[0] = True
+        numpy.not_equal(matrix[1:], matrix[:-1], out = changes[1:])
+        self.changeSteps(changes, matrix, valves, times)
+        return self
+
+    # RoutineBuilder.changeSteps: adds a valve step for every row with a change, each followed by a pause until the
+    #   next row with a change (see valveMatrix).
+    #   Inputs:
+    #       changes - boolean matrix, True where a valve changes
+    #       matrix - boolean matrix of the valve states
+    #       valves - the entry of each column's valve
+    #       times - start of every row and end of the last row
+    def changeSteps(self, changes, matrix, valves, times):
+        import numpy
+        changed, valveEntries, stateEntries = changedRows(changes, matrix, valves)
+        ends = numpy.r_[times[changed[1:]], times[-1]] if changed else []
+        pauses = numpy.round(ends - times[changed], 9).tolist() # 0.1 rather than 0.10000000000000009
+        items = self.items
+        if changed and changed[0] > 0: # the first rows change nothing
+            items.append(["PauseStep", repr(round(float(times[changed[0]] - times[0]), 9))])
+        for k in range(len(changed)):
+            items.append(["ValveStep", valveEntries[k], stateEntries[k]])
+            if pauses[k] > 0:
+                items.append(["PauseStep", repr(pauses[k])])
+
+    # RoutineBuilder.pulses: adds the steps of a pulse schedule: each pulse energizes a valve at a time, for a number
+    #   of seconds. Valves start de-energized, stay energized while any of their pulses lasts, and valves changing at
+    #   the same time change in one step.
+    #   Inputs:
+    #       schedule - N x 3 array, or list of (start, valve, seconds) tuples, with times in seconds from the start of
+    #           the steps added
+    #       end - the time at which the steps end; the end of the last pulse if None
+    #   Output: the builder
+    def pulses(self, schedule, end = None):
+        import numpy
+        schedule = numpy.asarray(schedule, dtype = object if isinstance(schedule, list) else None)
+        if not len(schedule):
+            return self
+        if schedule.ndim != 2 or schedule.shape[1] != 3:
+            raise ValueError("Error: a pulse schedule has a (start, valve, seconds) row for every pulse.")
+        starts = schedule[:, 0].astype(float)
+        lengths = schedule[:, 2].astype(float)
+        if (starts < 0).any() or (lengths < 0).any():
+            raise ValueError("Error: pulses must start at or after 0 and last a positive number of seconds.")
+        keep = lengths > 0
+        valveNames = [entry(int(v) if isinstance(v, float) and v == int(v) else v) for v in schedule[keep, 1].tolist()]
+        names = sorted(set(valveNames), key = lambda n: (not n.isdigit(), int(n) if n.isdigit() else 0, n))
+        index = dict([(n, k) for k, n in enumerate(names)])
+        valves = numpy.array([index[n] for n in valveNames], dtype = int)
+        edgeTimes = numpy.r_[starts[keep], starts[keep] + lengths[keep]]
+        edgeValves = numpy.r_[valves, valves]
+        deltas = numpy.r_[numpy.ones(len(valves), int), -numpy.ones(len(valves), int)]
+        # for each valve in turn, count the pulses lasting after each edge; the count returns to 0 at each valve's end
+        order = numpy.lexsort((deltas, edgeTimes, edgeValves))
+        edgeTimes, edgeValves = edgeTimes[order], edgeValves[order]
+        on = numpy.cumsum(deltas[order]) > 0
+        # the state of a valve at a time is the state after its last edge at that time
+        last = numpy.r_[(edgeTimes[1:] != edgeTimes[:-1]) | (edgeValves[1:] != edgeValves[:-1]), True]
+        edgeTimes, edgeValves, on = edgeTimes[last], edgeValves[last], on[last]
+        before = numpy.r_[False, on[:-1]]
+        before[numpy.r_[True, edgeValves[1:] != edgeValves[:-1]]] = False
+        change = on != before
+        edgeTimes, edgeValves, on = edgeTimes[change], edgeValves[change], on[change]
+        order = numpy.lexsort((edgeValves, edgeTimes))
+        edgeTimes, edgeValves, on = edgeTimes[order], edgeValves[order], on[order]
+        stepTimes, rows = numpy.unique(edgeTimes, return_inverse = True)
+        changes = numpy.zeros((len(stepTimes), len(names)), dtype = bool)
+        changes[rows, edgeValves] = True
+        matrix = numpy.zeros(changes.shape, dtype = bool)
+        matrix[rows, edgeValves] = on
+        finish = stepTimes[-1] if end is None else max(float(end), stepTimes[-1])
+        if stepTimes[0] > 0:
+            self.pause(float(stepTimes[0]))
+        self.changeSteps(changes, matrix, names, numpy.r_[stepTimes, finish])
+        return self
+
+    # RoutineBuilder.saved: returns the routine as the list Routine.save returns.
+    def saved(self):
+        return [item.saved() if isinstance(item, RoutineBuilder) else item for item in self.items]
+
+    # RoutineBuilder.countSteps: returns the number of steps, counting the steps of loops once.
+    def countSteps(self):
+        return sum([item.countSteps() if isinstance(item, RoutineBuilder) else 1 for item in self.items])
+
+
+# LoopBuilder: a loop; its steps may refer to the loop iteration as i[0] (see RoutineBuilder).
+class LoopBuilder(RoutineBuilder):
+
+    # LoopBuilder.__init__
+    #   Input:
+    #       iterations - number of iterations
+    def __init__(self, iterations):
+        RoutineBuilder.__init__(self)
+        if int(iterations) < 1:
+            raise ValueError("You must loop over a postitive integer number of iterations.")
+        self.iterations = int(iterations)
+
+    # LoopBuilder.saved: returns the loop as the list Loop.save returns.
+    def saved(self):
+        return ["Loop", stepTypes, str(self.iterations)] + RoutineBuilder.saved(self)
+
+
+# ParallelBuilder: a parallel block; each of its items is a branch that runs at the same time as the others. Use branch
+#   for a branch of several steps.
+class ParallelBuilder(RoutineBuilder):
+
+    # ParallelBuilder.branch: adds a branch of steps run one after another, as a loop of one iteration.
+    #   Inputs: None
+    #   Output: a LoopBuilder
+    def branch(self):
+        return self.loop(1)
+
+    # ParallelBuilder.saved: returns the block as the list ParallelBlock.save returns.
+    def saved(self):
+        return ["ParallelBlock", stepTypes] + RoutineBuilder.saved(self)
+
+
+# ProtocolBuilder: a whole protocol (see RoutineBuilder).
+class ProtocolBuilder(RoutineBuilder):
+
+    # ProtocolBuilder.save: writes the protocol to a file that Protocol.loadProtocol can load.
+    #   Input:
+    #       path - the file to write
+    #   Output: None
+    def save(self, path):
+        with open(path, 'w') as file:
+            json.dump([header] + self.saved(), file)
+
+    # ProtocolBuilder.plan: checks the protocol and plans it into timed events (see SavedProtocol.planSaved).
+    #   Input:
+    #       pins - the valves the protocol may use; the pins of one KATARA board if None
+    #   Output: (list of events, seconds the protocol takes); raises a ValueError if the protocol is not valid
+    def plan(self, pins = None):
+        return planSaved(self.saved(), pins if pins is not None else range(2, 70))
@@ -0,0 +1,335 @@
+#MIT License
+#
+#Copyright (c) 2017 Jonathan A. White
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import copy
+from Protocol_Tools import Loop, ParallelBlock # before Step, which imports Protocol_Tools back
+from Step import Step
+from StepDerivatives import ValveStep, PumpStep
+from ValveTrace import setStepContext
+
+# ProtocolOptimizer rewrites a validated protocol into a shorter list of steps to run, without changing the steps the
+# user edits and saves: each routine (protocol or loop) gets a runSteps list that Routine.run uses instead of its steps.
+# Steps whose entries do not depend on the loop iteration are described by their repeatActions (see
+# Step.repeatActions), and the optimizer
+#   - removes zero-length pauses and merges adjacent pauses,
+#   - combines valve steps that run at the same time (with no pause between them) into one command, the last state
+#     given to a valve winning, and removes valve changes to the state the valve is known to be in already,
+#   - merges pump steps that follow each other on the same valves at the same rate, and folds the pauses after a pump
+#     into the pump step's wait,
+#   - inlines loops of one iteration and replaces loops of pauses with a single pause.
+# Valves, pumps and pauses happen at the same points of the protocol's schedule as before; only the commands and the
+# waits between steps that took no time are removed. Steps that depend on the loop iteration, parallel blocks and
+# anything that cannot be described are left in place, and what is known about the valve states is forgotten there.
+
+
+# Saved: holds a saved entry for steps built by the optimizer, in place of a LabelEntry.
+class Saved:
+    def __init__(self, saved):
+        self.saved = saved
+        self.expression = False
+
+
+# PauseRun: a pause built from one or more pause steps. It is shown on the box of the first of them.
+class PauseRun(Step):
+
+    # PauseRun.__init__
+    #   Inputs:
+    #       source - the first step merged into the pause
+    #       runtime - seconds to pause
+    def __init__(self, source, runtime):
+        self.box = source.box
+        self.stepId = getattr(source, 'stepId', 0)
+        self.runtime = runtime
+
+    def run(self, iter = None):
+        setStepContext(self.stepId, iter)
+        Step.pause(self, self.runtime)
+
+    def repeatActions(self):
+        return [("pause", self.runtime)]
+
+    def planEvents(self, iter = None):
+        return [(0, self.stepId, iter, ("step",))], self.runtime
+
+
+# ValveRun: a single valve command built from valve steps that run at the same time.
+class ValveRun(Step):
+
+    # ValveRun.__init__
+    #   Inputs:
+    #       source - the first step merged into the command
+    #       pins - valves to set
+    #       states - corresponding states
+    def __init__(self, source, pins, states):
+        self.box = source.box
+        self.stepId = getattr(source, 'stepId', 0)
+        self.pins = pins
+        self.states = states
+
+    # ValveRun.run: sets the valves as ValveStep.run does.
+    def run(self, iter = None):
+        setStepContext(self.stepId, iter)
+        for pin, state in zip(self.pins, self.states):
+            Step.btndict[pin].config(bg = "green" if state else "gray")
+        ValveStep.setValves(self.pins, self.states)
+        Step.pause(self, 0)
+        self.checkIfCancel()
+
+    def repeatActions(self):
+        return [("pins", self.pins, self.states)]
+
+    def planEvents(self, iter = None):
+        return [(0, self.stepId, iter, ("pins", self.pins, self.states))], 0
+
+
+# PumpRun: a pump step, possibly with the cycles of following pump steps added to it, that also waits for the pauses
+# that followed it (see the time argument of PumpStep.run).
+class PumpRun(Step):
+
+    # PumpRun.__init__
+    #   Inputs:
+    #       step - the pump step to run
+    #       extra - seconds to wait after pumping
+    def __init__(self, step, extra = 0):
+        self.step = step
+        self.box = step.box
+        self.stepId = getattr(step, 'stepId', 0)
+        self.extra = extra
+
+    def run(self, iter = None):
+        self.step.run(iter = iter, time = self.extra)
+
+    def repeatActions(self):
+        return self.step.repeatActions() + ([("pause", self.extra)] if self.extra else [])
+
+    def planEvents(self, iter = None):
+        events, duration = self.step.planEvents(iter)
+        return events, duration + self.extra
+
+
+# stepNumber: the step number of an item, or of the first step of a loop.
+def stepNumber(item):
+    if isinstance(item, Loop):
+        first = [s for s in item.steps if hasattr(s, 'stepId')]
+        return str(first[0].stepId) if first else "?"
+    return str(getattr(item, 'stepId', '?'))
+
+
+# describe: names an item of a protocol for the optimizer's report.
+def describe(item):
+    if isinstance(item, Loop):
+        return "the loop at step " + stepNumber(item)
+    return "step " + stepNumber(item)
+
+
+# describeAll: names several items of a protocol for the optimizer's report.
+def describeAll(items):
+    if len(items) == 1:
+        return describe(items[0])
+    return "steps " + ", ".join([stepNumber(item) for item in items])
+
+
+# RoutineOptimizer: optimizes the items of one routine in order. Runs of items that can be described are collected in
+# a pending group (valve changes, a pause or a pump), which is written out to runSteps when something else follows.
+class RoutineOptimizer:
+
+    # RoutineOptimizer.__init__
+    #   Input:
+    #       report - list to append descriptions of the changes to
+    def __init__(self, report):
+        self.report = report
+        self.runSteps = []
+        self.known = {} # valve: state it is known to be in at this point of the routine
+        self.kind = None # kind of the pending group: "pins", "pause" or "pump"
+        self.sources = [] # steps in the pending group
+        self.pins = [] # pending valve changes, in order, the last state given to a valve winning
+        self.states = {}
+        self.runtime = 0 # pending pause
+        self.pump = None # pending pump: [first step, direction, valves, rate, cycles, extra wait]
+        self.pumpSources = []
+        self.waitSources = []
+
+    # RoutineOptimizer.optimize: returns the items to run in place of a list of items.
+    def optimize(self, items):
+        for item in items:
+            self.add(item)
+        self.flush()
+        return self.runSteps
+
+    # RoutineOptimizer.add: adds one item of the routine.
+    def add(self, item):
+        if isinstance(item, Loop):
+            self.addLoop(item)
+        elif isinstance(item, ParallelBlock):
+            for branch in item.steps:
+                if isinstance(branch, Loop):
+                    optimizeRoutine(branch, self.report)
+            self.barrier(item)
+        elif isinstance(item, (PauseRun, ValveRun)):
+            self.addActions(item, item.repeatActions())
+        elif isinstance(item, PumpRun):
+            self.addActions(item.step, item.step.repeatActions())
+            if item.extra:
+                self.addActions(item, [("pause", item.extra)])
+        else:
+            actions = item.repeatActions() if hasattr(item, 'repeatActions') else None
+            if actions is None:
+                self.barrier(item)
+            else:
+                self.addActions(item, actions)
+
+    # RoutineOptimizer.addLoop: optimizes a loop, then inlines it if it has one iteration and no longer depends on the
+    #   iteration, or replaces it with a pause if it only pauses.
+    def addLoop(self, loop):
+        optimizeRoutine(loop, self.report)
+        body = loop.runSteps
+        actions = []
+        for item in body:
+            itemActions = item.repeatActions() if hasattr(item, 'repeatActions') else None
+            if itemActions is None:
+                actions = None
+                break
+            actions += itemActions
+        if actions is not None and loop.saveIter == 1:
+            self.report.append("Inlined " + describe(loop) + ", which runs once.")
+            for item in body:
+                self.add(item)
+        elif actions is not None and not [a for a in actions if a[0] != "pause"]:
+            runtime = loop.saveIter*sum([a[1] for a in actions])
+            self.report.append("Replaced " + describe(loop) + ", which only pauses, with one " + str(runtime)
+                               + " s pause.")
+            self.addActions(loop, [("pause", runtime)])
+        else:
+            self.barrier(loop)
+
+    # RoutineOptimizer.addActions: adds the actions of a step.
+    #   Inputs:
+    #       source - the step, or a loop replaced by a pause
+    #       actions - its actions
+    def addActions(self, source, actions):
+        if actions and actions[0][0] == "pump":
+            self.addPump(source, actions[0])
+            actions = [] # the pump step waits for its own cycles
+        for action in actions:
+            if action[0] == "pause" and action[1] == 0:
+                self.report.append("Removed the zero-length pause of " + describe(source) + ".")
+                continue
+            if action[0] == "pins":
+                if self.kind != "pins":
+                    self.flush()
+                    self.kind = "pins"
+                for pin, state in zip(action[1], action[2]):
+                    if pin in self.states:
+                        self.pins.remove(pin)
+                    self.pins.append(pin)
+                    self.states[pin] = state
+                if source not in self.sources:
+                    self.sources.append(source)
+            elif action[0] == "pause" and self.kind == "pump": # a pause after the pump: waited for by the pump step
+                self.pump[5] += action[1]
+                self.waitSources.append(source)
+            elif action[0] == "pause":
+                if self.kind != "pause":
+                    self.flush()
+                    self.kind = "pause"
+                self.runtime += action[1]
+                self.sources.append(source)
+
+    # RoutineOptimizer.addPump: adds a pump, merging it into the pending pump if that runs on the same valves at the
+    #   same rate and nothing has been waited for since.
+    def addPump(self, step, action):
+        direction, valves, rate, cycles = action[1:]
+        pump = self.pump
+        if self.kind == "pump" and not pump[5] and (pump[1], pump[2], pump[3]) == (direction, valves, rate):
+            pump[4] += cycles
+            self.pumpSources.append(step)
+            return
+        self.flush()
+        self.kind = "pump"
+        self.pump = [step, direction, valves, rate, cycles, 0]
+        self.pumpSources = [step]
+        self.waitSources = []
+        for valve in valves: # the pump leaves its valves closed, but not at an exactly known time
+            self.known.pop(valve, None)
+
+    # RoutineOptimizer.barrier: adds an item that cannot be optimized; what is known about the valves is forgotten.
+    def barrier(self, item):
+        self.flush()
+        self.known = {}
+        self.runSteps.append(item)
+
+    # RoutineOptimizer.flush: writes the pending group to runSteps.
+    def flush(self):
+        if self.kind == "pins":
+            pins = [p for p in self.pins if self.known.get(p) != self.states[p]]
+            for pin in self.pins:
+                if pin not in pins:
+                    self.report.append("Removed the change of valve " + str(pin) + " to " + str(self.states[pin])
+                                       + " in " + describeAll(self.sources) + "; it is already in that state.")
+            if len(self.sources) > 1:
+                self.report.append("Combined valve " + describeAll(self.sources) + ", which run at the same time, "
+                                   "into one command.")
+            states = [self.states[p] for p in pins]
+            if pins and len(self.sources) == 1 and len(pins) == len(self.pins) and \
+                    self.sources[0].repeatActions() == [("pins", pins, states)]:
+                self.runSteps.append(self.sources[0])
+            elif pins:
+                self.runSteps.append(ValveRun(self.sources[0], pins, states))
+            for pin in pins:
+                self.known[pin] = self.states[pin]
+        elif self.kind == "pause":
+            if len(self.sources) > 1:
+                self.report.append("Merged the pauses of " + describeAll(self.sources) + " into one "
+                                   + str(self.runtime) + " s pause.")
+            source = self.sources[0]
+            if len(self.sources) == 1 and hasattr(source, 'repeatActions') and \
+                    source.repeatActions() == [("pause", self.runtime)]:
+                self.runSteps.append(source)
+            else:
+                self.runSteps.append(PauseRun(self.sources[0], self.runtime))
+        elif self.kind == "pump":
+            step, direction, valves, rate, cycles, extra = self.pump
+            if len(self.pumpSources) > 1:
+                self.report.append("Merged the pumps of " + describeAll(self.pumpSources) + " on valves "
+                                   + ", ".join([str(v) for v in valves]) + " into one " + str(cycles) + " cycle pump.")
+                step = copy.copy(step)
+                step.nCycles = Saved(cycles)
+            if self.waitSources:
+                self.report.append("Folded the pauses of " + describeAll(self.waitSources) + " into the wait of "
+                                   + describe(self.pumpSources[-1]) + ".")
+            self.runSteps.append(PumpRun(step, extra) if extra else step)
+        self.kind = None
+        self.sources = []
+        self.pins = []
+        self.states = {}
+        self.runtime = 0
+        self.pump = None
+
+
+# optimizeRoutine: sets the runSteps of a routine, and of the loops inside it, to their optimized steps.
+#   Inputs:
+#       routine - a validated protocol or loop
+#       report - list to append descriptions of the changes to
+#   Output: None
+def optimizeRoutine(routine, report):
+    routine.runSteps = RoutineOptimizer(report).optimize(routine.steps)
+    if isinstance(routine, Loop):
+        routine.repeatBody = routine.compileRepeat()
+
+
+# optimize: optimizes a protocol after it has been validated (saveEntries) and numbered (numberSteps), before it runs.
+#   Input:
+#       protocol - the protocol
+#   Output: list of descriptions of what was changed, empty if nothing was
+def optimize(protocol):
+    report = []
+    optimizeRoutine(protocol, report)
+    return report
@@ -27,10 +27,16 @@ import time
 from threading import Thread
 import threading
 import json
-from Step import Step
+try:
+    import Queue as queue #python 2.7
+except:
+    import queue #python 3
+from Step import Step, runContext
 from StepDerivatives import *
 from LabelEntry import LabelEntry
 from no_wait_Dialog import no_wait_Dialog
+from ValveLocks import ValveLockManager
+from SerialMetrics import clock
 import config
 
 
@@ -40,6 +46,7 @@ import config
 
 class Routine(object):
     connected = False # set to true after connecting. #Note: this could cause problems if multiple devices require connecting
+    runSteps = None # steps to run in place of self.steps, set by the optimizer (see ProtocolOptimizer)
 
     # This is a tuple of illegal character for step names/types. A step that attemps to load a saved step named using a
     # special character will throw an error- the special character could be part of an attempt to execute malicious code.
@@ -159,6 +166,21 @@ class Routine(object):
         self.addButtons()
         self.redraw()
 
+    # Routine.addParallelBlock: Adds a parallel block to a routine. The index of the routine steps list in which to
+    #               insert the block is supplied by the calling button.
+    #   Input:
+    #       index - the index of the routine steps list in which to insert the parallel block.
+    #   Output: None
+    def addParallelBlock(self, index):
+        if config.stopEditing:
+            no_wait_Dialog(self.master, "Error", "You cannot edit a protocol while it is running.")
+            return
+        newblock = ParallelBlock(self.routineFrame)
+        newblock.setStepImplementation(self.stepImplementation)
+        self.steps.insert(index, newblock)
+        self.addButtons()
+        self.redraw()
+
     # Routine.addButtons: adds buttons when a new step or loop is drawn.
     #   Input: None
     #   Output: None
@@ -166,6 +188,7 @@ class Routine(object):
         last = len(self.steps)
         btnRow = [Button(self.routineFrame, text="Add Step", command=lambda: self.addStep(last))]
         btnRow.append(Button(self.routineFrame, text="Add Loop", command=lambda: self.addLoop(last)))
+        btnRow.append(Button(self.routineFrame, text="Add Parallel", command=lambda: self.addParallelBlock(last)))
         if last > 0: #add a remove button to the last that has
             self.Buttons[-1].append(Button(self.routineFrame, text="Remove", command=lambda: self.remove(last - 1)))
         self.Buttons.append(btnRow)
@@ -192,6 +215,7 @@ class Routine(object):
     #   Input: None
     #   Output: None
     def saveEntries(self):
+        self.runSteps = None
         nItems = len(self.steps)
         for i, item in enumerate(self.steps):
             if i != nItems -1 or hasattr(self, 'activeLoop'): #can't be last item if routine object is a loop
@@ -246,6 +270,30 @@ class Routine(object):
             self.addButtons()
         self.resetPbox()
 
+    # Routine.usedValves: Returns the set of valves that the steps of a routine may change. Call after saveEntries.
+    #   Input:
+    #       iters - a tuple containing the number of iterations each outer loop will be iterated over.
+    #   Output: set of valve numbers
+    def usedValves(self, iters = None):
+        valves = set()
+        for item in self.steps:
+            valves |= item.usedValves(iters)
+        return valves
+
+    # Routine.numberSteps: Numbers the steps of a routine, depth first, so that records in a valve trace (see
+    # ValveTrace) can be traced back to the step that caused them.
+    #   Input:
+    #       start - the number to give the first step
+    #   Output: the number to give the step after the last step of this routine
+    def numberSteps(self, start = 1):
+        for item in self.steps:
+            if hasattr(item, 'numberSteps'):
+                start = item.numberSteps(start)
+            else:
+                item.stepId = start
+                start += 1
+        return start
+
     # Routine.checkIfHasIllegalCharacters : Checks if a string has illegal characters that could be used in malicious
     # code before eval is called on it.
     #   Input:
@@ -261,9 +309,33 @@ class Routine(object):
     #   iter - used in derived classes: a tuple containing the number of iterations each outer loop will be iterated over. The immediate outer
     #           loop is first, the second outer loop is second, and so on. This is used for recursive error checking.
     def run(self, iter = None):
-        for i in self.steps:
+        for i in self.stepsToRun():
             i.run()
 
+    # Routine.stepsToRun: returns the steps to run: the optimized steps if the routine has been optimized, otherwise
+    #   its steps.
+    def stepsToRun(self):
+        return self.steps if self.runSteps is None else self.runSteps
+
+    # Routine.planEvents: Returns the routine's steps as timed events, one after another, so that it can be run in a
+    #   separate process (see Step.planEvents and ProcessExecutor). Call after saveEntries and numberSteps.
+    #   Input:
+    #       iter - tuple of loop iterations, None if the routine is not inside a loop
+    #   Output: (list of events, seconds the routine takes), or None if an item cannot be planned or the plan would
+    #       have more than config.processPlanLimit events
+    def planEvents(self, iter = None):
+        events = []
+        offset = 0
+        for item in self.stepsToRun():
+            plan = item.planEvents(iter)
+            if plan is None:
+                return None
+            events += [(offset + event[0],) + event[1:] for event in plan[0]]
+            offset += plan[1]
+            if len(events) > config.processPlanLimit:
+                return None
+        return events, offset
+
     # Routine.disconnected: Called by event handler if an arduino is disconnected while a protocol is running.
     #   input:
     #       input - accepts input from the event handler, but is not actually used.
@@ -289,27 +361,35 @@ class ArduinoErrorProofedRoutine(Routine):
     #       returns "Error" if there is a connection problem which recursively returns to the root calling run method to
     #       stop the protocol.
     def run(self, iter = None):
-        for i in self.steps:
-            try:
-                ret = i.run(iter = iter)
-                if ret  == "Error":
-                    return "Error" #propogate up errors to calling loops/routines to stop protocol.
-            except Warning as W:
-                print("Warning!")
-                print(W.message)
-                if self.vGUI.device == "Arduino Mega":
-                    self.master.event_generate("<<connection_warning>>", when = "tail")
-                    from KATARAGUI import pumpGUI
-                    for pGUI in pumpGUI.instances:
-                        valves = pGUI.pump.valves
-                        pGUI.pump = self.device.specifyPump(int(valves[0]), int(valves[1]), int(valves[2]))
-            except Exception as E:
-                print("Error!")
-                print(E.message)
-                Protocol.pRun.event.set()
-                print(str(self.master.__class__))
-                print(self.master.event_generate("<<disconnected_error>>", when = "tail"))
-                return "Error" # stop protocol, bubbles up in first try statement above.
+        for i in self.stepsToRun():
+            if self.runItem(i, iter) == "Error":
+                return "Error" #propogate up errors to calling loops/routines to stop protocol.
+        return None
+
+    # ArduinoErrorProofedRoutine.runItem: Runs a single step or loop with the error handling described above.
+    #   Inputs:
+    #       i - the step or loop to run
+    #       iter - tuple containing the current iteration values of outer loops.
+    #   Outputs:
+    #       returns "Error" if there is a connection problem, None otherwise.
+    def runItem(self, i, iter = None):
+        try:
+            ret = i.run(iter = iter)
+            if ret  == "Error":
+                return "Error" #propogate up errors to calling loops/routines to stop protocol.
+        except Warning as W:
+            print("Warning: " + str(W))
+            if self.vGUI.device == "Arduino Mega":
+                self.master.event_generate("<<connection_warning>>", when = "tail")
+                from KATARAGUI import pumpGUI
+                for pGUI in pumpGUI.instances:
+                    valves = pGUI.pump.valveKeys
+                    pGUI.pump = self.device.specifyPump(valves[0], valves[1], valves[2])
+        except Exception as E:
+            runContext.thread.event.set() # stops this protocol; protocols on other valves keep running
+            print("Error: " + str(E))
+            self.master.event_generate("<<disconnected_error>>", when = "tail")
+            return "Error" # stop protocol, bubbles up in first try statement above.
         return None
 
 # Dialog box for prompting users what kind of step they would like to add; inherits from the Tkinter Dialog class.
@@ -348,8 +428,6 @@ class addStepDialog(Dialog):
 # a framework for editing custom protocols. They also can run non editable saved protocols that are loaded as buttons.
 class Protocol(ArduinoErrorProofedRoutine):
     running = False
-    holdFlag = False #set to true from external object when unsafe to start a protocol
-    holdErrorMessage = "" #set error message to prompt user when user tries to start a protocol when holdFlag is True
 
     # Protocol.__init__:
     #
@@ -445,14 +523,24 @@ class Protocol(ArduinoErrorProofedRoutine):
 
 
 
+    # Protocol.optimize: If config.optimizeProtocols is set, rewrites the protocol into fewer steps to run (see
+    #   ProtocolOptimizer) and prints what was changed. Call after saveEntries and numberSteps.
+    #   Inputs: None
+    #   Outputs: list of descriptions of the changes, also kept in self.optimizationReport
+    def optimize(self):
+        self.optimizationReport = []
+        if config.optimizeProtocols:
+            from ProtocolOptimizer import optimize
+            self.optimizationReport = optimize(self)
+            for change in self.optimizationReport:
+                print("Optimizer: " + change)
+        return self.optimizationReport
+
     # Protocol.run: Executes the protocol, or stops it if it is already running.
     #   Inputs:
     #       iters - a tuple containing the number of iterations each outer loop will be iterated over. The immediate outer
     #               loop is first, the second outer loop is second, and so on. This is used for recursive error checking.
     def run(self, iter=None):
-        if Protocol.holdFlag:
-            tkMessageBox.showerror("Error", self.holdErrorMessage)
-            return
         if not self.connected: #note: If the protocol uses multiple devices, this will need to be modified
             tkMessageBox.showerror("Error","Error: Not connected to the device.")
             return
@@ -471,9 +559,9 @@ class Protocol(ArduinoErrorProofedRoutine):
                     self.runbtn.config(bg ='SystemButtonFace', text = "Run Protocol")
                 except:
                     self.runbtn.config(bg='gray', text="Run Protocol")
-            Routine.pRun.event.set() #sends message to protocol running in separate thread to stop
+            self.pRun.event.set() #sends message to protocol running in separate thread to stop
+            self.pRun.release() # the cancelled thread stops without finishing, so free its valves here
             self.running = False
-            RoutineThread.protocolRunning = False
 
             if Loop.activeLoop:
                 Loop.activeLoop.currIter.config(text="")
@@ -486,15 +574,27 @@ class Protocol(ArduinoErrorProofedRoutine):
             except Exception as E:
                 tkMessageBox.showerror("Error", E.message)
                 return
+            self.numberSteps()
+            self.optimize()
+            # a running protocol or pump, which holds its valves, would change valves while they are read back
+            if self.vGUI and self.vGUI.device and not RoutineThread.protocolRunning and \
+                    not RoutineThread.valveLocks.held():
+                try:
+                    self.vGUI.syncValves() # start from the valve states the device actually has
+                except (IOError, Warning) as E:
+                    tkMessageBox.showerror("Error", str(E))
+                    return
             try:
                 #Protocols are run in a separate thread so users can continue to interact with the GUI as it runs.
-                Routine.pRun = RoutineThread(Routine.run, self, threading.current_thread(),
-                                             button = not self.writable)
+                # They run in a separate process if they can (see ProcessRoutineThread).
+                self.pRun = Routine.pRun = \
+                    ProcessRoutineThread.create(self, threading.current_thread(), button = not self.writable) or \
+                    RoutineThread(Routine.run, self, threading.current_thread(), button = not self.writable)
             except Warning as W:
                 no_wait_Dialog(self.master, message = W.message, title = "Warning")
                 print("Warning Dialog")
-            except Exception as E:
-                no_wait_Dialog(self.master, message= E.message, title = "Error")
+            except Exception as E: # e.g. a running protocol or pump holds some of this protocol's valves
+                no_wait_Dialog(self.master, message= str(E), title = "Error")
                 print("Error Dialog")
                 return
             self.running = True
@@ -502,17 +602,18 @@ class Protocol(ArduinoErrorProofedRoutine):
             if self.writable:
                 config.stopEditing = True
 
-            #pass reference to timer Widget to step Class
+            #pass reference to timer Widget to the protocol's thread, where its steps find it
             timerWidget = Label(self.controlbox, text = "Step Runtime: ")
             timerWidget.pack(side = RIGHT)
 
-            Step.timerWidget = timerWidget
-            Protocol.pRun.start()
+            self.pRun.timerWidget = timerWidget
+            self.pRun.start()
 
 # Loop : Inherits from the ArduinoErrorProofedRoutine class, and manages a list of steps, that could include other
 # loops, to be executed.
 class Loop(ArduinoErrorProofedRoutine):
     activeLoop = None #reference active loop so that if a protocol is cancelled while a loop is running, we can remove "iterations:" label.
+    repeatOnDevice = True # send loops that do not depend on i to the device as one repeat command (see compileRepeat)
 
     # Loop.__init__
     # Input:
@@ -547,6 +648,7 @@ class Loop(ArduinoErrorProofedRoutine):
         saveIter = self.iterations.get()
         if saveIter == "":
             raise ValueError("Error: Unfilled number of iterations in loop.")
+        self.runSteps = None
         try:
             self.saveIter = int(saveIter)
         except:
@@ -579,6 +681,23 @@ class Loop(ArduinoErrorProofedRoutine):
                     item.box.config(bg='yellow')
                 # in anycase, raise the error again.
                 raise E
+        self.repeatBody = self.compileRepeat()
+
+    # Loop.compileRepeat: If every item in the loop is a step that does not depend on the loop iteration, and can be
+    #   run by the device (valve, pause and pump steps), returns the actions of one iteration so that the whole loop
+    #   can be sent to the device as one repeat command (see ValveController.runRepeat). Call after saveEntries.
+    #   Input: None
+    #   Output: list of actions, or None if the loop must run step by step.
+    def compileRepeat(self):
+        if not Loop.repeatOnDevice:
+            return None
+        actions = []
+        for item in self.stepsToRun():
+            itemActions = item.repeatActions() if hasattr(item, 'repeatActions') else None # loops and blocks run here
+            if itemActions is None:
+                return None
+            actions += itemActions
+        return actions
 
     # Loop.save: Called recursively when Protocol.save is called. Returns information necessary to reconstruct loop to calling object.
     #   Inputs:
@@ -616,6 +735,32 @@ class Loop(ArduinoErrorProofedRoutine):
         super(Loop, self).load(savedLoop[2:])
 
 
+    # Loop.usedValves: Returns the set of valves the loop may change over all of its iterations.
+    #   Input:
+    #       iters - a tuple containing the number of iterations each outer loop will be iterated over.
+    #   Output: set of valve numbers
+    def usedValves(self, iters = None):
+        if iters:
+            _iters = tuple([self.saveIter]+list(iters))
+        else:
+            _iters = (self.saveIter,)
+        return super(Loop, self).usedValves(_iters)
+
+    # Loop.planEvents: Returns every iteration of the loop as timed events (see Routine.planEvents).
+    #   Input:
+    #       iter - tuple of the iterations of outer loops, None if the loop is not inside another
+    #   Output: (list of events, seconds the loop takes), or None if it cannot be planned
+    def planEvents(self, iter = None):
+        events = []
+        offset = 0
+        for i in range(1, self.saveIter + 1):
+            plan = super(Loop, self).planEvents((i,) + iter if iter else (i,))
+            if plan is None or len(events) + len(plan[0]) > config.processPlanLimit:
+                return None
+            events += [(offset + event[0],) + event[1:] for event in plan[0]]
+            offset += plan[1]
+        return events, offset
+
     # Loop.run - executes the loop
     # Inputs:
     #   iter - a tuple containing the current iteration values of outer loops. The current loop is at bin 0, the first
@@ -625,6 +770,10 @@ class Loop(ArduinoErrorProofedRoutine):
     #       cancel the run.
     def run(self, iter = None):
         Loop.activeLoop = self #this marker allows steps to clean up iteration counter if the protocol is canceled
+        if getattr(self, 'repeatBody', None) and self.runOnDevice():
+            self.currIter.config(text="")
+            Loop.activeLoop = None
+            return None
         for i in range(1,self.saveIter+1):
             self.currIter.config(text= "Iteration: " + str(i))
             if not iter:
@@ -637,9 +786,203 @@ class Loop(ArduinoErrorProofedRoutine):
         self.currIter.config(text="")
         Loop.activeLoop = None
 
+    # Loop.runOnDevice - sends the loop to the device as one repeat command and waits for the device to finish it,
+    #   stopping it if the protocol is cancelled.
+    # Inputs: None
+    # Outputs:
+    #       Returns False if the device cannot run the loop now, for example while it runs another loop, in which case
+    #       the loop should be run step by step; True once the device has finished.
+    def runOnDevice(self):
+        device = self.vGUI.device if self.vGUI else None
+        duration = device.runRepeat(self.repeatBody, self.saveIter) if device else None
+        if duration is None:
+            return False
+        routine = runContext.thread
+        self.currIter.config(text= "Iterations: " + str(self.saveIter) + " (on device)")
+        start = routine.stepStart(duration)
+        while clock() - start < duration:
+            if routine.timerWidget:
+                routine.timerWidget.config(text = "Step Runtime (s): " + str(int(clock() - start)))
+            routine.event.wait(min(0.05, max(0, duration - (clock() - start))))
+            if routine.event.isSet():
+                device.stopRepeat()
+                for action in self.repeatBody:
+                    if action[0] == "pump":
+                        device.specifyPump(*action[2]).stop()
+                self.currIter.config(text="")
+                routine.mainthread.join()
+        routine.stepEnded(start + duration)
+        if routine.timerWidget:
+            routine.timerWidget.config(text = '')
+        for action in self.repeatBody: # show the states the device left the valves in
+            if action[0] == "pins":
+                for valve, state in zip(action[1], action[2]):
+                    Step.btndict[valve].config(bg = "green" if state else "gray")
+            elif action[0] == "pump":
+                for valve in action[2]:
+                    Step.btndict[valve].config(bg = "gray")
+        return True
+
+# ParallelBlock: Inherits from the ArduinoErrorProofedRoutine class. Each item in a parallel block (a step or a loop) is a
+# branch, and the branches run concurrently in their own threads. Branches may not share valves; this is checked when
+# the protocol is validated. The block finishes when its slowest branch does.
+class ParallelBlock(ArduinoErrorProofedRoutine):
+
+    # ParallelBlock.__init__
+    # Input:
+    #   master - a Tkinter frame that the parallel block will be nested in
+    # Output:
+    #   None
+    def __init__(self, master):
+        self.box = LabelFrame(master, text="Parallel Block")
+        Label(self.box, text="Each step or loop below runs at the same time.").grid(row=0, column=0, sticky=W)
+        self.steptype = "ParallelBlock" #alows parallel blocks to be saved and loaded as if steps.
+        super(ParallelBlock, self).__init__(self.box)
+
+    # ParallelBlock.draw:
+    #   Inputs:
+    #       _row - the row of the Tkinter parent frame in which the block will be drawn with the grid manager
+    #       _col - the column of the Tkinter parent frame in which the block will be drawn with the grid manager
+    #   Output: None
+    def draw(self, _row, _col):
+        self.box.grid(row=_row, column=_col, sticky=W)
+        super(ParallelBlock, self).draw(1, 0)
+
+    # ParallelBlock.saveEntries: Called before running or saving a protocol. Saves the entries of every branch, then
+    #   checks that no two branches use the same valve.
+    # Input:
+    #   iters - a tuple containing the number of iterations each outer loop will be iterated over. The immediate outer
+    #           loop is first, the second outer loop is second, and so on. This is used for recursive error checking.
+    # Output: None, but raises a ValueError if branches conflict.
+    def saveEntries(self, iters = None):
+        if len(self.steps) < 2:
+            raise Exception("A parallel block needs at least two steps or loops to run at the same time.")
+        self.runSteps = None
+        for item in self.steps:
+            item.last = False # a branch cannot pump indefinitely; the block would never finish.
+            try:
+                item.saveEntries(iters = iters)
+                if item.box.cget('bg') == "yellow":
+                    try:
+                        item.box.config(bg = 'SystemButtonFace')
+                    except:
+                        item.box.config(bg = 'gray')
+            except Exception as E:
+                if not hasattr(item, 'activeLoop'): # loops and blocks color their own failing items
+                    item.box.config(bg='yellow')
+                raise E
+
+        branchValves = [item.usedValves(iters) for item in self.steps]
+        for j, valves in enumerate(branchValves):
+            for k in range(j):
+                shared = valves & branchValves[k]
+                if shared:
+                    for item in (self.steps[j], self.steps[k]):
+                        item.box.config(bg='yellow')
+                    raise ValueError("Branches of a parallel block cannot use the same valves. Valves "
+                                     + ", ".join([str(v) for v in sorted(shared)]) + " are used by more than one branch.")
+
+    # ParallelBlock.save: Called recursively when Protocol.save is called. Returns information necessary to reconstruct
+    #   the block to the calling object.
+    #   Inputs:
+    #       None
+    #   Outputs:
+    #       savedBlock - A list of information necessary to reconstruct the block to be saved in a JSON file.
+    def save(self):
+        savedBlock = super(ParallelBlock, self).save()
+        if hasattr(self.stepImplementation, '__iter__'): # if more than one step can be used in the protocol
+            stepImp = [s.__name__ for s in self.stepImplementation]
+            savedBlock = ["ParallelBlock", stepImp] + savedBlock
+        else: #Otherwise only one steptype is used in a protocol
+            savedBlock = ["ParallelBlock", self.stepImplementation.__name__] + savedBlock
+        return savedBlock
+
+    # ParallelBlock.load: Called recursively when Protocol.loadProtocol is called. Reconstructs a block saved by
+    #   ParallelBlock.save
+    #   Inputs:
+    #       savedBlock - list of information to reconstruct saved block, generated by ParallelBlock.save and
+    #           retrieved from a JSON file.
+    #   Outputs:
+    #       None
+    def load(self, savedBlock):
+        stepImp = savedBlock[0]
+        self.stepImplementation = []
+        if type(stepImp) == list:
+            for s in stepImp:
+                self.checkIfHasIllegalCharacters(s)
+                self.stepImplementation.append(eval(s))
+        else:
+            self.checkIfHasIllegalCharacters(stepImp)
+            self.stepImplementation = eval(stepImp)
+        super(ParallelBlock, self).load(savedBlock[1:])
+
+    # ParallelBlock.planEvents: Returns the events of every branch, merged in time order. The block takes as long as
+    #   its slowest branch (see Routine.planEvents).
+    #   Input:
+    #       iter - tuple of the iterations of outer loops, None if the block is not inside a loop
+    #   Output: (list of events, seconds the block takes), or None if a branch cannot be planned
+    def planEvents(self, iter = None):
+        events = []
+        duration = 0
+        for item in self.steps:
+            plan = item.planEvents(iter)
+            if plan is None:
+                return None
+            events += plan[0]
+            duration = max(duration, plan[1])
+        events.sort(key = lambda event: event[0]) # stable, so events at the same time keep their branch order
+        return events, duration
+
+    # ParallelBlock.run - starts every branch in its own thread and waits for all of them to finish.
+    # Inputs:
+    #   iter - a tuple containing the current iteration values of outer loops. The current loop is at bin 0, the first
+    #       outer Loop is at bin 1, ect.
+    # Outputs:
+    #       Returns "Error" if any branch fails. This propogates up through the recursive structure to cancel the run.
+    def run(self, iter = None):
+        results = [None]*len(self.steps)
+
+        routine = runContext.thread
+
+        # runBranch is the target of each branch thread; it records whether its branch failed.
+        def runBranch(index, item):
+            runContext.thread = routine
+            try:
+                results[index] = self.runItem(item, iter)
+            except Exception as E: # e.g. the error handling in runItem failed; the block must not report success
+                results[index] = "Error"
+                routine.event.set() # stops the other branches
+                print("Error: " + str(E))
+
+        branches = []
+        for index, item in enumerate(self.steps):
+            branch = Thread(target=runBranch, args=(index, item))
+            branch.setDaemon(True)
+            branches.append(branch)
+            branch.start()
+        for branch in branches:
+            while branch.is_alive():
+                branch.join(0.01)
+                if routine.event.isSet():
+                    # Either a branch failed and signalled the others to stop, or the user cancelled the run. A failing
+                    # branch returns right after setting the event; cancelled branches stop in Step.checkIfCancel.
+                    for other in branches:
+                        other.join(0.05)
+                    if "Error" in results:
+                        return "Error"
+                    routine.mainthread.join()
+        if "Error" in results:
+            return "Error"
+        return None
+
 # RoutineThread: class to run protocols in their own thread. This allows the program to run a protocl and manage the GUI at the same time
+# Protocols that use different valves may run at the same time, sharing the serial link: each RoutineThread holds the
+# valves its protocol uses in RoutineThread.valveLocks from when it is created until it finishes or is cancelled.
 class RoutineThread(Thread):
-    protocolRunning = False
+    protocolRunning = False # True while any protocol is running
+    running = set() # RoutineThreads that have not finished or been cancelled
+    runningLock = threading.Lock()
+    valveLocks = ValveLockManager()
     # RoutineThread.__init__
     #   Inputs:
     #       pRun - function or method to call for run, passed by calling routine object
@@ -648,12 +991,15 @@ class RoutineThread(Thread):
     #                   will send this a flag. Step objects check for flags in their run method. If they find one, they
     #                   call join on mainthread to end the routinethread.
     #       button - a boolean: true if the protocol is inside a custom button, false if in editable protocol panel.
+    #       timerWidget - Tkinter label showing the runtime of the current step; may also be set before start.
     #   Outputs:
-    #       None
-    def __init__(self, pRun, _routineObject, mainthread, button = False): #, name = None):
-        if RoutineThread.protocolRunning:
-            raise Exception("There is already a protocol running! Please either wait for it to finish or cancel it before running another protocol.")
-        else:
+    #       None, but raises a ValueError if the protocol uses valves held by a running protocol or pump. Call after
+    #       the protocol's saveEntries, which its valve set is computed from.
+    def __init__(self, pRun, _routineObject, mainthread, button = False, timerWidget = None): #, name = None):
+        self.valves = _routineObject.usedValves()
+        RoutineThread.valveLocks.acquire(self, self.valves, "protocol " + getattr(_routineObject, 'name', ''))
+        with RoutineThread.runningLock:
+            RoutineThread.running.add(self)
             RoutineThread.protocolRunning = True
         Thread.__init__(self)
         self.routineObject = _routineObject
@@ -661,15 +1007,50 @@ class RoutineThread(Thread):
         self.setDaemon(True)
         self.event = threading.Event()
         self.mainthread = mainthread
-        Step.event = self.event
-        Step.mainthread = self.mainthread
-        Loop.mainthread = self.mainthread
+        self.timerWidget = timerWidget
         self.button = button
+        self.done = threading.Event() # set when the routine has finished and the thread has cleaned up
+        self.onDone = None # function called from this thread after done is set, e.g. by a RunQueue
+        self.startAt = None # clock() time the protocol's schedule starts from instead of when its first step runs
+        self.deadline = None # clock() time at which the last timed step is scheduled to end
+
+    # RoutineThread.stepStart: returns the clock() time a timed step starts from: startAt until the first step that
+    #   takes time has used it, so that instantaneous steps before it take no scheduled time, then the current time.
+    #   Input:
+    #       runtime - seconds the step takes
+    #   Output: clock() time
+    def stepStart(self, runtime):
+        with RoutineThread.runningLock:
+            start = self.startAt
+            if runtime > 0:
+                self.startAt = None
+        return clock() if start is None else start
+
+    # RoutineThread.stepEnded: records the clock() time a timed step was scheduled to end at (see RunQueue).
+    #   Input:
+    #       end - clock() time
+    #   Output: None
+    def stepEnded(self, end):
+        with RoutineThread.runningLock:
+            self.deadline = end if self.deadline is None else max(self.deadline, end)
+
+    # RoutineThread.release: frees this protocol's valves. Called when the thread finishes and when the protocol is
+    #   cancelled, since a cancelled thread stops without finishing (see Step.checkIfCancel); calling it twice is safe.
+    #   Inputs: None
+    #   Outputs: None
+    def release(self):
+        RoutineThread.valveLocks.release(self)
+        with RoutineThread.runningLock:
+            RoutineThread.running.discard(self)
+            RoutineThread.protocolRunning = bool(RoutineThread.running)
+        if getattr(self.routineObject, 'writable', False):
+            config.stopEditing = False
 
     # RoutineThread.run: Start a RoutineThread
     #   Inputs: None
     #   Outputs: None
     def run(self):
+        runContext.thread = self
         try:
             self.pRun(self.routineObject)
             print("Running")
@@ -678,13 +1059,360 @@ class RoutineThread(Thread):
             print(E.message)
         finally:
             print("Finally")
-            config.stopEditing = False
-            RoutineThread.protocolRunning = False
+            self.release()
             try:
                 self.routineObject.runbtn.config(bg='SystemButtonFace', text = self.routineObject.name)
             except:
                 self.routineObject.runbtn.config(bg='gray', text=self.routineObject.name)
             self.routineObject.running = False
+            self.done.set()
+            if self.onDone:
+                self.onDone()
+
+
+# ProcessRoutineThread: runs a protocol in a worker process (see ProcessExecutor) and follows it from a thread of the
+# GUI, showing the running step, loop iterations, step runtime and valve states from the worker's status block. The
+# worker owns the serial port while it runs, so the protocol holds every valve of the device until the port is back.
+class ProcessRoutineThread(RoutineThread):
+
+    # ProcessRoutineThread.create: Returns a thread that runs a protocol in a worker process, or None if the protocol
+    #   should run in a RoutineThread instead: if config.runInProcess is off, the device cannot hand over its port
+    #   (e.g. several boards), a pump or another protocol is using the device, or the protocol cannot be planned.
+    #   Inputs:
+    #       protocol - the Protocol, after saveEntries and numberSteps
+    #       mainthread - reference to the main thread (see RoutineThread.__init__)
+    #       button - True if the protocol is inside a custom button
+    #   Output: ProcessRoutineThread or None
+    @staticmethod
+    def create(protocol, mainthread, button = False):
+        device = protocol.vGUI.device if protocol.vGUI else None
+        if not config.runInProcess or not hasattr(device, 'releasePort') or RoutineThread.valveLocks.held():
+            return None
+        plan = protocol.planEvents()
+        if plan is None:
+            print("The protocol cannot be compiled to run in a separate process; running it in a thread.")
+            return None
+        for offset, step, iters, action in plan[0]:
+            valves = action[1] if action[0] == "pins" else action[2] if action[0] == "pump" else []
+            if [v for v in valves if v not in device.pinStates]:
+                return None
+        from ProcessExecutor import ProcessExecutor
+        return ProcessRoutineThread(protocol, mainthread, ProcessExecutor(device, plan[0], plan[1]), button)
+
+    # ProcessRoutineThread.__init__
+    #   Inputs:
+    #       _routineObject - the Protocol to run
+    #       mainthread - reference to the main thread (see RoutineThread.__init__)
+    #       executor - ProcessExecutor holding the compiled protocol
+    #       button - True if the protocol is inside a custom button
+    #       timerWidget - Tkinter label showing the runtime of the current step; may also be set before start.
+    #   Outputs: None, but raises a ValueError if a valve of the device is in use
+    def __init__(self, _routineObject, mainthread, executor, button = False, timerWidget = None):
+        self.finished = False
+        RoutineThread.__init__(self, None, _routineObject, mainthread, button, timerWidget)
+        try:
+            RoutineThread.valveLocks.acquire(self, executor.device.pinStates, "protocol " +
+                                             getattr(_routineObject, 'name', ''))
+        except ValueError:
+            self.finished = True
+            self.release()
+            raise
+        self.pRun = self.follow
+        self.executor = executor
+
+    # ProcessRoutineThread.release: frees the device's valves once the worker has exited and the port is back. Until
+    #   then, cancelling the protocol only stops it (see Protocol.run).
+    #   Inputs: None
+    #   Outputs: None
+    def release(self):
+        if self.finished:
+            RoutineThread.release(self)
+
+    # ProcessRoutineThread.follow: Starts the worker and shows its progress until it exits, then takes the port back.
+    #   Called by RoutineThread.run.
+    #   Input:
+    #       routine - the Protocol being run
+    #   Output: None
+    def follow(self, routine):
+        steps = {} # step by number
+        loops = {} # loops enclosing each step by step number, the innermost first
+        self.indexSteps(routine, [], steps, loops)
+        shown = {"step": None, "loops": [], "pins": {}}
+        try:
+            self.executor.start()
+        except Exception as E:
+            print("The protocol process could not be started: " + str(E))
+            self.finished = True
+            routine.master.event_generate("<<disconnected_error>>", when = "tail")
+            return
+        error = None
+        status = None
+        try:
+            while not self.executor.wait(0.05):
+                if self.event.isSet():
+                    self.executor.stop()
+                    break
+                self.show(self.executor.status.read(), steps, loops, shown)
+        except Exception as E:
+            error = str(E)
+            self.executor.stop()
+        try:
+            status = self.executor.finish()
+        except Exception as E: # the port could not be taken back
+            error = error or str(E)
+        finally:
+            if shown["step"]:
+                self.resetBox(shown["step"].box)
+            for loop in shown["loops"]:
+                loop.currIter.config(text = "")
+            Loop.activeLoop = None
+            if self.timerWidget:
+                self.timerWidget.config(text = "")
+            self.finished = True
+        if status:
+            shown["step"], shown["loops"] = None, []
+            self.show(status, {}, {}, shown)
+        error = error or self.executor.error
+        if error:
+            print("Error!")
+            print(error)
+            routine.master.event_generate("<<disconnected_error>>", when = "tail")
+
+    # ProcessRoutineThread.indexSteps: finds the steps of a routine by number, and the loops each is in.
+    #   Inputs:
+    #       routine - routine to index
+    #       enclosing - loops the routine is in, the innermost first
+    #       steps - dictionary to add step by number to
+    #       loops - dictionary to add enclosing loops by step number to
+    #   Output: None
+    def indexSteps(self, routine, enclosing, steps, loops):
+        for item in routine.stepsToRun():
+            if isinstance(item, Routine):
+                self.indexSteps(item, [item] + enclosing if isinstance(item, Loop) else enclosing, steps, loops)
+            else:
+                steps[item.stepId] = item
+                loops[item.stepId] = enclosing
+
+    # ProcessRoutineThread.show: shows a status read from the worker: highlights the running step, labels the loops
+    #   it is in with their iterations, updates the step runtime and colors the valves whose state changed.
+    #   Inputs:
+    #       status - status read from the status block (see StatusBlock.read)
+    #       steps - step by number
+    #       loops - enclosing loops by step number
+    #       shown - what is shown: the highlighted step, the labelled loops and the valve states
+    #   Output: None
+    def show(self, status, steps, loops, shown):
+        step = steps.get(status["step"])
+        if step is not shown["step"]:
+            if shown["step"]:
+                self.resetBox(shown["step"].box)
+            if step:
+                step.box.config(bg = 'green')
+            shown["step"] = step
+            for loop in shown["loops"]:
+                loop.currIter.config(text = "")
+            shown["loops"] = loops.get(status["step"], [])
+            Loop.activeLoop = shown["loops"][0] if shown["loops"] else None
+        for loop, i in zip(shown["loops"], status["iters"]):
+            loop.currIter.config(text = "Iteration: " + str(i))
+        if step and self.timerWidget:
+            self.timerWidget.config(text = "Step Runtime (s): " + str(int(time.time() - status["stepStart"])))
+        colors = ("gray", "green", "Blue")
+        for pin in self.executor.device.pinStates:
+            pinState = status["pins"][pin]
+            if shown["pins"].get(pin) != pinState:
+                Step.btndict[pin].config(bg = colors[pinState])
+                shown["pins"][pin] = pinState
+
+    # ProcessRoutineThread.resetBox: returns a step's box to its color when not running.
+    def resetBox(self, box):
+        try:
+            box.config(bg = 'SystemButtonFace')
+        except:
+            box.config(bg = 'gray')
+
+
+# RunQueue: runs queued protocols one after another. Each protocol is validated when it is queued, while the protocol
+# before it may still be running, so that the next one starts as soon as the previous one finishes. The queue can be
+# paused (the running protocol finishes, the next does not start), reordered, and queued protocols can be removed.
+class RunQueue:
+    pollInterval = 10 # milliseconds between the GUI thread's calls to runGUICalls
+
+    # RunQueue.__init__
+    #   Inputs:
+    #       mainthread - the GUI thread, passed to each RoutineThread (see RoutineThread.__init__)
+    #       onChange - function called from the GUI thread whenever the queue changes
+    def __init__(self, mainthread, onChange = None):
+        self.mainthread = mainthread
+        self.onChange = onChange
+        self.items = [] # protocols waiting to run, in order
+        self.current = None # the protocol running from the queue
+        self.paused = False
+        self.condition = threading.Condition()
+        self.worker = None
+        self.guiCalls = queue.Queue() # functions the queue's thread leaves for the GUI thread, see runGUICalls
+
+    # RunQueue.enqueue: validates a protocol and adds it to the end of the queue.
+    #   Input:
+    #       protocol - the Protocol to run
+    #   Output: None, but raises an error if the protocol cannot be run
+    def enqueue(self, protocol):
+        if not protocol.connected:
+            raise IOError("Error: Not connected to the device.")
+        if not protocol.steps:
+            raise ValueError("There are no steps in this protocol!")
+        with self.condition:
+            if protocol in self.items or protocol is self.current or protocol.running:
+                raise ValueError("This protocol is already running or queued.")
+        protocol.saveEntries()
+        protocol.numberSteps()
+        protocol.optimize()
+        with self.condition:
+            self.items.append(protocol)
+            self.condition.notify()
+            if not self.worker or not self.worker.is_alive():
+                self.worker = Thread(target = self._work)
+                self.worker.setDaemon(True)
+                self.worker.start()
+        self._changed()
+
+    # RunQueue.pause: stops the queue from starting further protocols. The running protocol finishes.
+    def pause(self):
+        with self.condition:
+            self.paused = True
+        self._changed()
+
+    # RunQueue.resume: lets the queue start protocols again.
+    def resume(self):
+        with self.condition:
+            self.paused = False
+            self.condition.notify()
+        self._changed()
+
+    # RunQueue.move: moves a queued protocol to another position.
+    #   Inputs:
+    #       index - current position in the queue
+    #       newIndex - position to move it to
+    def move(self, index, newIndex):
+        with self.condition:
+            if not 0 <= index < len(self.items):
+                return
+            newIndex = max(0, min(newIndex, len(self.items) - 1))
+            self.items.insert(newIndex, self.items.pop(index))
+        self._changed()
+
+    # RunQueue.remove: removes a protocol from the queue before it starts.
+    #   Input:
+    #       index - position in the queue
+    def remove(self, index):
+        with self.condition:
+            if 0 <= index < len(self.items):
+                self.items.pop(index)
+        self._changed()
+
+    # RunQueue.cancelCurrent: cancels the running protocol the same way its Cancel Run button does. The queue goes on to
+    #   the next protocol unless it is paused. Call from the GUI thread.
+    def cancelCurrent(self):
+        current = self.current
+        if current and current.running:
+            current.run() # Protocol.run stops a running protocol
+
+    # RunQueue.runGUICalls: calls the functions the queue's thread has left for the GUI thread, which must call this
+    #   every pollInterval milliseconds: Tkinter is not thread safe, so the queue's thread never touches widgets.
+    def runGUICalls(self):
+        while True:
+            try:
+                function = self.guiCalls.get_nowait()
+            except queue.Empty:
+                return
+            function()
+
+    # RunQueue._changed: calls onChange, if set. Call from the GUI thread.
+    def _changed(self):
+        if self.onChange:
+            self.onChange()
+
+    # RunQueue._notify: wakes the queue's thread. Called when a protocol finishes and when valves are released.
+    def _notify(self):
+        with self.condition:
+            self.condition.notify()
+
+    # RunQueue._start: shows a protocol as running and starts its thread. Called on the GUI thread (see runGUICalls).
+    #   Inputs:
+    #       protocol - the Protocol to run
+    #       thread - its RoutineThread
+    def _start(self, protocol, thread):
+        if thread.event.isSet(): # cancelled before it started
+            return
+        try:
+            protocol.runbtn.config(bg = 'red', text = "Cancel Run")
+            thread.timerWidget = Label(protocol.controlbox)
+            thread.start()
+        except Exception as E:
+            protocol.running = False
+            thread.event.set()
+            thread.release() # wakes the queue's thread, which goes on to the next protocol
+            tkMessageBox.showerror("Error", "Could not run " + protocol.name + ": " + str(E))
+        self._changed()
+
+    # RunQueue._drop: reports a protocol that cannot be run, after it has been taken off the queue. Called on the GUI
+    #   thread (see runGUICalls).
+    #   Inputs:
+    #       protocol - the Protocol
+    #       error - the error it raised
+    def _drop(self, protocol, error):
+        self._changed()
+        tkMessageBox.showerror("Error", "Could not run " + protocol.name + ": " + str(error))
+
+    # RunQueue._work: target of the queue's thread. Starts each protocol as soon as the previous one has finished and
+    #   no protocol started by hand holds any of its valves. The thread sleeps until a protocol is queued, the queue is
+    #   resumed, the running protocol finishes or is cancelled, or valves are released. A protocol that follows the
+    #   previous one without a wait starts its schedule at the previous one's final deadline, so that the time taken to
+    #   hand over does not delay its steps.
+    def _work(self):
+        RoutineThread.valveLocks.addListener(self._notify)
+        deadline = None # final deadline of the protocol that just finished, None if the queue has waited since
+        while True:
+            with self.condition:
+                while not self.items or self.paused:
+                    deadline = None
+                    self.condition.wait()
+                protocol = self.items.pop(0)
+                self.current = protocol
+                try:
+                    protocol.usedValves() # raises if the protocol cannot be run at all
+                except Exception as E:
+                    self.current = None
+                    deadline = None
+                    self.guiCalls.put(lambda protocol = protocol, E = E: self._drop(protocol, E))
+                    continue
+                try:
+                    thread = RoutineThread(Routine.run, protocol, self.mainthread, button = not protocol.writable)
+                except ValueError: # a protocol started by hand holds some of its valves; try again once they are freed
+                    self.items.insert(0, protocol)
+                    self.current = None
+                    deadline = None
+                    self.condition.wait()
+                    continue
+                except Exception as E:
+                    self.current = None
+                    deadline = None
+                    self.guiCalls.put(lambda protocol = protocol, E = E: self._drop(protocol, E))
+                    continue
+                thread.onDone = self._notify
+                thread.startAt = deadline
+                protocol.pRun = Routine.pRun = thread
+                protocol.running = True
+            if protocol.writable:
+                config.stopEditing = True
+            self.guiCalls.put(lambda protocol = protocol, thread = thread: self._start(protocol, thread))
+            with self.condition:
+                while not thread.done.isSet() and not thread.event.isSet():
+                    self.condition.wait()
+                # a cancelled thread stops without finishing (see Step.checkIfCancel)
+                deadline = thread.deadline if not thread.event.isSet() else None
+                self.current = None
+            self.guiCalls.put(self._changed)
 
 # ProtocolButtonPanel: User interface for loading saved protocols as custom buttons. Users can load single buttons, save
 #                       Panels of buttons, and load panels of buttons.
@@ -702,6 +1430,9 @@ class ProtocolButtonPanel:
         self.buttons = [] #list of references to buttons
         self.protocols = [] #corresponding list of references to protocols
         self.master = master
+        self.queue = RunQueue(threading.current_thread(), self.refreshQueue)
+        self.queueRuns = IntVar() # if checked, clicking a button queues its protocol instead of running it
+        self.pollQueue()
 
     #ProtocolButtonPanel.draw: draws ProtocolButtonPanel
     #   Inputs:
@@ -713,10 +1444,97 @@ class ProtocolButtonPanel:
         self.controlButtons = LabelFrame(self.mainframe)
         Button(self.controlButtons, text="Load Buttons", command=self.load).pack(side=LEFT)
         Button(self.controlButtons, text="Save Panel", command=self.saveButtonPanel).pack(side = LEFT)
+        Checkbutton(self.controlButtons, variable = self.queueRuns, text = "Queue Runs").pack(side = LEFT)
         self.customButtonFrame.pack()
         self.controlButtons.pack()
+        self.drawQueue()
         self.mainframe.grid(row = row, column = col, sticky = W)
 
+    #ProtocolButtonPanel.drawQueue: draws the list of queued protocols and the buttons that manage the queue.
+    #   Inputs:
+    #       None
+    #   Outputs:
+    #       None
+    def drawQueue(self):
+        self.queueFrame = LabelFrame(self.mainframe, text = "Run Queue")
+        self.queueList = Listbox(self.queueFrame, height = 4, width = 40)
+        self.queueList.pack(side = LEFT)
+        queueButtons = Frame(self.queueFrame)
+        self.pauseBtn = Button(queueButtons, text = "Pause", command = self.pauseQueue)
+        self.pauseBtn.grid(row = 0, column = 0, sticky = W+E)
+        Button(queueButtons, text = "Up", command = lambda: self.moveQueued(-1)).grid(row = 0, column = 1, sticky = W+E)
+        Button(queueButtons, text = "Down", command = lambda: self.moveQueued(1)).grid(row = 1, column = 1, sticky = W+E)
+        Button(queueButtons, text = "Remove", command = self.removeQueued).grid(row = 1, column = 0, sticky = W+E)
+        Button(queueButtons, text = "Cancel Running", command = self.queue.cancelCurrent).grid(row = 2, column = 0,
+                                                                                             columnspan = 2)
+        queueButtons.pack(side = LEFT)
+        self.queueFrame.pack()
+
+    #ProtocolButtonPanel.runOrQueue: called by custom buttons. Queues the button's protocol if "Queue Runs" is checked,
+    #   otherwise runs it (or cancels it if it is running).
+    #   Inputs:
+    #       protocol - the button's protocol
+    #   Outputs:
+    #       None
+    def runOrQueue(self, protocol):
+        if self.queueRuns.get() and not protocol.running:
+            try:
+                self.queue.enqueue(protocol)
+            except Exception as E:
+                tkMessageBox.showerror("Error", str(E))
+        else:
+            protocol.run()
+
+    #ProtocolButtonPanel.pollQueue: carries out the run queue's calls for the GUI thread (see RunQueue.runGUICalls)
+    #   and checks again after RunQueue.pollInterval milliseconds.
+    def pollQueue(self):
+        self.queue.runGUICalls()
+        self.mainframe.after(RunQueue.pollInterval, self.pollQueue)
+
+    #ProtocolButtonPanel.refreshQueue: redraws the list of queued protocols.
+    #   Inputs:
+    #       event - passed by Tkinter, not used
+    #   Outputs:
+    #       None
+    def refreshQueue(self, event = None):
+        self.queueList.delete(0, END)
+        current = self.queue.current
+        if current:
+            self.queueList.insert(END, "Running: " + current.name)
+        for protocol in list(self.queue.items):
+            self.queueList.insert(END, protocol.name)
+        self.pauseBtn.config(text = "Resume" if self.queue.paused else "Pause")
+
+    #ProtocolButtonPanel.selectedQueued: returns the queue position of the protocol selected in the list, or None if
+    #   nothing, or the running protocol, is selected.
+    def selectedQueued(self):
+        selection = self.queueList.curselection()
+        if not selection:
+            return None
+        index = int(selection[0]) - (1 if self.queue.current else 0)
+        return index if index >= 0 else None
+
+    #ProtocolButtonPanel.pauseQueue: pauses or resumes the run queue.
+    def pauseQueue(self):
+        if self.queue.paused:
+            self.queue.resume()
+        else:
+            self.queue.pause()
+
+    #ProtocolButtonPanel.moveQueued: moves the selected protocol up (-1) or down (1) in the queue.
+    def moveQueued(self, step):
+        index = self.selectedQueued()
+        if index is not None:
+            self.queue.move(index, index + step)
+            self.refreshQueue()
+            self.queueList.selection_set(index + step + (1 if self.queue.current else 0))
+
+    #ProtocolButtonPanel.removeQueued: removes the selected protocol from the queue.
+    def removeQueued(self):
+        index = self.selectedQueued()
+        if index is not None:
+            self.queue.remove(index)
+
     #ProtocolButtonPanel.load: load a saved protocol as a button- called by load button.
     #   Inputs:
     #       None
@@ -747,17 +1565,23 @@ class ProtocolButtonPanel:
             else:
                 tkMessageBox.showerror("Error","Error: This file is not a saved Protocol")
 
-    # ProtocolButtonPanel.addButton: helper function to load- adds button that calls loaded protocol
+    # ProtocolButtonPanel.addButton: helper function to load- adds button that calls loaded protocol. A button with the
+    # same name as an existing one replaces it, so reloading a panel does not pile up protocols.
     #   Inputs:
     #       Proc - JSON decoded list object specifying saved protocol
     #       name - name of button to be displayed in button.
     #   Outputs:
     #       None
     def addButton(self, Proc, name):
+        for i, prot in enumerate(self.protocols):
+            if prot.name == name:
+                self.buttons.pop(i).destroy()
+                self.protocols.pop(i).box.destroy()
+                break
         newproc = Protocol(self.master, writable=False)
         newproc.setName(name)
         newproc.load(Proc)
-        newButton = Button(self.customButtonFrame, text = name, command = newproc.run)
+        newButton = Button(self.customButtonFrame, text = name, command = lambda: self.runOrQueue(newproc))
         newproc.runbtn = newButton
         for button in self.buttons:
             button.grid_remove()
@@ -0,0 +1,279 @@
+#MIT License
+#
+#Copyright (c) 2017 Jonathan A. White
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import ast
+import operator
+import config
+
+# SavedProtocol plans a protocol in the format saved by Protocol.save into timed events without building its Tk
+# widgets, so that programs with no GUI can run saved protocols (see ControlServer). The events are the ones
+# Routine.planEvents returns for the same protocol: (seconds from the start, step number, loop iterations, action),
+# where the action is a "pins" or "pump" action of ValveController.runRepeat or ("step",) for a pause. Entries are
+# checked as the steps' saveEntries methods check them, on every loop iteration they are evaluated for.
+#
+#   events, duration = planSaved(json.load(open("protocol.txt")), device.pinStates)
+
+header = "This is a saved Protocol" # first element of a protocol file (see Protocol.save)
+
+# operators allowed in entry expressions (see evaluateEntry)
+binaryOperators = {ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul, ast.Div: operator.truediv,
+                   ast.FloorDiv: operator.floordiv, ast.Mod: operator.mod, ast.Pow: operator.pow}
+unaryOperators = {ast.USub: operator.neg, ast.UAdd: operator.pos}
+maxExponent = 64 # largest power allowed, so that an entry cannot ask for an enormous number
+
+
+# evaluateEntry: evaluates an entry written as an expression of the loop iterations, such as "2 + i[0]*3". Protocols
+#   come from clients of the control server, so the expression is not run as python: only numbers, i[k] and the
+#   arithmetic operators are allowed.
+#   Inputs:
+#       text - the entry
+#       iter - tuple of loop iterations, None outside loops
+#   Output: the value; raises a ValueError for anything else.
+def evaluateEntry(text, iter):
+    try:
+        tree = ast.parse(str(text).strip(), mode = 'eval')
+    except SyntaxError:
+        raise ValueError(text)
+    return evaluateNode(tree.body, iter)
+
+
+# evaluateNode: evaluates a node of an entry expression (see evaluateEntry).
+def evaluateNode(node, iter):
+    if isinstance(node, ast.BinOp) and type(node.op) in binaryOperators:
+        left, right = evaluateNode(node.left, iter), evaluateNode(node.right, iter)
+        if isinstance(node.op, ast.Pow) and abs(right) > maxExponent:
+            raise ValueError("power")
+        return binaryOperators[type(node.op)](left, right)
+    if isinstance(node, ast.UnaryOp) and type(node.op) in unaryOperators:
+        return unaryOperators[type(node.op)](evaluateNode(node.operand, iter))
+    number = constant(node)
+    if number is not None:
+        return number
+    if isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name) and node.value.id == 'i' and iter:
+        index = node.slice.value if isinstance(node.slice, getattr(ast, 'Index', ())) else node.slice # python < 3.9
+        index = constant(index)
+        if isinstance(index, int) and 0 <= index < len(iter):
+            return iter[index]
+    raise ValueError("not allowed")
+
+
+# constant: returns the number a node holds, or None if it is not a number literal.
+def constant(node):
+    value = None
+    if type(node).__name__ == 'Constant':
+        value = node.value
+    elif type(node).__name__ == 'Num': # python < 3.8
+        value = node.n
+    if type(value) in (int, float):
+        return value
+    return None
+
+
+# planSaved: plans a saved protocol.
+#   Inputs:
+#       saved - the saved protocol list, with or without its header
+#       pins - the valves the protocol may use, e.g. the device's pinStates
+#   Output: (list of events, seconds the protocol takes), but raises a ValueError if the protocol is not valid or has
+#       more than config.processPlanLimit events
+def planSaved(saved, pins):
+    if not isinstance(saved, list):
+        raise ValueError("Error: a saved protocol is a list of steps.")
+    if saved and saved[0] == header:
+        saved = saved[1:]
+    if not saved:
+        raise ValueError("There are no steps in this protocol!")
+    items, end = numberItems(saved, 1)
+    return SavedPlanner(pins).planRoutine(items, None)
+
+
+# numberItems: numbers the steps of a saved routine depth first, as Routine.numberSteps does.
+#   Inputs:
+#       saved - list of saved items
+#       start - the number to give the first step
+#   Output: (list of (step number, saved item, numbered children) tuples, the number to give the next step); the
+#       children of steps are None
+def numberItems(saved, start):
+    items = []
+    for item in saved:
+        if not isinstance(item, list) or not item:
+            raise ValueError("Error: " + str(item) + " is not a saved step, loop or parallel block.")
+        if item[0] == "Loop":
+            children, following = numberItems(item[3:], start)
+        elif item[0] == "ParallelBlock":
+            children, following = numberItems(item[2:], start)
+        else:
+            children, following = None, start + 1
+        items.append((start, item, children))
+        start = following
+    return items, start
+
+
+# SavedPlanner: plans the items numbered by numberItems, checking each entry for the loop iterations it is evaluated on.
+class SavedPlanner:
+
+    # SavedPlanner.__init__
+    #   Input:
+    #       pins - the valves steps may use
+    def __init__(self, pins):
+        self.pins = pins
+        self.count = 0 # events planned so far
+
+    # SavedPlanner.planRoutine: plans items one after another (see Routine.planEvents).
+    #   Inputs:
+    #       items - numbered items
+    #       iter - tuple of loop iterations, None outside loops
+    #   Output: (list of events, seconds the items take)
+    def planRoutine(self, items, iter):
+        events = []
+        offset = 0
+        for item in items:
+            plan = self.planItem(item, iter)
+            events += [(offset + event[0],) + event[1:] for event in plan[0]]
+            offset += plan[1]
+        return events, offset
+
+    # SavedPlanner.planItem: plans a step, loop or parallel block for one iteration of its outer loops.
+    #   Inputs:
+    #       item - numbered item
+    #       iter - tuple of loop iterations, None outside loops
+    #   Output: (list of events, seconds the item takes)
+    def planItem(self, item, iter):
+        stepId, saved, children = item
+        if saved[0] == "Loop":
+            try:
+                iterations = int(saved[2])
+            except (ValueError, TypeError, IndexError):
+                raise ValueError(str(saved[2:3]) + " is not a valid n")
+            if iterations < 1:
+                raise ValueError("You must loop over a postitive integer number of iterations.")
+            if not children:
+                raise ValueError("You cannot run a loop with no steps!")
+            events = []
+            offset = 0
+            for i in range(1, iterations + 1):
+                plan = self.planRoutine(children, (i,) + iter if iter else (i,))
+                events += [(offset + event[0],) + event[1:] for event in plan[0]]
+                offset += plan[1]
+            return events, offset
+        if saved[0] == "ParallelBlock":
+            events = []
+            duration = 0
+            for child in children:
+                plan = self.planItem(child, iter)
+                events += plan[0]
+                duration = max(duration, plan[1])
+            events.sort(key = lambda event: event[0])
+            return events, duration
+        if saved[0] == "ValveStep":
+            plan = self.planValveStep(saved[1:], iter)
+        elif saved[0] == "PumpStep":
+            plan = self.planPumpStep(saved[1:], iter)
+        elif saved[0] == "PauseStep":
+            plan = [("step",)], self.planPauseStep(saved[1:], iter)
+        else:
+            raise ValueError("Error: " + str(saved[0]) + " steps cannot be run without the GUI.")
+        self.count += 1
+        if self.count > config.processPlanLimit:
+            raise ValueError("Error: the protocol has more than " + str(config.processPlanLimit) + " steps to run.")
+        return [(0, stepId, iter, action) for action in plan[0]], plan[1]
+
+    # SavedPlanner.evaluate: returns the value of a saved entry on a loop iteration: the entry itself if it converts
+    #   to the type, otherwise the value of the entry as an arithmetic expression of i (see evaluateEntry).
+    #   Inputs:
+    #       entry - saved entry
+    #       type - int or float
+    #       iter - tuple of loop iterations, None outside loops
+    #       message - error message if the entry is not valid
+    #   Output: the value
+    def evaluate(self, entry, type, iter, message):
+        try:
+            return type(entry)
+        except (ValueError, TypeError):
+            pass
+        try:
+            return evaluateEntry(entry, iter)
+        except (ValueError, TypeError, ZeroDivisionError, OverflowError):
+            raise ValueError(message + (" on iteration " + iterToString(iter) if iter else "") + ".")
+
+    # SavedPlanner.valve: returns the valve of a saved valve entry on a loop iteration (see Step.valveKey).
+    def valve(self, entry, iter):
+        entry = str(entry).strip()
+        try:
+            valve = int(entry)
+        except ValueError:
+            valve = entry if ':' in entry else self.evaluate(entry, int, iter, "Valve entry " + entry +
+                                                             " is not a valid valve or python expression")
+        if valve not in self.pins:
+            raise ValueError("Valve entry " + entry + " is not an available valve" +
+                             (" on iteration " + iterToString(iter) if iter else "") + ".")
+        return valve
+
+    # SavedPlanner.planValveStep: returns the "pins" action of a saved ValveStep and its duration, 0.
+    #   Inputs:
+    #       entries - the step's saved entries: comma separated valves and states
+    #       iter - tuple of loop iterations, None outside loops
+    def planValveStep(self, entries, iter):
+        if len(entries) != 2:
+            raise ValueError("Error: a saved ValveStep has a valve entry and a state entry.")
+        valves = str(entries[0]).split(',')
+        states = str(entries[1]).replace(' ', '').split(',')
+        if len(states) != len(valves):
+            if len(states) != 1:
+                raise ValueError("The number of valves and states entered in Valve Step are different.")
+            states = states*len(valves)
+        valves = [self.valve(v, iter) for v in valves]
+        if len(set(valves)) < len(valves):
+            raise ValueError("There are duplicate pin entries.")
+        states = [self.evaluate(s, int, iter, "Valve state " + s + " is not allowed") for s in states]
+        for state in states:
+            if state not in (0, 1):
+                raise ValueError("The valve state must be either 1 (energized) or 0 (not energized)" +
+                                 (", not " + str(state) + " on iteration " + iterToString(iter) if iter else "") + ".")
+        return [("pins", valves, states)], 0
+
+    # SavedPlanner.planPumpStep: returns the "pump" action of a saved PumpStep and the seconds it pumps.
+    #   Inputs:
+    #       entries - the step's saved entries: rate, number of cycles and three valves
+    #       iter - tuple of loop iterations, None outside loops
+    def planPumpStep(self, entries, iter):
+        if len(entries) != 5:
+            raise ValueError("Error: a saved PumpStep has rate, cycles and three valve entries.")
+        rate = self.evaluate(entries[0], int, iter, str(entries[0]) + " is not a valid rate for a pump step")
+        if type(rate) != int or rate < 1:
+            raise ValueError(str(entries[0]) + " is not a valid rate for a pump step. Rates must be positive integers.")
+        cycles = self.evaluate(entries[1], int, iter, str(entries[1]) + " is not a valid number of cycles")
+        if type(cycles) != int or cycles < -1 or cycles == 0 or (cycles == -1 and iter):
+            raise ValueError(str(entries[1]) + " is not a valid number of cycles for a pump step. The number of cycles"
+                             " must be a positive integer, or -1 outside loops to pump indefinitely.")
+        valves = [self.valve(v, iter) for v in entries[2:]]
+        if len(set(valves)) < 3:
+            raise ValueError("There are duplicate valve entries" +
+                             (" on iteration " + iterToString(iter) if iter else "") + ".")
+        return [("pump", 'f', valves, rate, cycles)], float('Inf') if cycles == -1 else float(cycles)/float(rate)
+
+    # SavedPlanner.planPauseStep: returns the seconds a saved PauseStep pauses.
+    #   Inputs:
+    #       entries - the step's saved entries: the time
+    #       iter - tuple of loop iterations, None outside loops
+    def planPauseStep(self, entries, iter):
+        if len(entries) != 1:
+            raise ValueError("Error: a saved PauseStep has one time entry.")
+        seconds = self.evaluate(entries[0], float, iter, "Invalid pause time: " + str(entries[0]))
+        if type(seconds) not in (int, float) or seconds < 0:
+            raise ValueError("Cannot pause for " + str(entries[0]) + " seconds" +
+                             (" on iteration " + iterToString(iter) if iter else "") +
+                             ". You can only pause for a positive number of seconds.")
+        return float(seconds)
+
+
+# iterToString: formats loop iterations for error messages, as Step.iterToString does.
+def iterToString(i):
+    return ", ".join(["i[" + str(j) + "] = " + str(k) for j, k in enumerate(i)])
@@ -0,0 +1,287 @@
+#MIT License
+#
+#Copyright (c) 2017 Jonathan A. White
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+
+import time
+import threading
+import os
+from collections import deque, OrderedDict
+
+# clock is the timer used for all measurements: a monotonic, high resolution clock where python provides one.
+clock = getattr(time, 'perf_counter', time.time)
+
+# SerialMetrics collects latency and throughput statistics for the serial link of one valve controller so that a slow
+# protocol can be traced to USB, to Python or to the firmware. Every ValveController owns one as self.metrics. All
+# methods are thread safe. Values can be read from code with snapshot() and are periodically written to a metrics file
+# in the Prometheus text format by a MetricsDumper (see config.metricsFile).
+class SerialMetrics:
+    # upper bounds (seconds) of the round trip latency histogram buckets; the last bucket is unbounded.
+    buckets = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0)
+    window = 10.0 # seconds of history used for the bytes and frames per second rates
+
+    registry = [] # metrics of every open controller, written by the MetricsDumper
+    dumper = None
+
+    # SerialMetrics.__init__
+    #   Input:
+    #       port - name of the serial port, used to label the metrics
+    def __init__(self, port):
+        self.port = str(port)
+        self.lock = threading.Lock()
+        self.start = clock()
+        self.bytesWritten = 0
+        self.bytesRead = 0
+        self.framesWritten = 0
+        self.framesRead = 0
+        self.retries = 0
+        self.reconnects = 0
+        self.recoveries = 0
+        self.recoverySeconds = 0.0 # total time spent recovering from failed writes
+        self.lastRecoverySeconds = 0.0
+        self.readBlocked = 0.0 # total seconds spent blocked in readline
+        self.histograms = {} # opcode -> [bucket counts, sum of latencies, count]
+        self.recent = deque() # (time, bytes written, bytes read, frames written, frames read) within the window
+
+    # SerialMetrics.recordWrite: records a frame written to the device.
+    #   Inputs:
+    #       nBytes - the number of bytes written
+    #       frames - the number of frames (commands) they contain
+    def recordWrite(self, nBytes, frames = 1):
+        with self.lock:
+            self.bytesWritten += nBytes
+            self.framesWritten += frames
+            self._addRecent((clock(), nBytes, 0, frames, 0))
+
+    # SerialMetrics.recordRead: records a reply line read from the device.
+    #   Inputs:
+    #       nBytes - the number of bytes read. An empty read (a timeout) is not counted as a frame.
+    #       blocked - seconds spent waiting in readline
+    def recordRead(self, nBytes, blocked):
+        with self.lock:
+            frames = 1 if nBytes else 0
+            self.bytesRead += nBytes
+            self.framesRead += frames
+            self.readBlocked += blocked
+            self._addRecent((clock(), 0, nBytes, 0, frames))
+
+    # SerialMetrics.recordRoundTrip: records the time from writing a command to reading its reply.
+    #   Inputs:
+    #       opcode - the command's opcode, for example '2' for set pins
+    #       seconds - the round trip time
+    def recordRoundTrip(self, opcode, seconds):
+        opcode = str(opcode)
+        with self.lock:
+            if opcode not in self.histograms:
+                self.histograms[opcode] = [[0]*(len(self.buckets) + 1), 0.0, 0]
+            histogram = self.histograms[opcode]
+            b = 0
+            while b < len(self.buckets) and seconds > self.buckets[b]:
+                b += 1
+            histogram[0][b] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    # SerialMetrics.recordRetry: records a command that was sent again after a failed write.
+    def recordRetry(self):
+        with self.lock:
+            self.retries += 1
+
+    # SerialMetrics.recordReconnect: records the serial connection being reopened.
+    def recordReconnect(self):
+        with self.lock:
+            self.reconnects += 1
+
+    # SerialMetrics.recordRecovery: records the time taken to recover the connection after a failed write, from the
+    #   failure to the failed command being resent.
+    #   Input:
+    #       seconds - the recovery time
+    def recordRecovery(self, seconds):
+        with self.lock:
+            self.recoveries += 1
+            self.recoverySeconds += seconds
+            self.lastRecoverySeconds = seconds
+
+    # SerialMetrics._addRecent: helper that adds an event to the rate window and drops events older than the window.
+    #   The caller holds self.lock.
+    def _addRecent(self, event):
+        self.recent.append(event)
+        while self.recent and event[0] - self.recent[0][0] > self.window:
+            self.recent.popleft()
+
+    # SerialMetrics.percentile: estimates a round trip latency percentile from the histogram.
+    #   Inputs:
+    #       opcode - the command's opcode
+    #       fraction - the percentile as a fraction, for example 0.99
+    #   Output: the upper bound (seconds) of the bucket holding the percentile, float('inf') if it is in the last
+    #       bucket, or None if no round trips have been recorded for the opcode.
+    def percentile(self, opcode, fraction):
+        with self.lock:
+            histogram = self.histograms.get(str(opcode))
+            if not histogram or not histogram[2]:
+                return None
+            target = fraction*histogram[2]
+            seen = 0
+            for b, count in enumerate(histogram[0]):
+                seen += count
+                if seen >= target and count:
+                    return self.buckets[b] if b < len(self.buckets) else float('inf')
+            return float('inf')
+
+    # SerialMetrics.snapshot: returns the current values.
+    #   Input: None
+    #   Output: dictionary of counters, rates over the last window seconds, and per opcode histograms
+    def snapshot(self):
+        with self.lock:
+            now = clock()
+            while self.recent and now - self.recent[0][0] > self.window:
+                self.recent.popleft()
+            span = min(self.window, max(now - self.start, 1e-9))
+            recent = [sum([e[k] for e in self.recent]) for k in range(1, 5)]
+            roundTrips = {}
+            for opcode, histogram in self.histograms.items():
+                roundTrips[opcode] = {'buckets': list(zip(self.buckets + (float('inf'),), histogram[0])),
+                                      'sum': histogram[1], 'count': histogram[2]}
+            return {'port': self.port,
+                    'uptime': now - self.start,
+                    'bytesWritten': self.bytesWritten,
+                    'bytesRead': self.bytesRead,
+                    'framesWritten': self.framesWritten,
+                    'framesRead': self.framesRead,
+                    'bytesWrittenPerSecond': recent[0]/span,
+                    'bytesReadPerSecond': recent[1]/span,
+                    'framesWrittenPerSecond': recent[2]/span,
+                    'framesReadPerSecond': recent[3]/span,
+                    'retries': self.retries,
+                    'reconnects': self.reconnects,
+                    'recoveries': self.recoveries,
+                    'recoverySeconds': self.recoverySeconds,
+                    'lastRecoverySeconds': self.lastRecoverySeconds,
+                    'readBlockedSeconds': self.readBlocked,
+                    'roundTrips': roundTrips}
+
+    # SerialMetrics.samples: lists the current values as metric samples.
+    #   Input: None
+    #   Output: list of (metric name, metric type, labels, value) tuples
+    def samples(self):
+        snap = self.snapshot()
+        label = 'port="' + self.port.replace('\\', '\\\\').replace('"', '\\"') + '"'
+        samples = []
+        for name, key, kind in (("bytes_written_total", 'bytesWritten', "counter"),
+                                ("bytes_read_total", 'bytesRead', "counter"),
+                                ("frames_written_total", 'framesWritten', "counter"),
+                                ("frames_read_total", 'framesRead', "counter"),
+                                ("retries_total", 'retries', "counter"),
+                                ("reconnects_total", 'reconnects', "counter"),
+                                ("recoveries_total", 'recoveries', "counter"),
+                                ("recovery_seconds_total", 'recoverySeconds', "counter"),
+                                ("last_recovery_seconds", 'lastRecoverySeconds', "gauge"),
+                                ("readline_blocked_seconds_total", 'readBlockedSeconds', "counter"),
+                                ("bytes_written_per_second", 'bytesWrittenPerSecond', "gauge"),
+                                ("bytes_read_per_second", 'bytesReadPerSecond', "gauge"),
+                                ("frames_written_per_second", 'framesWrittenPerSecond', "gauge"),
+                                ("frames_read_per_second", 'framesReadPerSecond', "gauge")):
+            samples.append(("katara_serial_" + name, kind, label, snap[key]))
+        for opcode in sorted(snap['roundTrips']):
+            histogram = snap['roundTrips'][opcode]
+            opLabel = label + ',opcode="' + opcode + '"'
+            cumulative = 0
+            for bound, count in histogram['buckets']:
+                cumulative += count
+                le = "+Inf" if bound == float('inf') else repr(bound)
+                samples.append(("katara_serial_roundtrip_seconds_bucket", "histogram", opLabel + ',le="' + le + '"',
+                                cumulative))
+            samples.append(("katara_serial_roundtrip_seconds_sum", "histogram", opLabel, histogram['sum']))
+            samples.append(("katara_serial_roundtrip_seconds_count", "histogram", opLabel, histogram['count']))
+        return samples
+
+    # SerialMetrics.render: formats the current values in the Prometheus text exposition format.
+    #   Input: None
+    #   Output: string
+    def render(self):
+        return render([self])
+
+    # SerialMetrics.register: adds these metrics to the metrics file, starting the MetricsDumper if a file is set.
+    #   Inputs:
+    #       path - metrics file to write, or None to keep the metrics in memory only
+    #       interval - seconds between writes
+    def register(self, path, interval):
+        SerialMetrics.registry.append(self)
+        if path and not SerialMetrics.dumper:
+            SerialMetrics.dumper = MetricsDumper(path, interval)
+            SerialMetrics.dumper.start()
+
+    # SerialMetrics.unregister: removes these metrics from the metrics file, e.g. when the connection is closed.
+    def unregister(self):
+        if self in SerialMetrics.registry:
+            SerialMetrics.registry.remove(self)
+
+
+# render: formats the metrics of several controllers in the Prometheus text exposition format. Samples are grouped by
+# metric so that each metric has one TYPE line.
+#   Input:
+#       metricsList - list of SerialMetrics objects
+#   Output: string
+def render(metricsList):
+    families = OrderedDict()
+    for metrics in metricsList:
+        for name, kind, labels, value in metrics.samples():
+            family = name
+            for suffix in ("_bucket", "_sum", "_count"):
+                if kind == "histogram" and name.endswith(suffix):
+                    family = name[:-len(suffix)]
+            if family not in families:
+                families[family] = ["# TYPE " + family + " " + kind]
+            families[family].append(name + "{" + labels + "} " + repr(value))
+    lines = []
+    for familyLines in families.values():
+        lines += familyLines
+    return "\n".join(lines) + "\n"
+
+
+# MetricsDumper: a daemon thread that periodically writes the metrics of every registered controller to a file. The
+# file is replaced atomically so a scraper never reads a partial file.
+class MetricsDumper(threading.Thread):
+
+    # MetricsDumper.__init__
+    #   Inputs:
+    #       path - the metrics file
+    #       interval - seconds between writes
+    def __init__(self, path, interval):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.path = path
+        self.interval = interval
+        self.stopEvent = threading.Event()
+
+    # MetricsDumper.run: writes the file every interval seconds until stop is called.
+    def run(self):
+        while not self.stopEvent.wait(self.interval):
+            try:
+                self.dump()
+            except (IOError, OSError) as E:
+                print("Could not write metrics: " + str(E))
+
+    # MetricsDumper.dump: writes the metrics file once.
+    def dump(self):
+        text = render(list(SerialMetrics.registry))
+        tmp = self.path + ".tmp"
+        with open(tmp, 'w') as file:
+            file.write(text)
+        if hasattr(os, 'replace'):
+            os.replace(tmp, self.path)
+        else: # python 2 cannot rename over an existing file on Windows
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            os.rename(tmp, self.path)
+
+    # MetricsDumper.stop: stops the thread after its current write.
+    def stop(self):
+        self.stopEvent.set()
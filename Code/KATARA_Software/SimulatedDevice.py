@@ -0,0 +1,410 @@
+#MIT License
+#
+#Copyright (c) 2017 Jonathan A. White
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+
+import time
+import threading
+from collections import deque
+from KATARAValveController import KATARAValveController
+from SerialMetrics import clock
+
+# SimulatedDevice provides an in-memory stand in for an Arduino running the KATARA firmware so that controllers and
+# protocols can be exercised without hardware, for example when replaying valve traces (see TraceReplay).
+
+# pump valve states for each of the six phases of a cycle, as in the firmware
+pumpForward = ((1, 0, 0), (1, 1, 0), (0, 1, 0), (0, 1, 1), (0, 0, 1), (1, 0, 1))
+pumpReverse = ((0, 0, 1), (0, 1, 1), (0, 1, 0), (1, 1, 0), (1, 0, 0), (1, 0, 1))
+maxPumps = 4 # pump slots in the firmware
+streamCapacity = 64 # frames in the firmware's stream buffer
+
+
+# toInt: converts a string to an integer the way the Arduino String.toInt does: leading digits (with an optional sign)
+# are converted and anything after them ignored; a string that does not start with a number gives 0.
+def toInt(s):
+    s = s.strip()
+    end = 1 if s[:1] in ('-', '+') else 0
+    while end < len(s) and s[end].isdigit():
+        end += 1
+    try:
+        return int(s[:end])
+    except ValueError:
+        return 0
+
+
+# FirmwareModel: models KATARA_Firmware.ino. Frames end in 'c'; each frame is echoed and then
+#   1          - identify ("KATARA Arduino Firmware", no newline)
+#   2PPSPPS... - set pins: two digit pin numbers each followed by a one digit state, together with any staged pins;
+#                replies "Set Pins"
+#   3dVVVVVVVVVRRRCCCCCC - start a pump: direction, three three digit valves, rate, cycles; replies "Pump"
+#   4          - read back pins 2-69 as 17 hex digits, the first digit holding pins 69-66 and the last pins 5-2
+#   5VVVVVVVVV - stop the pumps using any of three valves; replies "Stop"
+#   6NNNNNNbody - run a repeat program: the body N times, 0 to stop the running program; replies "Repeat". The body
+#                is a sequence of SnnPPS... (set nn pins), WMMMMMMMM (wait milliseconds) and PdVVVVVVVVVRRRCCCCCC
+#                (start a pump) items.
+#   7...       - streaming mode (see the firmware): 7S sets up a stream and replies "Stream" and the capacity of the
+#                buffer, 7D queues frames, 7R starts playing, 7E finishes once the buffer is empty and 7X stops now.
+#                These frames are not echoed. While a stream plays, the model sends "7C" messages returning credits
+#                and a "7F" message when it ends; such messages are collected with takeOutput.
+#   8PPSPPS... - stage a chunk of a set pins command, applied by the next 2 frame; not echoed, replies "Staged" and
+#                the number of pins staged. With no pins (or on an identify frame) the staged pins are dropped.
+#   (empty)    - a lone 'c' stops all pumps, no reply
+# Pumps step through the six phases of a cycle on the firmware's schedule (see runPumps), up to maxPumps at a time.
+# Every frame received and every pin change is recorded with its time so tests can inspect what the device saw.
+class FirmwareModel:
+
+    # FirmwareModel.__init__
+    #   Input: None
+    def __init__(self):
+        self.pins = dict([(p, 0) for p in range(2, 70)])
+        self.pumps = [None]*maxPumps # running pumps by slot, as dictionaries
+        self.program = None # the running repeat program, as a dictionary
+        self.inputString = ""
+        self.frames = [] # (time, frame) for every complete frame received, without the terminating 'c'
+        self.timeline = [] # (time, pin, state) for every pin change
+        self.stream = None # the stream set up by a 7S frame, as a dictionary
+        self.staged = [] # (pin, state) staged by 8 frames
+        self.output = [] # (time, message) for messages sent without a frame asking for them
+        self.lock = threading.RLock()
+
+    # FirmwareModel.receive: feeds bytes received from the host to the model. Like the firmware's serialEvent, which
+    #   stops reading at a 'c' and leaves the bytes after it for the next pass of loop(), each 'c' ends exactly one
+    #   frame, however many frames arrive together.
+    #   Inputs:
+    #       data - string received
+    #       now - time at which the last byte was received, defaults to the current time
+    #   Output: the string the firmware sends back
+    def receive(self, data, now = None):
+        if now is None:
+            now = clock()
+        reply = ""
+        with self.lock:
+            self.runPumps(now)
+            for char in data:
+                if char == 'c':
+                    frame, self.inputString = self.inputString, ""
+                    reply += self.process(frame, now)
+                else:
+                    self.inputString += char
+        return reply
+
+    # FirmwareModel.process: handles one frame.
+    #   Inputs:
+    #       frame - the frame without its terminating 'c'
+    #       now - time at which the frame was received
+    #   Output: the reply string
+    def process(self, frame, now):
+        self.frames.append((now, frame))
+        if frame == "":
+            for slot in range(maxPumps):
+                self.endPump(slot, now)
+            return ""
+        if frame[0] == '1':
+            self.staged = []
+            return frame + "KATARA Arduino Firmware"
+        if frame[0] == '2':
+            self.stagePins(frame[1:])
+            self.writePins(now, [pin for pin, state in self.staged], [state for pin, state in self.staged])
+            self.staged = []
+            return frame + "Set Pins\r\n"
+        if frame[0] == '3':
+            valves = [toInt(frame[2 + 3*v:5 + 3*v]) for v in range(3)]
+            cycles = toInt(frame[14:20])
+            self.startPump(frame[1] == 'r', valves, toInt(frame[11:14]), cycles if cycles > 0 else -1, now)
+            return frame + "Pump\r\n"
+        if frame[0] == '4':
+            mask = sum([self.pins[p] << (p - 2) for p in range(2, 70)])
+            return frame + "%017X\r\n" % mask
+        if frame[0] == '5':
+            valves = set([toInt(frame[1 + 3*v:4 + 3*v]) for v in range(3)])
+            for slot in range(maxPumps):
+                if self.pumps[slot] and set(self.pumps[slot]['valves']) & valves:
+                    self.endPump(slot, now)
+            return frame + "Stop\r\n"
+        if frame[0] == '6':
+            repeats = toInt(frame[1:7])
+            self.program = {'body': frame[7:], 'pos': 0, 'repeatsLeft': repeats, 'next': now} if repeats > 0 else None
+            return frame + "Repeat\r\n"
+        if frame[0] == '7':
+            return self.streamCommand(frame, now)
+        if frame[0] == '8':
+            if len(frame) == 1:
+                self.staged = []
+            self.stagePins(frame[1:])
+            return "Staged%d\r\n" % len(self.staged)
+        return frame
+
+    # FirmwareModel.stagePins: stages the pins of a set pins message, up to one per pin of the board.
+    def stagePins(self, message):
+        staged = [(toInt(message[k:k + 2]), toInt(message[k + 2])) for k in range(0, len(message) - 2, 3)]
+        self.staged = (self.staged + staged)[:len(self.pins)]
+
+    # FirmwareModel.streamCommand: handles a 7 frame like the firmware's streamCommand.
+    #   Inputs:
+    #       frame - the frame without its terminating 'c'
+    #       now - time at which the frame was received
+    #   Output: the reply string
+    def streamCommand(self, frame, now):
+        stream = self.stream
+        if frame[1:2] == 'S':
+            pins = [toInt(frame[10 + 2*k:12 + 2*k]) for k in range(min(toInt(frame[8:10]), 32))]
+            self.stream = {'tick': toInt(frame[2:8])*1e-6, 'pins': pins, 'buffer': deque(), 'running': False,
+                           'ending': False, 'start': now, 'nextTick': 0, 'played': 0, 'late': 0, 'overflows': 0,
+                           'owed': 0, 'lateReported': 0}
+            return "Stream%d\r\n" % streamCapacity
+        if stream is None:
+            return ""
+        if frame[1:2] == 'D':
+            width = 4 + (len(stream['pins']) + 3)//4
+            if stream['running']: # the first tick that can see the new frames
+                stream['nextTick'] = max(stream['nextTick'], int((now - stream['start'])/stream['tick']) + 1)
+            for at in range(2, len(frame) - width + 1, width):
+                if len(stream['buffer']) >= streamCapacity:
+                    stream['overflows'] += 1
+                    continue
+                wait = (int(frame[at:at + 4], 16) - stream['nextTick'] + 32768) % 65536 - 32768 # as a signed int
+                stream['buffer'].append((stream['nextTick'] + wait, int(frame[at + 4:at + width], 16)))
+        elif frame[1:2] == 'R':
+            stream.update(running = True, start = now, nextTick = 0)
+        elif frame[1:2] == 'E':
+            stream['ending'] = True
+            if not stream['running']:
+                self.finishStream(now)
+            else:
+                self.reportStream(now)
+        elif frame[1:2] == 'X':
+            stream['buffer'].clear()
+            self.finishStream(now)
+        return ""
+
+    # FirmwareModel.streamDue: returns the time at which the next stream frame will be played, or None if no stream
+    #   frame is waiting to be played. A frame is played at its tick, or at the first tick after it arrived if that
+    #   was later, and at most one frame is played per tick.
+    def streamDue(self):
+        stream = self.stream
+        if not stream or not stream['running'] or not stream['buffer']:
+            return None
+        return stream['start'] + max(stream['nextTick'], stream['buffer'][0][0])*stream['tick']
+
+    # FirmwareModel.streamActive: returns True while a stream is playing.
+    def streamActive(self):
+        return bool(self.stream and self.stream['running'])
+
+    # FirmwareModel.playFrame: plays the next stream frame at its time, like the firmware's playTick.
+    def playFrame(self):
+        stream = self.stream
+        stamp, mask = stream['buffer'].popleft()
+        tick = max(stream['nextTick'], stamp)
+        time = stream['start'] + tick*stream['tick']
+        if tick > stamp:
+            stream['late'] += 1
+        self.writePins(time, stream['pins'], [(mask >> k) & 1 for k in range(len(stream['pins']))])
+        stream['played'] += 1
+        stream['owed'] += 1
+        stream['nextTick'] = tick + 1
+        self.reportStream(time)
+
+    # FirmwareModel.reportStream: returns credits and finishes the stream when the firmware's reportStream would.
+    def reportStream(self, now):
+        stream = self.stream
+        empty = not stream['buffer']
+        lateChanged = stream['late'] != stream['lateReported']
+        if stream['owed'] >= streamCapacity//4 or (stream['owed'] and empty) or lateChanged:
+            self.output.append((now, "7C%d %d\r\n" % (stream['owed'], stream['late'])))
+            stream['owed'] = 0
+            stream['lateReported'] = stream['late']
+        if stream['ending'] and empty:
+            self.finishStream(now)
+
+    # FirmwareModel.finishStream: stops the stream and reports the frames played, late and dropped.
+    def finishStream(self, now):
+        stream = self.stream
+        stream.update(running = False, ending = False)
+        self.output.append((now, "7F%d %d %d\r\n" % (stream['played'], stream['late'], stream['overflows'])))
+
+    # FirmwareModel.takeOutput: returns and forgets the messages the model has sent on its own.
+    #   Output: list of (time, message)
+    def takeOutput(self):
+        with self.lock:
+            output, self.output = self.output, []
+        return output
+
+    # FirmwareModel.startPump: claims a slot for a new pump like the firmware's startPump: a pump that shares a valve
+    #   with the new one is replaced, otherwise the first free slot is used, or the first slot if all are busy.
+    def startPump(self, reverse, valves, rate, cycles, now):
+        slots = [s for s in range(maxPumps) if self.pumps[s] and set(self.pumps[s]['valves']) & set(valves)]
+        slots += [s for s in range(maxPumps) if not self.pumps[s]] + [0]
+        slot = slots[0]
+        self.endPump(slot, now)
+        period = (1000000//(max(rate, 1)*6))*1e-6 # the firmware keeps whole microseconds
+        self.pumps[slot] = {'reverse': reverse, 'valves': valves, 'period': period, 'nextPhase': now + period,
+                            'cyclesLeft': cycles, 'phase': 0}
+        self.writePumpPhase(self.pumps[slot], now)
+
+    # FirmwareModel.endPump: returns the valves of the pump in a slot to 0 and frees the slot.
+    def endPump(self, slot, now):
+        if self.pumps[slot]:
+            self.writePins(now, self.pumps[slot]['valves'], (0, 0, 0))
+            self.pumps[slot] = None
+
+    # FirmwareModel.writePumpPhase: sets the valves of a pump to the states of its current phase.
+    def writePumpPhase(self, pump, now):
+        phases = pumpReverse if pump['reverse'] else pumpForward
+        self.writePins(now, pump['valves'], phases[pump['phase']])
+
+    # FirmwareModel.runPumps: advances every pump through the phases that have elapsed by now, and runs the items of
+    #   the repeat program and plays the stream frames that have come due. Each change is recorded at its scheduled
+    #   time, so the model may be advanced late without distorting the timeline.
+    #   Input:
+    #       now - current time
+    def runPumps(self, now):
+        with self.lock:
+            while True:
+                due = [s for s in range(maxPumps) if self.pumps[s] and self.pumps[s]['nextPhase'] <= now]
+                streamTime = self.streamDue()
+                if streamTime is not None and streamTime <= now and \
+                        not [s for s in due if self.pumps[s]['nextPhase'] < streamTime] and \
+                        not (self.program and self.program['next'] < streamTime):
+                    self.playFrame()
+                    continue
+                if self.program and self.program['next'] <= now and \
+                        not [s for s in due if self.pumps[s]['nextPhase'] < self.program['next']]:
+                    self.runProgramItem()
+                    continue
+                if not due:
+                    return
+                slot = min(due, key = lambda s: self.pumps[s]['nextPhase'])
+                pump = self.pumps[slot]
+                time = pump['nextPhase']
+                pump['phase'] += 1
+                if pump['phase'] == 6:
+                    pump['phase'] = 0
+                    if pump['cyclesLeft'] > 0:
+                        pump['cyclesLeft'] -= 1
+                    if pump['cyclesLeft'] == 0:
+                        self.endPump(slot, time)
+                        continue
+                self.writePumpPhase(pump, time)
+                pump['nextPhase'] += pump['period']
+
+    # FirmwareModel.runProgramItem: runs the next item of the repeat program at its scheduled time, like the
+    #   firmware's runProgram.
+    def runProgramItem(self):
+        program = self.program
+        body, pos, time = program['body'], program['pos'], program['next']
+        if pos >= len(body): # end of a pass through the body
+            program['pos'] = 0
+            program['repeatsLeft'] -= 1
+            if program['repeatsLeft'] <= 0:
+                self.program = None
+            return
+        if body[pos] == 'S':
+            nPins = toInt(body[pos + 1:pos + 3])
+            items = [body[pos + 3 + 3*k:pos + 6 + 3*k] for k in range(nPins)]
+            self.writePins(time, [toInt(item[:2]) for item in items], [toInt(item[2:]) for item in items])
+            program['pos'] = pos + 3 + 3*nPins
+        elif body[pos] == 'W':
+            program['next'] += toInt(body[pos + 1:pos + 9])*1e-3
+            program['pos'] = pos + 9
+        elif body[pos] == 'P':
+            valves = [toInt(body[pos + 2 + 3*v:pos + 5 + 3*v]) for v in range(3)]
+            self.startPump(body[pos + 1] == 'r', valves, toInt(body[pos + 11:pos + 14]), toInt(body[pos + 14:pos + 20]),
+                           time)
+            program['pos'] = pos + 20
+        else: # not a valid item: stop the program
+            self.program = None
+
+    # FirmwareModel.nextPhase: returns the time of the next scheduled pump phase change, repeat program item or stream
+    #   frame, or None if nothing is scheduled.
+    def nextPhase(self):
+        with self.lock:
+            times = [p['nextPhase'] for p in self.pumps if p]
+            if self.program:
+                times.append(self.program['next'])
+            if self.streamDue() is not None:
+                times.append(self.streamDue())
+        return min(times) if times else None
+
+    # FirmwareModel.writePins: sets pins, recording the ones that change in the timeline.
+    def writePins(self, now, pins, states):
+        for pin, state in zip(pins, states):
+            if pin in self.pins and self.pins[pin] != state:
+                self.pins[pin] = state
+                self.timeline.append((now, pin, state))
+
+    # FirmwareModel.pinTimeline: returns the recorded pin changes.
+    #   Input:
+    #       pin - only return the changes of this pin, or None for all pins
+    #   Output: list of (time, pin, state)
+    def pinTimeline(self, pin = None):
+        with self.lock:
+            return [change for change in self.timeline if pin is None or change[1] == pin]
+
+
+# SimulatedSerial: an object with the parts of the pyserial Serial interface the controllers use, connected to a
+# FirmwareModel instead of a port.
+class SimulatedSerial:
+
+    # SimulatedSerial.__init__
+    #   Inputs:
+    #       model - the FirmwareModel to talk to
+    #       timeout - read timeout in seconds. Reads only wait while a stream is playing, for the model to send
+    #           something; otherwise every reply is ready as soon as its frame is written.
+    def __init__(self, model, timeout = 0.1):
+        self.model = model
+        self.timeout = timeout
+        self.received = ""
+        self.open = True
+
+    def write(self, data):
+        if not self.open:
+            raise IOError("The simulated port is closed.")
+        if isinstance(data, bytes):
+            data = data.decode('ascii')
+        reply = self.model.receive(data)
+        self._collect()
+        self.received += reply
+        return len(data)
+
+    # SimulatedSerial._collect: advances the model to the current time and receives what it has sent on its own.
+    def _collect(self):
+        self.model.runPumps(clock())
+        self.received += "".join([message for sent, message in self.model.takeOutput()])
+
+    # SimulatedSerial.readline: returns up to and including the next newline, or everything received if there is no
+    #   newline (as pyserial does when a read times out).
+    def readline(self):
+        self._collect()
+        deadline = clock() + self.timeout
+        while '\n' not in self.received and self.model.streamActive() and clock() < deadline:
+            time.sleep(max(0, min(self.model.nextPhase() or deadline, deadline) - clock()))
+            self._collect()
+        end = self.received.find('\n') + 1 or len(self.received)
+        line, self.received = self.received[:end], self.received[end:]
+        return line.encode('ascii')
+
+    def isOpen(self):
+        return self.open
+
+    def close(self):
+        self.open = False
+
+
+# SimulatedValveController: a KATARAValveController connected to a FirmwareModel. The port name is only used as a
+# label. The model is kept across reconnects, like a real board that keeps its pin states.
+class SimulatedValveController(KATARAValveController):
+    deviceType = "Simulated KATARA device"
+    resetDelay = 0
+
+    # SimulatedValveController.openSerial: connects to the simulated firmware instead of a serial port.
+    def openSerial(self, port, timeout, reset = True):
+        if not hasattr(self, 'model'):
+            self.model = FirmwareModel()
+        return SimulatedSerial(self.model, timeout)
@@ -0,0 +1,211 @@
+#MIT License
+#
+#Copyright (c) 2017 Jonathan A. White
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+
+
+import os
+import mmap
+import struct
+import threading
+import time
+import ValveTrace
+from ValveTrace import stepContext, PUMP_FORWARD, PUMP_REVERSE, PUMP_STOP
+from SerialMetrics import clock
+
+# StateExport publishes the live state of a controller in a memory-mapped file, so that other programs on the same
+# computer, for example imaging software that needs the valve states at its frame rate, can read it without going
+# through the GUI: no copies, no messages, no round trips.
+#
+# A StateExporter is attached to a controller (ValveController.attachExporter, or config.stateExportFile). After each
+# valve or pump command, and whenever a step starts (ValveTrace.setStepContext), it writes the whole state: the wall
+# clock and monotonic clock times, the mask of energized pins, the running step and its loop iterations, and the
+# pumps with the times they end. The file is updated with a seqlock: the writer makes the sequence number odd, writes
+# the state and makes it even again; a reader copies the state and retries if the number was odd or changed meanwhile.
+# Readers use StateReader, or any language that can map a file and read the layout below (little endian):
+#
+#   offset 0   8 bytes  magic, "KATSTAT1"
+#   offset 8   uint32   layout version (1)
+#   offset 16  uint64   sequence number, odd while the state is being written
+#   offset 24  state:   float64 wall clock time (time.time()) and float64 monotonic time (SerialMetrics.clock, the
+#                       host's monotonic clock) of the update; uint64 x2 pin mask, bits 0-63 then 64-127 (bit n is
+#                       pin n); uint32 step number, 0 outside protocols; uint8 loop depth and int32 x8 loop
+#                       iterations, innermost first; then for each of 4 pump slots uint8 x3 valves, uint8 direction
+#                       (1 forward, 2 reverse, 0 empty slot) and float64 monotonic time the pump ends (inf if it runs
+#                       until stopped); uint64 number of updates.
+
+magic = b'KATSTAT1'
+version = 1
+header = struct.Struct('<8sI')
+sequenceOffset = 16
+sequenceStruct = struct.Struct('<Q')
+stateOffset = 24
+maxDepth = 8
+maxPumps = 4 # pump slots in the firmware
+state = struct.Struct('<ddQQIB' + str(maxDepth) + 'i' + '3BBd'*maxPumps + 'Q')
+fileSize = stateOffset + state.size
+
+exporters = {} # open StateExporter by absolute path
+
+
+# StateExporter: writes the state of one controller to a state file.
+class StateExporter:
+
+    # StateExporter.open: returns the exporter of a state file, opening it if no controller has it open. Only one
+    #   controller in a process exports to a file at a time, so with several boards the first board is exported.
+    #   Input:
+    #       path - the state file
+    #   Output: StateExporter, or None if another controller has the file open
+    @staticmethod
+    def open(path):
+        path = os.path.abspath(path)
+        if path in exporters:
+            return None
+        exporters[path] = StateExporter(path)
+        return exporters[path]
+
+    # StateExporter.__init__: maps the state file, creating it if it does not exist. An existing state file is reused
+    #   so that its readers keep working, e.g. while a protocol runs in a worker process (see ProcessExecutor).
+    #   Input:
+    #       path - the state file
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.lock = threading.Lock()
+        self.mask = 0
+        self.pumps = [] # (valves, direction, end time) of running pumps
+        self.updates = 0
+        self.file = open(self.path, 'r+b' if os.path.exists(self.path) else 'w+b')
+        if os.path.getsize(self.path) != fileSize:
+            self.file.truncate(fileSize)
+        self.map = mmap.mmap(self.file.fileno(), fileSize)
+        if self.map[:len(magic)] != magic:
+            self.map[:fileSize] = b'\0'*fileSize
+            header.pack_into(self.map, 0, magic, version)
+        ValveTrace.stepListeners.append(self.stepChanged)
+
+    # StateExporter.publish: records a command's effect on the valves and writes the state. Called by the controller
+    #   after each command (see ValveController._recordTransition).
+    #   Inputs:
+    #       mask - integer bit mask of energized pins after the command
+    #       pumpEvent - pump event code from ValveTrace, NO_PUMP for valve commands
+    #       pumpValves - the pump's three valves for pump events
+    #       pumpSeconds - seconds a started pump runs, inf if until stopped
+    #   Output: None
+    def publish(self, mask, pumpEvent = ValveTrace.NO_PUMP, pumpValves = (0, 0, 0), pumpSeconds = float('Inf')):
+        with self.lock:
+            now = clock()
+            self.mask = mask
+            valves = tuple(pumpValves)
+            if pumpEvent:
+                self.pumps = [p for p in self.pumps if p[0] != valves and p[2] > now]
+            if pumpEvent in (PUMP_FORWARD, PUMP_REVERSE):
+                self.pumps = (self.pumps + [(valves, pumpEvent, now + pumpSeconds)])[-maxPumps:]
+            self._write(now)
+
+    # StateExporter.stepChanged: writes the state with a new step. Called from ValveTrace.setStepContext.
+    def stepChanged(self):
+        with self.lock:
+            self._write(clock())
+
+    # StateExporter._write: writes the state under the seqlock. The caller holds self.lock.
+    def _write(self, now):
+        stepId = getattr(stepContext, 'stepId', 0)
+        iters = tuple(getattr(stepContext, 'iters', ()))[:maxDepth]
+        pumps = []
+        for k in range(maxPumps):
+            if k < len(self.pumps):
+                valves, direction, end = self.pumps[k]
+                pumps += [valves[0], valves[1], valves[2], direction, end]
+            else:
+                pumps += [0, 0, 0, 0, 0.0]
+        self.updates += 1
+        sequence, = sequenceStruct.unpack_from(self.map, sequenceOffset)
+        sequence += 1 + sequence % 2 # the next odd number, also if a writer stopped halfway
+        sequenceStruct.pack_into(self.map, sequenceOffset, sequence)
+        state.pack_into(self.map, stateOffset, time.time(), now, self.mask & 0xFFFFFFFFFFFFFFFF, self.mask >> 64,
+                        stepId, len(iters), *(iters + (0,)*(maxDepth - len(iters)) + tuple(pumps) + (self.updates,)))
+        sequenceStruct.pack_into(self.map, sequenceOffset, sequence + 1)
+
+    # StateExporter.close: stops exporting. The file is left with the last state.
+    def close(self):
+        with self.lock:
+            if self.map is None:
+                return
+            try:
+                ValveTrace.stepListeners.remove(self.stepChanged)
+            except ValueError:
+                pass
+            exporters.pop(self.path, None)
+            self.map.close()
+            self.file.close()
+            self.map = None
+
+
+# StateReader: reads a state file written by a StateExporter, for use by other programs:
+#
+#   reader = StateReader("KATARA_state.bin")
+#   snapshot = reader.read()
+#   if reader.pinState(snapshot, 12): ...
+class StateReader:
+
+    # StateReader.__init__: maps the state file read only.
+    #   Input:
+    #       path - the state file
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), fileSize, access = mmap.ACCESS_READ)
+        if self.map[:len(magic)] != magic:
+            raise ValueError("Error: " + path + " is not a KATARA state file.")
+
+    # StateReader.sequence: returns the sequence number, which changes with every update; an even number once the
+    #   update is complete. Polling it is the cheapest way to wait for a change.
+    def sequence(self):
+        return sequenceStruct.unpack_from(self.map, sequenceOffset)[0]
+
+    # StateReader.read: returns a consistent copy of the state.
+    #   Inputs: None
+    #   Output: dictionary with the sequence number, 'time' (wall clock), 'clock' (monotonic), 'mask' (pin mask),
+    #       'stepId', 'iters' (tuple, innermost loop first), 'pumps' (list of (valves, direction, end time) of the pumps
+    #       running at the time of the update) and 'updates'
+    def read(self):
+        while True:
+            sequence = self.sequence()
+            if sequence % 2 == 0:
+                values = state.unpack_from(self.map, stateOffset)
+                if self.sequence() == sequence:
+                    break
+            time.sleep(0)
+        wall, now, low, high, stepId, depth = values[:6]
+        iters = values[6:6 + maxDepth]
+        slots = values[6 + maxDepth:-1]
+        pumps = []
+        for k in range(0, len(slots), 5):
+            if slots[k + 3] and slots[k + 4] > now:
+                pumps.append((slots[k:k + 3], slots[k + 3], slots[k + 4]))
+        return {'sequence': sequence, 'time': wall, 'clock': now, 'mask': low | (high << 64), 'stepId': stepId,
+                'iters': tuple(iters[:depth]), 'pumps': pumps, 'updates': values[-1]}
+
+    # StateReader.pinState: returns 1 if a pin is energized in a state read by StateReader.read, 0 if not.
+    def pinState(self, snapshot, pin):
+        return (snapshot['mask'] >> pin) & 1
+
+    # StateReader.pumping: returns the valves of the pumps running at a time, from a state read by StateReader.read.
+    #   Inputs:
+    #       snapshot - the state
+    #       now - monotonic time (SerialMetrics.clock), the current time if None
+    #   Output: set of valves
+    def pumping(self, snapshot, now = None):
+        now = clock() if now is None else now
+        return set([v for valves, direction, end in snapshot['pumps'] if end > now for v in valves])
+
+    # StateReader.close: unmaps the file.
+    def close(self):
+        self.map.close()
+        self.file.close()
@@ -13,9 +13,16 @@ try:
 except:
     from tkinter import * #python 3
 import time
+import threading
 from LabelEntry import LabelEntry
 from Protocol_Tools import *
 import config
+from SerialMetrics import clock
+
+# runContext.thread is the RoutineThread running the protocol that the calling thread belongs to. RoutineThread.run
+# sets it and ParallelBlock copies it into its branches, so that protocols running at the same time each see their own
+# cancel event and timer.
+runContext = threading.local()
 
 # Base class for steps in a protocol. Should extend in each usage case for particular kinds of steps on other kinds devices
 # Derived classes should add entries in the draw method, and place entries in self.entries array data member so they can
@@ -24,6 +31,7 @@ class Step:
     NestingRuleStatement = " Python expressions may refer to the iteration of the local loop as i[0], i[1] for the" \
                            " iteration of the loop that the local loop is nested inside, or i[n] for the nth outer" \
                            " loop where n is a natural number."
+    stepId = 0 # number of the step in its protocol, set by Routine.numberSteps; used to tag valve trace records
     parameter = "Step" #derived classes should set their parameter member. This will be used in protocols including
     #  many step types when adding a step, these protocols will prompt the user for what step type they wish to add,
     # and display buttons for each type labeled by their self.parameter member.
@@ -45,6 +53,12 @@ class Step:
 
         self.entries = []  # derived classes should place entry objects in here
 
+    # Step.event, Step.mainthread and Step.timerWidget: the cancel event, main thread and step timer label of the
+    # protocol being run by the calling thread (see RoutineThread).
+    event = property(lambda self: runContext.thread.event)
+    mainthread = property(lambda self: runContext.thread.mainthread)
+    timerWidget = property(lambda self: runContext.thread.timerWidget)
+
     # Step.draw: Draws Step in super Procedure
     # Inputs:
     #       _row - the row in which to draw the step
@@ -115,6 +129,61 @@ class Step:
             print("Check: ", currentIters)
             checkFunction(expression, currentIters)
 
+    # Step.valveKey: Converts a literal valve entry to its key in btndict: an integer for pins on the first board, or a
+    # namespaced string such as "B:12" for pins on other boards (see MultiValveController).
+    # Inputs:
+    #       valve - user entered valve
+    # Outputs: the valve key, or None if the entry is not an available valve (it may still be an expression).
+    def valveKey(self, valve):
+        try:
+            valve = int(valve)
+        except ValueError:
+            valve = str(valve).strip()
+            if ':' not in valve:
+                return None
+        if valve in self.btndict:
+            return valve
+        return None
+
+    # Step.usedValves: Returns the set of valves a step may change over every iteration of the loops it is nested in.
+    # Used by ParallelBlock to check that its branches do not share valves. A plain Step is a pause and uses none;
+    # derived classes that change valves should override it. Call after saveEntries.
+    # Inputs:
+    #       iters - tuple where each entry is the number of iterations in each outer loop, None if not in a loop.
+    # Outputs: set of valve numbers
+    def usedValves(self, iters = None):
+        return set()
+
+    # Step.dependsOnIteration: Checks whether a saved entry refers to the loop iterations, i.
+    # Inputs:
+    #       saved - saved entry
+    # Outputs: True if the entry is an expression using i, or cannot be parsed as a python expression.
+    def dependsOnIteration(self, saved):
+        try:
+            return 'i' in compile(str(saved).strip(), "<entry>", "eval").co_names
+        except SyntaxError:
+            return True
+
+    # Step.repeatActions: Returns what the step does as actions a device can repeat by itself (see
+    # ValveController.runRepeat and Loop.compileRepeat), or None if the step cannot be repeated that way, for example
+    # because its entries depend on the loop iteration. Derived classes that can be repeated should override it. Call
+    # after saveEntries.
+    # Inputs: None
+    # Output: list of actions, or None
+    def repeatActions(self):
+        return None
+
+    # Step.planEvents: Returns what the step does on one iteration of its loops as timed events, so that the protocol
+    # can be run in a separate process (see ProcessExecutor). An event is a (seconds from the start of the step, step
+    # number, loop iterations, action) tuple, where the action is a "pins" or "pump" action of
+    # ValveController.runRepeat, or ("step",) marking the start of a step that only waits. Derived classes that can be
+    # planned should override it. Call after saveEntries.
+    # Inputs:
+    #       iter - tuple of loop iterations. None if the step is not inside a loop.
+    # Output: (list of events, seconds the step takes), or None if the step cannot be planned
+    def planEvents(self, iter = None):
+        return None
+
     # Step.iterToString: When recursive IterCheck fails, feeds the iteration it failed on to an error message.
     # Inputs:
     #       i - tuple object containing the iteration of all parent loops/Protocol which contain this step.
@@ -159,11 +228,13 @@ class Step:
     # Outputs: None
     def pause(self, runtime, cleanup = None, iter = None):
         self.box.config(bg = 'green')
-        start = time.time()#clock()
-        while time.time() - start < runtime:#clock() - start < runtime:
-            self.timerWidget.config(text = "Step Runtime (s): " + str(int(time.time()-start)))#time.clock() - start)))
-            self.event.wait(0.01) #event set in RoutineThread initialization
+        routine = runContext.thread
+        start = routine.stepStart(runtime) # the previous queued protocol's deadline for its first step (see RunQueue)
+        while clock() - start < runtime:
+            self.timerWidget.config(text = "Step Runtime (s): " + str(int(clock()-start)))
+            self.event.wait(min(0.01, max(0, runtime - (clock() - start)))) #event set in RoutineThread initialization
             self.checkIfCancel(cleanup = cleanup)
+        routine.stepEnded(start + runtime)
         self.timerWidget.config(text = '')
         self.timerWidget.grid_forget()
         try:
@@ -185,7 +256,6 @@ class Step:
             except:
                 self.box.config(bg='gray')
             self.timerWidget.config(text="")
-            config.stopEditing = False
             if cleanup:
                 cleanup()  # clean up step before ending
             self.mainthread.join()  # mainthread set in ProcedureThread initialization
@@ -16,6 +16,7 @@ try:
 except:
     from tkinter import * #python 3
 from ValveController import ValveController
+from ValveTrace import setStepContext
 
 # ValveSteps are Steps in a Routine that open or close valves.
 class ValveStep(Step):
@@ -42,15 +43,16 @@ class ValveStep(Step):
     #               is stored in i[0], the first outer loop in i[1], and the nth outer loop in i[n].
     #   Output: None
     def run(self, cleanup = None, iter = None):
+        setStepContext(self.stepId, iter)
         valves = []
         states = []
         for j in range(len(self.Valve.saved)):
             i = iter
-            if self.Valve.expression:
+            if self.Valve.expression[j]:
                 valves.append(eval(self.Valve.saved[j], {}, {'i' : i}))
             else:
-                valves.append(int(self.Valve.saved[j]))
-            if self.State.expression:
+                valves.append(self.valveKey(self.Valve.saved[j]))
+            if self.State.expression[j]:
                 states.append(eval(self.State.saved[j], {}, {'i' : i}))
             else:
                 states.append(int(self.State.saved[j]))
@@ -62,6 +64,41 @@ class ValveStep(Step):
         Step.pause(self, 0)
         self.checkIfCancel()
 
+    # ValveStep.repeatActions: Returns the step as a "pins" action if none of its entries depend on the loop iteration
+    #   and every valve is on the first board (see Step.repeatActions).
+    #   Inputs: None
+    #   Output: list of actions, or None
+    def repeatActions(self):
+        valves = []
+        states = []
+        for j in range(len(self.Valve.saved)):
+            valve, state = self.Valve.saved[j], self.State.saved[j]
+            if self.dependsOnIteration(valve) or self.dependsOnIteration(state):
+                return None
+            valves.append(eval(valve, {}, {}) if self.Valve.expression[j] else self.valveKey(valve))
+            states.append(eval(state, {}, {}) if self.State.expression[j] else int(state))
+        if [v for v in valves if type(v) != int]:
+            return None
+        return [("pins", valves, states)]
+
+    # ValveStep.planEvents: Returns the step as a "pins" event for the given loop iteration (see Step.planEvents).
+    #   Input:
+    #       iter - tuple of loop iterations, None if the step is not inside a loop
+    #   Output: (list of events, 0)
+    def planEvents(self, iter = None):
+        valves = []
+        states = []
+        for j in range(len(self.Valve.saved)):
+            if self.Valve.expression[j]:
+                valves.append(eval(self.Valve.saved[j], {}, {'i' : iter}))
+            else:
+                valves.append(self.valveKey(self.Valve.saved[j]))
+            if self.State.expression[j]:
+                states.append(eval(self.State.saved[j], {}, {'i' : iter}))
+            else:
+                states.append(int(self.State.saved[j]))
+        return [(0, self.stepId, iter, ("pins", valves, states))], 0
+
     # ValveStep.saveEntries: save user entries for running or writing to file
     #   Inputs:
     #       type - data type that entries should be. Valve entries should be ints.
@@ -106,13 +143,8 @@ class ValveStep(Step):
     #               is stored in i[0], the first outer loop in i[1], and the nth outer loop in i[n].
     #       listNum - the position in the comma separated list of user entered valves/states.
     def checkValveStateEntry(self, valve, state, iters, listNum = None):
-        if not iters: # just look for integers
-            try:
-                valve1 = int(valve)
-            except:
-                raise ValueError(valve + " is not an available valve. Available valves are "
-                                 + self.btndict["AvailablePinsStatement"] + ".")
-            if valve1 not in self.btndict:
+        if not iters: # just look for integers or namespaced valves
+            if self.valveKey(valve) is None:
                 raise ValueError(valve + " is not an available valve. Available valves are "
                                  + self.btndict["AvailablePinsStatement"] + ".")
             if state not in ("0", "1"):
@@ -125,7 +157,8 @@ class ValveStep(Step):
             valve = int(valve)
             valveIsInt = True
         except:
-            valveIsInt = False
+            valveIsInt = self.valveKey(valve) is not None # a valve on another board, for example B:12
+            valve = valve.strip() if valveIsInt else valve
         if valveIsInt:
             if valve not in self.btndict:
                 raise ValueError("Valve " + str(valve) + " is not available. Available valves are "
@@ -193,6 +226,19 @@ class ValveStep(Step):
                              " or a python expression evaluating to 1 or 0. For interation " + self.iterToString(i)
                              +" the expression evaluates to " + str(state) + ".")
 
+    # ValveStep.usedValves: Returns the set of valves this step sets over every iteration of its outer loops.
+    #   Inputs:
+    #       iters - tuple of the number of iterations of each outer loop, None if the step is not inside a loop.
+    #   Output: set of valve numbers
+    def usedValves(self, iters = None):
+        valves = set()
+        for j, valve in enumerate(self.Valve.saved):
+            if self.Valve.expression[j]:
+                self.recursiveIterCheck(iters, valve, lambda expr, i: valves.add(eval(expr, {}, {'i': i})), ())
+            else:
+                valves.add(self.valveKey(valve))
+        return valves
+
     # ValveStep.setValves: Sends a serial command through a ValveController object to set valve states. Set upon
     # ValveController object's initialization in the KATARAGUI.connect method.
     #   Inputs:
@@ -241,13 +287,9 @@ class PumpStep(Step):
         for v in self.valveEntries:
             v0 = v.get()
             valves.append(v0)
-            try:
-                v1 = int(v0)
-                if v1 not in self.btndict:
-                    raise ValueError(v0 + " in pump step is not a valid valve. Valid valves are " +
-                                     self.btndict["AvailablePinsStatement"] + ".")
+            if self.valveKey(v0) is not None:
                 v.expression = False
-            except:
+            else:
                 if not iters:
                     raise ValueError(v0 + " in pump step is not a valid valve. Valid valves are " +
                                  self.btndict["AvailablePinsStatement"] + ".")
@@ -371,14 +413,14 @@ class PumpStep(Step):
     #       color - the color to change the valve button to.
     #   Output: None
     def changeValveColor(self, color):
-        for v in self.pump.valves:
-            Step.btndict[int(v)].config(bg=color)
+        for v in self.pump.valveKeys:
+            Step.btndict[v].config(bg=color)
 
     # PumpStep.cleanup: Resests GUI after finishing pump sequence.
     #   Inputs: None
     #   Outputs: None
     def cleanup(self): #call this method if a protocol is canceled in the middle of a pump step
-        self.pump.ctlr.ser.write("c")
+        self.pump.stop() # stops only this pump; protocols running at the same time keep theirs
         self.changeValveColor("gray")
 
     # PumpStep.run: runs the pump sequence.
@@ -389,16 +431,13 @@ class PumpStep(Step):
     #   Outputs: None
     #def run(self, cleanup = None, iter = None, time = None):
     def run(self, iter=None, time=None):
+        setStepContext(self.stepId, iter)
         i = iter
 
         valves = []
         for v in self.valveEntries:
-            if v.expression:
-                valves.append(eval(v.saved, {}, {'i' : i}))
-            else:
-                valves.append(v.saved)
+            valves.append(self.evalValve(v.saved, i))
         self.pump = self.specifyPump(valves[0], valves[1], valves[2])
-        ValveController.pPumps.remove(self.pump)
         self.changeValveColor("Blue")
         if self.nCycles.expression:
             nCycles = eval(self.nCycles.saved, {}, {'i' : i})
@@ -413,9 +452,59 @@ class PumpStep(Step):
             Step.pause(self, float('Inf'), cleanup=self.cleanup)
         else:
             Step.pause(self, float(nCycles)/float(rate), cleanup=self.cleanup)
-        Step.pause(self, time, cleanup = self.cleanup)
+        if time:
+            Step.pause(self, time, cleanup = self.cleanup)
         self.changeValveColor("gray")
 
+    # PumpStep.repeatActions: Returns the step as a "pump" action followed by a pause while it pumps, if none of its
+    #   entries depend on the loop iteration and its valves are on the first board (see Step.repeatActions).
+    #   Inputs: None
+    #   Output: list of actions, or None
+    def repeatActions(self):
+        entries = [v.saved for v in self.valveEntries] + [self.rate.saved, self.nCycles.saved]
+        if [e for e in entries if self.dependsOnIteration(e)]:
+            return None
+        valves = [self.evalValve(v.saved, None) for v in self.valveEntries]
+        rate = eval(self.rate.saved, {}, {}) if self.rate.expression else self.rate.saved
+        nCycles = eval(self.nCycles.saved, {}, {}) if self.nCycles.expression else self.nCycles.saved
+        if [v for v in valves if type(v) != int] or nCycles == -1:
+            return None
+        return [("pump", 'f', valves, rate, nCycles), ("pause", float(nCycles)/float(rate))]
+
+    # PumpStep.planEvents: Returns the step as a "pump" event for the given loop iteration, taking as long as the pump
+    #   runs (see Step.planEvents). A pump that runs until the protocol is cancelled takes forever.
+    #   Input:
+    #       iter - tuple of loop iterations, None if the step is not inside a loop
+    #   Output: (list of events, seconds the pump runs)
+    def planEvents(self, iter = None):
+        valves = [self.evalValve(v.saved, iter) for v in self.valveEntries]
+        rate = eval(self.rate.saved, {}, {'i' : iter}) if self.rate.expression else self.rate.saved
+        nCycles = eval(self.nCycles.saved, {}, {'i' : iter}) if self.nCycles.expression else self.nCycles.saved
+        duration = float('Inf') if nCycles == -1 else float(nCycles)/float(rate)
+        return [(0, self.stepId, iter, ("pump", 'f', valves, rate, nCycles))], duration
+
+    # PumpStep.usedValves: Returns the set of valves this pump actuates over every iteration of its outer loops.
+    #   Inputs:
+    #       iters - tuple of the number of iterations of each outer loop, None if the step is not inside a loop.
+    #   Output: set of valve numbers
+    def usedValves(self, iters = None):
+        valves = set()
+        for v in self.valveEntries:
+            self.recursiveIterCheck(iters or (), v.saved, lambda saved, i: valves.add(self.evalValve(saved, i)), ())
+        return valves
+
+    # PumpStep.evalValve: Returns the valve for a saved valve entry on a given loop iteration. Step.saveEntries marks
+    # namespaced valves such as B:12 as expressions, so literal valves are recognized before evaluating.
+    #   Inputs:
+    #       saved - saved valve entry
+    #       i - tuple of the iterations of all outer loops
+    #   Output: the valve
+    def evalValve(self, saved, i):
+        valve = self.valveKey(saved)
+        if valve is None:
+            valve = eval(saved, {}, {'i': i})
+        return valve
+
     # PumpStep.checkValidValveEntry: If PumpStep is in a loop and has an expression entry for a valve as a function
     # of the loop iteration, checkValidValve checks whether the expression evaluates to a valid valve on
     # the given iteration.
@@ -446,7 +535,7 @@ class PumpStep(Step):
     def checkDuplicateValves(self, valves, i):
         evaledValves = []
         for v in valves:
-            evaledValves.append(eval(v, {}, {'i':i}))
+            evaledValves.append(self.evalValve(v, i))
         if len(set(evaledValves)) < 3:
             raise ValueError("There are duplicate valves on iteration " + self.iterToString(i))
 
@@ -504,6 +593,23 @@ class PauseStep(Step):
 
 
 
+    # PauseStep.repeatActions: Returns the step as a "pause" action if its time does not depend on the loop iteration
+    #   (see Step.repeatActions).
+    #   Inputs: None
+    #   Output: list of actions, or None
+    def repeatActions(self):
+        if self.dependsOnIteration(self.time.saved):
+            return None
+        return [("pause", float(eval(self.time.saved, {}, {}) if self.time.expression else self.time.saved))]
+
+    # PauseStep.planEvents: Returns the start of the pause as an event and its length (see Step.planEvents).
+    #   Input:
+    #       iter - tuple of loop iterations, None if the step is not inside a loop
+    #   Output: (list of events, seconds to pause)
+    def planEvents(self, iter = None):
+        runtime = eval(self.time.saved, {}, {'i' : iter}) if self.time.expression else self.time.saved
+        return [(0, self.stepId, iter, ("step",))], float(runtime)
+
     # Step.run pauses the protocol. The function is still called run to allow duck typing.
     #   Input:
     #       cleanup - function to cleanup after step: None for Step.run
@@ -511,6 +617,7 @@ class PauseStep(Step):
     #       position, the outer-most loop is in the last position.
     #   Output: None
     def run(self, iter = None):
+        setStepContext(self.stepId, iter)
         i = iter
         if self.time.expression:
             runtime = eval(self.time.saved, {}, {'i' : i})
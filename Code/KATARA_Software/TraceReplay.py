@@ -0,0 +1,176 @@
+#MIT License
+#
+#Copyright (c) 2017 Jonathan A. White
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+
+import time
+import os
+import tempfile
+from collections import OrderedDict
+from ValveTrace import *
+from SerialMetrics import clock
+
+# TraceReplay replays a recorded valve trace (see ValveTrace) through a ValveController, normally a
+# SimulatedValveController, while recording a new trace of what the controller did. Comparing the two traces step by
+# step shows changes in command order or timing between software versions before they reach the bench.
+#
+# Traces store the pins energized after each command and the pump events, not the pump rate or cycles, so pumps are
+# replayed as continuous pumping at 1 Hz until their recorded stop.
+
+replayRate = 1
+
+
+# replayTrace: drives a controller with the commands recorded in a trace.
+#   Inputs:
+#       trace - a trace file path, or a trace read with readTrace
+#       ctlr - the ValveController to drive. Its attached recorder, if any, is replaced.
+#       outPath - file for the trace of the replay. A temporary file is used if None.
+#       realtime - if True each command is issued at its recorded time (scaled by speed) after the first; if False the
+#           commands are issued as fast as possible.
+#       speed - playback speed factor when realtime is True
+#   Output: the trace of the replay, as returned by readTrace
+def replayTrace(trace, ctlr, outPath = None, realtime = True, speed = 1.0):
+    if not isinstance(trace, dict):
+        trace = readTrace(trace)
+    if speed <= 0:
+        raise ValueError("Error: replay speed must be positive.")
+    if outPath is None:
+        handle, outPath = tempfile.mkstemp(suffix = ".kvt")
+        os.close(handle)
+    ctlr.attachRecorder(ValveTraceRecorder(outPath))
+    pumps = {} # (v1, v2, v3): pump, so that each pump is specified once
+    times = trace['time']
+    mask = ctlr.pinMask()
+    try:
+        start = clock()
+        for k in range(len(times)):
+            if realtime:
+                delay = (times[k] - times[0])/speed - (clock() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            setStepContext(trace['stepId'][k], tuple(trace['iterations'][k][:trace['depth'][k]]))
+            event = trace['pumpEvent'][k]
+            if event == NO_PUMP:
+                changed = mask ^ trace['mask'][k]
+                pins = maskToPins(changed)
+                ctlr.setPins(pins, [(trace['mask'][k] >> p) & 1 for p in pins])
+            else:
+                valves = trace['pumpValves'][k]
+                if valves not in pumps:
+                    pumps[valves] = ctlr.specifyPump(*valves)
+                if event == PUMP_FORWARD:
+                    pumps[valves].forward(replayRate, -1)
+                elif event == PUMP_REVERSE:
+                    pumps[valves].reverse(replayRate, -1)
+                else:
+                    pumps[valves].stop()
+            mask = ctlr.pinMask()
+    finally:
+        setStepContext(0)
+        ctlr.attachRecorder(None)
+    return readTrace(outPath)
+
+
+# compareTraces: compares a replayed trace to the original, step by step.
+#   Inputs:
+#       original - the recorded trace (path or readTrace result)
+#       replayed - the trace produced by replayTrace (path or readTrace result)
+#   Output: dictionary with
+#       'steps' - OrderedDict keyed by step id, each holding the record counts of both traces, the number of records
+#           whose pin mask, pump event, pump valves or loop iterations differ, and the maximum and mean difference in
+#           time since the start of the trace (seconds, replayed minus original)
+#       'firstDivergence' - index of the first record that differs in anything but time, or None
+#       'lengths' - record counts of both traces
+def compareTraces(original, replayed):
+    traces = []
+    for trace in (original, replayed):
+        traces.append(trace if isinstance(trace, dict) else readTrace(trace))
+    original, replayed = traces
+    fields = ('mask', 'pumpEvent', 'pumpValves', 'iterations')
+
+    def records(trace):
+        byStep = OrderedDict()
+        t0 = trace['time'][0] if trace['time'] else 0
+        for k in range(len(trace['time'])):
+            byStep.setdefault(trace['stepId'][k], []).append(k)
+        return byStep, t0
+
+    originalSteps, originalStart = records(original)
+    replayedSteps, replayedStart = records(replayed)
+    steps = OrderedDict()
+    for stepId in list(originalSteps) + [s for s in replayedSteps if s not in originalSteps]:
+        a = originalSteps.get(stepId, [])
+        b = replayedSteps.get(stepId, [])
+        result = {'original': len(a), 'replayed': len(b), 'drift': 0.0, 'meanDrift': 0.0}
+        for field in fields:
+            result[field] = 0
+        drifts = []
+        for j, k in zip(a, b):
+            for field in fields:
+                if original[field][j] != replayed[field][k]:
+                    result[field] += 1
+            drifts.append((replayed['time'][k] - replayedStart) - (original['time'][j] - originalStart))
+        if drifts:
+            result['drift'] = max(drifts, key = abs)
+            result['meanDrift'] = sum(drifts)/len(drifts)
+        steps[stepId] = result
+
+    firstDivergence = None
+    n = min(len(original['time']), len(replayed['time']))
+    for k in range(n):
+        if original['stepId'][k] != replayed['stepId'][k] or \
+                [original[f][k] for f in fields] != [replayed[f][k] for f in fields]:
+            firstDivergence = k
+            break
+    if firstDivergence is None and len(original['time']) != len(replayed['time']):
+        firstDivergence = n
+    return {'steps': steps, 'firstDivergence': firstDivergence,
+            'lengths': (len(original['time']), len(replayed['time']))}
+
+
+# formatReport: formats the result of compareTraces as a table with one line per step.
+#   Input:
+#       report - dictionary returned by compareTraces
+#   Output: string
+def formatReport(report):
+    lines = ["%6s %8s %8s %6s %6s %6s %6s %11s %11s" % ("step", "original", "replayed", "pins", "pump", "valves",
+                                                          "iters", "max drift", "mean drift")]
+    for stepId, r in report['steps'].items():
+        lines.append("%6d %8d %8d %6d %6d %6d %6d %+10.4fs %+10.4fs" % (
+            stepId, r['original'], r['replayed'], r['mask'], r['pumpEvent'], r['pumpValves'], r['iterations'],
+            r['drift'], r['meanDrift']))
+    if report['firstDivergence'] is None:
+        lines.append("The command streams match (%d records)." % report['lengths'][0])
+    else:
+        lines.append("The command streams diverge at record %d (%d original records, %d replayed)." % (
+            (report['firstDivergence'],) + report['lengths']))
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description = "Replay a KATARA valve trace and compare the result to it.")
+    parser.add_argument("trace", help = "recorded valve trace (.kvt)")
+    parser.add_argument("--fast", action = "store_true", help = "issue commands as fast as possible")
+    parser.add_argument("--speed", type = float, default = 1.0, help = "playback speed factor")
+    parser.add_argument("--port", help = "replay on the device at this serial port instead of a simulated device")
+    parser.add_argument("--out", help = "file for the trace of the replay")
+    args = parser.parse_args()
+    if args.port:
+        from KATARAValveController import KATARAValveController
+        ctlr = KATARAValveController(args.port)
+    else:
+        from SimulatedDevice import SimulatedValveController
+        ctlr = SimulatedValveController("simulated")
+    try:
+        replayed = replayTrace(args.trace, ctlr, args.out, not args.fast, args.speed)
+    finally:
+        ctlr.close()
+    print(formatReport(compareTraces(args.trace, replayed)))
@@ -18,8 +18,11 @@ except:
 from Protocol_Tools import *
 from Step import Step
 from LabelEntry import LabelEntry
-import serial
-from serial.tools import list_ports
+from threading import Thread
+try:
+    import Queue as queue #python 2.7
+except:
+    import queue #python 3
 
 
 #Serves as a base class for GUIs connecting USB devices.
@@ -53,38 +56,110 @@ class usbGUI:
         #event is generated, eg created, something is changed inside window like adding or deleting a step.
 
 
-        #Initialize the menu bar and connect menu.
+        #Initialize the menu bar and connect menu. The connected devices are found in the background (see
+        # usbGUI.findPorts) so that the window does not wait on the port scan.
+        self.ports = None # (port, description) of the connected usb devices, None until the first scan finishes
+        self.portSearch = None
+        self.foundPorts = queue.Queue() # devices found by the scan thread, for the GUI thread to pick up
+        self.portPolling = False # whether usbGUI.checkPorts is scheduled
+        self.portMenus = [] # (menu, function to call with the chosen port) for each menu that lists the devices
         self.menubar = Menu(master)
         #self.menubar.config(bg ='red')
         self.connectmenu = Menu(self.menubar, tearoff=0)
         self.connectmenu.config(postcommand = self.resetConnectMenu)
-        self.populateConnectMenu()
+        self.addPortMenu(self.connectmenu, self.connect)
         self.menubar.add_cascade(label="Connect", menu=self.connectmenu)
+        self.findPorts()
 
         master.config(menu=self.menubar)
 
         self.device = None #not yet initialized
 
-    # usbGUI.resetConnectMenu: Called when the user clicks on the "Connect" dropdown menu- checks what USB devices are
-    #   connected and updates the dropdown menu to list those devices.
+    # usbGUI.addPortMenu: Adds a menu that lists the connected usb devices. It is filled from the last port scan.
+    # Inputs:
+    #       menu - the menu
+    #       command - function called with the port name when a device is chosen
+    # Outputs: None
+    def addPortMenu(self, menu, command):
+        self.portMenus.append((menu, command))
+        self.fillPortMenu(menu, command)
+
+    # usbGUI.resetConnectMenu: Called when the user clicks on the "Connect" dropdown menu- lists the devices found by
+    #   the last scan and checks again what USB devices are connected, updating the menu when the scan finishes.
     # Inputs: None
     # Outputs: None
     def resetConnectMenu(self):
-        # First, delete currently listed devices
-        nCommands = len(self.connectmenu._tclCommands)
-        self.connectmenu.delete(0, nCommands)
-        #Now check devices and then add them.
         self.populateConnectMenu()
+        self.findPorts()
 
-
-    # usbGUI.populateConnectMenu: Checks what usb devices are connected to the computer and adds them to a list to be
-    #   shown in the connect dropdown menu
+    # usbGUI.populateConnectMenu: Lists the usb devices found by the last port scan in every port menu. Called when a
+    #   scan finishes (see usbGUI.checkPorts) and when a menu is opened.
     # Inputs: None
     # Outputs: None
     def populateConnectMenu(self):
-        ports = [port for port in serial.tools.list_ports.comports() if port[2] != 'n/a']
-        for port in ports:
-            self.connectmenu.add_command(label=port[1], command=lambda prt=port[0]: self.connect(prt))
+        for menu, command in self.portMenus:
+            self.fillPortMenu(menu, command)
+
+    # usbGUI.fillPortMenu: replaces the entries of a port menu with the devices found by the last port scan.
+    # Inputs:
+    #       menu - the menu
+    #       command - function called with the port name when a device is chosen
+    # Outputs: None
+    def fillPortMenu(self, menu, command):
+        menu.delete(0, END)
+        if self.ports is None:
+            menu.add_command(label="Searching for devices...", state=DISABLED)
+        elif not self.ports:
+            menu.add_command(label="No devices found", state=DISABLED)
+        for port in self.ports or []:
+            menu.add_command(label=port[1], command=lambda prt=port[0]: command(prt))
+
+    # usbGUI.findPorts: Starts a scan of the connected usb devices on another thread, unless one is running already.
+    #   The thread puts the devices on self.foundPorts, where usbGUI.checkPorts picks them up on the GUI thread.
+    # Inputs: None
+    # Outputs: None
+    def findPorts(self):
+        if self.portSearch and self.portSearch.is_alive():
+            return
+        self.portSearch = Thread(target = self.scanPorts)
+        self.portSearch.daemon = True
+        self.portSearch.start()
+        if not self.portPolling:
+            self.portPolling = True
+            self.mainframe.after(RunQueue.pollInterval, self.checkPorts)
+
+    # usbGUI.checkPorts: Runs on the GUI thread while a port scan is going on. Saves the devices found by the scan in
+    #   self.ports and updates the port menus, or checks again after RunQueue.pollInterval milliseconds if the scan
+    #   has not finished. Tkinter is not thread safe, so the scan thread never touches the window itself.
+    # Inputs: None
+    # Outputs: None
+    def checkPorts(self):
+        try:
+            ports = self.foundPorts.get_nowait()
+        except queue.Empty:
+            self.mainframe.after(RunQueue.pollInterval, self.checkPorts)
+            return
+        while not self.foundPorts.empty(): # keep the newest scan if several finished
+            ports = self.foundPorts.get_nowait()
+        self.ports = ports
+        self.populateConnectMenu()
+        if self.portSearch.is_alive() or not self.foundPorts.empty(): # a newer scan started after this one finished
+            self.mainframe.after(RunQueue.pollInterval, self.checkPorts)
+        else:
+            self.portPolling = False
+
+    # usbGUI.scanPorts: Checks what usb devices are connected to the computer. Runs on the thread started by
+    #   usbGUI.findPorts. pyserial's port listing is imported here, so that it is not loaded at startup.
+    # Inputs: None
+    # Outputs: None
+    def scanPorts(self):
+        try:
+            from serial.tools import list_ports
+            ports = [(port[0], port[1]) for port in list_ports.comports() if port[2] != 'n/a']
+        except Exception as E:
+            print("Could not list the serial ports: " + str(E))
+            ports = []
+        self.foundPorts.put(ports)
 
     # usbGUI.onFrameConfigure: called whenever a '<Configure>' event is generated (see binding in constructor). This
     # happens when something changes in the window, for example, when a step is added. This method adjuts the frame size
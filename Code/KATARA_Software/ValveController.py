@@ -10,30 +10,75 @@
 
 
 
-import serial
 
 import time
+import threading
+import os
+import weakref
+import config
+from SerialMetrics import SerialMetrics, clock
+from ValveTrace import ValveTraceRecorder, NO_PUMP, maskToPins
+from StateExport import StateExporter
+from PinCoalescer import PinCoalescer, PinUpdate
 
 # Valve Controller is the base class for sending serial communications to valve controlling circuits using the pyserial
 # package by default. The derived class, KATARAValveController sends USB signals interpretable by the KATARA Arduino firmware.
 # Derived classes are not necessarily bound to using the pyserial package if the extender prefers another package.
 class ValveController:
-    pPumps = []
+    pPumps = weakref.WeakSet() # every pump in use; a pump is dropped from the set once nothing refers to it
 
     # ValveController.__init__: Connects to valve controlling device.
     #   Input:
     #       port - string name of the serial port to open.
+    #       reset - False to open the port without resetting the device, for example to take over a device another
+    #           controller was using (see ProcessExecutor)
     #   Output: None, but may raise errors.
-    def __init__(self, port):
+    def __init__(self, port, reset = True):
         #connect to port at default baudrate of 9600
         #set time out to 0.1 second. If arduino does not respond to a read request with in 1/10 second, terminate read.
-        self.ser = serial.Serial(port, timeout = 0.1)
+        self.resetOnOpen = reset # whether the device resets when the port is opened, see openSerial
+        self.ser = self.openSerial(port, 0.1, reset)
+        # serLock serializes each command and its reply so that steps running in parallel branches of a protocol do
+        # not interleave their frames on the serial link.
+        self.serLock = threading.RLock()
+        self.metrics = SerialMetrics(port) # latency and throughput statistics, see SerialMetrics
         self.testConnection()
+        self.metrics.register(config.metricsFile, config.metricsInterval)
+        self.recorder = None # records valve transitions when attached, see ValveController.attachRecorder
+        self.exporter = None # publishes the live state when attached, see ValveController.attachExporter
+        self.coalescer = None # merges pin updates issued close together when attached, see attachCoalescer
+        if config.traceDirectory:
+            name = "KATARA_trace_" + os.path.basename(str(port)) + time.strftime("_%Y%m%d-%H%M%S") + ".kvt"
+            self.attachRecorder(ValveTraceRecorder(os.path.join(config.traceDirectory, name)))
 
 
         # Create a dictionary to keep track of pinStates. The derived class should add entries to this dictionary.
         self.pinStates = {}
         self.pump = perstalticPump
+        # pumps already specified on this controller by valve triple, so repeated pump steps reuse one pump object
+        self.pumpCache = weakref.WeakValueDictionary()
+        if config.stateExportFile:
+            self.attachExporter(StateExporter.open(config.stateExportFile))
+        if config.coalesceWindow:
+            self.attachCoalescer(PinCoalescer(self, config.coalesceWindow))
+
+    # ValveController.openSerial: Opens the serial connection to the device. Override to connect through something
+    #   other than pyserial, for example a simulated device (see SimulatedDevice).
+    #   Inputs:
+    #       port - string name of the serial port to open.
+    #       timeout - read timeout in seconds
+    #       reset - False to keep DTR deasserted while opening the port, so that boards that reset on DTR (such as the
+    #           Arduino Mega) keep running and keep their valve states
+    #   Output: an open pyserial Serial object, or an object with the same write/readline/close/isOpen methods.
+    def openSerial(self, port, timeout, reset = True):
+        import serial # imported on first connection rather than at startup
+        if reset:
+            return serial.Serial(port, timeout = timeout)
+        ser = serial.Serial(timeout = timeout)
+        ser.port = port
+        ser.dtr = False
+        ser.open()
+        return ser
 
     # ValveController.testConnection: An abstract method that tests whether a connection has been made successfully
     #   with the usb device- this will require serial communication specific to the device which should be implemented
@@ -48,7 +93,176 @@ class ValveController:
     # Inputs: None
     # Outputs: None
     def close(self):
+        self.attachCoalescer(None)
         self.ser.close()
+        self.metrics.unregister()
+        if self.recorder:
+            self.recorder.close()
+        if self.exporter:
+            self.exporter.close()
+
+    # ValveController.attachRecorder: records every valve transition made through this controller to a
+    #   ValveTraceRecorder. Any previously attached recorder is closed.
+    # Inputs:
+    #       recorder - a ValveTraceRecorder, or None to stop recording
+    # Outputs: None
+    def attachRecorder(self, recorder):
+        if self.recorder:
+            self.recorder.close()
+        self.recorder = recorder
+
+    # ValveController.attachExporter: publishes the controller's state to a state file from now on (see StateExport).
+    #   Replaces any exporter already attached.
+    # Inputs:
+    #       exporter - a StateExporter, or None to stop exporting
+    # Outputs: None
+    def attachExporter(self, exporter):
+        if self.exporter:
+            self.exporter.close()
+        self.exporter = exporter
+        if exporter:
+            exporter.publish(self.pinMask())
+
+    # ValveController.attachCoalescer: merges the pin updates made with setPinsLater and togglePinLater from now on (see
+    #   PinCoalescer). Any coalescer already attached sends its pending updates and is replaced.
+    # Inputs:
+    #       coalescer - a PinCoalescer for this controller, or None to send each update at once
+    # Outputs: None
+    def attachCoalescer(self, coalescer):
+        if self.coalescer:
+            self.coalescer.close()
+        self.coalescer = coalescer
+
+    # ValveController.setPinsLater: Sets pins through the attached coalescer, if any, without waiting for the device;
+    #   otherwise sets them at once.
+    # Inputs:
+    #       pins - a tuple, list, or set of pins
+    #       states - a tuple or list of states, one per pin
+    # Outputs: a PinUpdate that completes when the device acknowledges the command carrying the update.
+    def setPinsLater(self, pins, states):
+        if self.coalescer:
+            return self.coalescer.setPins(pins, states)
+        update = PinUpdate()
+        try:
+            update.finish(self.setPins(pins, states))
+        except Exception as E:
+            update.finish(None, E)
+        return update
+
+    # ValveController.togglePinLater: Toggles a pin like _togglePin, through the attached coalescer if any.
+    # Inputs:
+    #       pin - the pin to toggle
+    # Outputs: (the new state of the pin, a PinUpdate, see setPinsLater)
+    def togglePinLater(self, pin):
+        if self.coalescer:
+            return self.coalescer.togglePin(pin)
+        state = 1 - self.pinStates[pin]
+        return state, self.setPinsLater((pin,), (state,))
+
+    # ValveController.pinMask: returns the pin states as an integer bit mask; bit n is set if pin n is energized.
+    # Inputs: None
+    # Outputs: integer
+    def pinMask(self):
+        mask = 0
+        for pin, state in self.pinStates.items():
+            if state:
+                mask |= 1 << pin
+        return mask
+
+    # ValveController.readPins: Abstract method that asks the device for the actual state of its pins in one command.
+    #   See KATARAValveController for an example implementation.
+    # Inputs: None
+    # Outputs: integer bit mask as returned by pinMask
+    def readPins(self):
+        raise NotImplementedError("readPins must be implemented in ValveController child classes.")
+
+    # ValveController.verify: Compares the pin states read back from the device with self.pinStates in one round trip.
+    # Inputs: None
+    # Outputs: list of the pins whose actual state differs from the expected one; empty if they all match.
+    def verify(self):
+        return maskToPins(self.readPins() ^ self.pinMask())
+
+    # ValveController.sync: Reads back the pin states from the device and updates self.pinStates to match them.
+    # Inputs: None
+    # Outputs: list of the pins whose state in self.pinStates was wrong
+    def sync(self):
+        actual = self.readPins()
+        changed = maskToPins(actual ^ self.pinMask())
+        for pin in changed:
+            self.pinStates[pin] = (actual >> pin) & 1
+        return changed
+
+    # ValveController.runRepeat: Runs a sequence of actions a number of times on the device itself, with one command,
+    #   instead of sending a command per action. Devices that cannot do this return None, as this base class does, and
+    #   the caller runs the actions itself. See KATARAValveController for an example implementation.
+    # Inputs:
+    #       actions - list of ("pins", pins, states), ("pause", seconds) and ("pump", direction, valves, rate, cycles)
+    #       count - number of times to run the actions
+    # Outputs: the number of seconds the device will take, or None if it cannot run the actions.
+    def runRepeat(self, actions, count):
+        return None
+
+    # ValveController.stopRepeat: Stops actions started with runRepeat. Valves are left as they are.
+    # Inputs: None
+    # Outputs: None
+    def stopRepeat(self):
+        pass
+
+    # ValveController.playWaveform: Plays a waveform on a set of pins with the device's own timer: frames of pin states,
+    #   each due at a tick, are streamed to a buffer on the device ahead of time, so that their timing does not depend
+    #   on the host or the serial line. Devices that cannot do this return None, as this base class does. See
+    #   KATARAValveController for an example implementation.
+    # Inputs:
+    #       pins - list of the pins the waveform drives
+    #       tick - seconds per tick
+    #       frames - iterable of (tick, states): the tick, counted from the start, at which to set the pins to states,
+    #           a sequence with one state per pin. Ticks must increase.
+    # Outputs: dictionary of statistics of the run, or None if the device cannot stream.
+    def playWaveform(self, pins, tick, frames):
+        return None
+
+    # ValveController._recordTransition: appends the current pin states to the attached recorder, and publishes them
+    #   through the attached exporter, if any. Derived classes call this after each command that changes valves.
+    # Inputs:
+    #       pumpEvent - pump event code from ValveTrace, NO_PUMP for valve commands
+    #       pumpValves - the pump's three valves for pump events
+    #       pumpSeconds - seconds a started pump runs, inf if it runs until stopped
+    # Outputs: None
+    def _recordTransition(self, pumpEvent = NO_PUMP, pumpValves = (0, 0, 0), pumpSeconds = float('Inf')):
+        if self.recorder:
+            self.recorder.record(self.pinMask(), pumpEvent, pumpValves)
+        if self.exporter:
+            self.exporter.publish(self.pinMask(), pumpEvent, pumpValves, pumpSeconds)
+
+    # ValveController.metricsSnapshot: returns the serial link statistics collected in self.metrics.
+    # Inputs: None
+    # Outputs: dictionary, see SerialMetrics.snapshot
+    def metricsSnapshot(self):
+        return self.metrics.snapshot()
+
+    # ValveController._serialWrite: writes to the device and records the write in self.metrics. Derived classes should
+    #   send everything through this method and _serialReadline.
+    # Inputs:
+    #       data - string to send
+    #       frames - the number of commands contained in data
+    # Outputs: None
+    def _serialWrite(self, data, frames = 1):
+        if not isinstance(data, bytes):
+            data = data.encode('ascii')
+        self.ser.write(data)
+        self.metrics.recordWrite(len(data), frames)
+
+    # ValveController._serialReadline: reads a reply line from the device, recording the time spent blocked waiting
+    #   for it in self.metrics.
+    # Inputs: None
+    # Outputs: the line read, or an empty string if the read timed out.
+    def _serialReadline(self):
+        start = clock()
+        line = self.ser.readline()
+        self.metrics.recordRead(len(line), clock() - start)
+        if not isinstance(line, str):
+            line = line.decode('ascii', 'replace')
+        return line
 
     # ValveController.togglePin: Toggles the indicated pin: if it is high when the function is called, the pin is set
     #       low. If it is low when the function is called, it is set high. This is called when buttons in the GUI are
@@ -92,12 +306,16 @@ class ValveController:
     #       v2 - the second valve in the peristaltic pump
     #       v3 - the third valve in the peristaltic pump
     # Output:
-    #       returns a peristaltic pump object for running peristaltic pump sequences (see below)
+    #       returns a peristaltic pump object for running peristaltic pump sequences (see below). Specifying the same
+    #       valves again returns the same object while it is still in use.
     def specifyPump(self,v1,v2,v3):
-        for v in (v1, v2, v3):
-            self._checkPin(v)
-        pPump = self.pump(v1, v2, v3, self)
-        self.pPumps.append(pPump)
+        pPump = self.pumpCache.get((v1, v2, v3))
+        if pPump is None or pPump.ctlr is not self:
+            for v in (v1, v2, v3):
+                self._checkPin(v)
+            pPump = self.pump(v1, v2, v3, self)
+            self.pumpCache[(v1, v2, v3)] = pPump
+            self.pPumps.add(pPump)
         return pPump #returns a reference to the pPump
 
     # ValveController._checkPin: Abstract method to check if user pin input is valid. Overriding _checkPin methods in
@@ -147,6 +365,9 @@ class perstalticPump:
         if len(set(valves)) < 3:  # if user entered the same valve more than once
             raise ValueError("Error: Please enter three different valve numbers to specify the pump.")
         self.valves = tuple(valves)
+        # valveKeys are the pins as the GUI and protocols name them. MultiValveController replaces them with
+        # namespaced pins such as "B:12" for pumps on boards other than the first.
+        self.valveKeys = tuple([int(v) for v in valves])
         self.ctlr = ctlr
 
     # peristalticPump.forward: run the peristaltic pump forward
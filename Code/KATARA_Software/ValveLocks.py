@@ -0,0 +1,83 @@
+#MIT License
+#
+#Copyright (c) 2017 Jonathan A. White
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import threading
+
+# ValveLockManager: records which protocol, or manually started pump, owns each valve, so that protocols using
+# different valves can run at the same time. Owners acquire all of their valves at once, before they start, and a
+# request that overlaps valves held by another owner is rejected as a whole. Valves are the keys of the GUI's button
+# dictionary (see Step.valveKey).
+class ValveLockManager:
+
+    # ValveLockManager.__init__
+    #   Inputs: None
+    #   Outputs: None
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.owners = {} # valve: owner
+        self.names = {} # owner: name shown in error messages
+        self.listeners = [] # functions called, from the releasing thread, whenever valves are released
+
+    # ValveLockManager.addListener: registers a function to call after every release, e.g. so that a protocol waiting
+    #   for valves can try again.
+    #   Input:
+    #       listener - function taking no arguments
+    #   Output: None
+    def addListener(self, listener):
+        with self.lock:
+            self.listeners.append(listener)
+
+    # ValveLockManager.acquire: gives an owner every valve in a set, or none of them.
+    #   Inputs:
+    #       owner - object taking the valves, e.g. a RoutineThread
+    #       valves - iterable of valves
+    #       name - name of the owner for error messages
+    #   Output: None, but raises a ValueError naming the valves in use if any belongs to another owner.
+    def acquire(self, owner, valves, name):
+        valves = set(valves)
+        with self.lock:
+            conflicts = {}
+            for valve in valves:
+                holder = self.owners.get(valve)
+                if holder is not None and holder is not owner:
+                    conflicts.setdefault(self.names[holder], []).append(valve)
+            if conflicts:
+                raise ValueError("Error: " + "; ".join([("valves " if len(used) > 1 else "valve ")
+                                                        + ", ".join([str(v) for v in sorted(used, key=str)])
+                                                        + (" are" if len(used) > 1 else " is") + " in use by " + holder
+                                                        for holder, used in sorted(conflicts.items())]) + ".")
+            for valve in valves:
+                self.owners[valve] = owner
+            self.names[owner] = name
+
+    # ValveLockManager.release: frees every valve held by an owner. Releasing an owner that holds nothing does nothing.
+    #   Input:
+    #       owner - object that acquired the valves
+    #   Output: None
+    def release(self, owner):
+        with self.lock:
+            for valve in [v for v, holder in self.owners.items() if holder is owner]:
+                del self.owners[valve]
+            self.names.pop(owner, None)
+            listeners = list(self.listeners)
+        for listener in listeners:
+            listener()
+
+    # ValveLockManager.owner: returns the name of the owner of a valve, or None if it is free.
+    def owner(self, valve):
+        with self.lock:
+            holder = self.owners.get(valve)
+            return self.names[holder] if holder is not None else None
+
+    # ValveLockManager.held: returns the set of valves held by an owner, or by anyone if owner is None.
+    def held(self, owner = None):
+        with self.lock:
+            return set([v for v, holder in self.owners.items() if owner is None or holder is owner])
@@ -0,0 +1,155 @@
+#MIT License
+#
+#Copyright (c) 2017 Jonathan A. White
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+
+
+try:
+    from Tkinter import * #python 2.7
+except:
+    from tkinter import * #python 3
+import threading
+
+# ValveMap draws the valves of one board as cells of a single canvas, in place of a Tk button per valve. Color changes
+# are collected and drawn together when Tk is next idle, so a step that changes many valves, or a whole-board recolor,
+# costs one redraw rather than a widget update per valve, and cells whose color did not change are not touched.
+# Clicking a cell calls the map's command with the valve's key. The rest of the program colors valves through
+# ValveCell objects, which stand in for the buttons in KATARAGUI.btndict.
+
+
+# ValveCell: one valve of a ValveMap. Accepts the bg option of a button's config and cget.
+class ValveCell:
+
+    # ValveCell.__init__
+    #   Inputs:
+    #       valveMap - the map the valve is drawn on
+    #       key - the valve's key in btndict
+    def __init__(self, valveMap, key):
+        self.valveMap = valveMap
+        self.key = key
+
+    # ValveCell.config: colors the valve. Options other than bg are ignored.
+    #   Input:
+    #       options - button options; bg is the color of the valve
+    #   Output: None
+    def config(self, **options):
+        if 'bg' in options:
+            self.valveMap.setColors({self.key: options['bg']})
+
+    configure = config
+
+    # ValveCell.cget: returns the valve's color for the bg option, None for other options.
+    def cget(self, option):
+        if option == 'bg':
+            return self.valveMap.color(self.key)
+        return None
+
+
+# ValveMap: a board's valves drawn on one canvas.
+class ValveMap:
+    cellWidth = 44
+    cellHeight = 34
+    gap = 3
+
+    # ValveMap.__init__
+    #   Inputs:
+    #       parent - the widget holding the canvas
+    #       keys - list of rows of valve keys, in the order drawn. None leaves a cell empty.
+    #       command - function called with the key of a valve when its cell is clicked
+    def __init__(self, parent, keys, command):
+        self.keys = keys
+        self.command = command
+        across = max([len(row) for row in keys] + [1])
+        self.canvas = Canvas(parent, width = across*(self.cellWidth + self.gap) + self.gap,
+                             height = len(keys)*(self.cellHeight + self.gap) + self.gap, highlightthickness = 0)
+        self.cells = {} # ValveCell by key
+        self.items = {} # canvas rectangle by key
+        self.drawn = {} # color shown by key
+        self.pending = {} # colors not yet drawn by key
+        self.lock = threading.Lock() # valves are colored from protocol threads as well as the GUI thread
+        self.redrawScheduled = False
+        for y, row in enumerate(keys):
+            for x, key in enumerate(row):
+                if key is None:
+                    continue
+                left = self.gap + x*(self.cellWidth + self.gap)
+                top = self.gap + y*(self.cellHeight + self.gap)
+                self.items[key] = self.canvas.create_rectangle(left, top, left + self.cellWidth, top + self.cellHeight,
+                                                               fill = "gray", outline = "black")
+                self.canvas.create_text(left + self.cellWidth/2, top + self.cellHeight/2, text = str(key))
+                self.drawn[key] = "gray"
+                self.cells[key] = ValveCell(self, key)
+        self.canvas.bind("<Button-1>", self.click)
+
+    # ValveMap.grid: places the canvas in its parent (see Tk's grid).
+    def grid(self, **options):
+        self.canvas.grid(**options)
+
+    # ValveMap.destroy: removes the canvas.
+    def destroy(self):
+        self.canvas.destroy()
+
+    # ValveMap.setColors: colors valves. The cells are redrawn when Tk is next idle, together with any other changes
+    #   made before then.
+    #   Input:
+    #       colors - dictionary of color by valve key
+    #   Output: None
+    def setColors(self, colors):
+        with self.lock:
+            self.pending.update(colors)
+            if self.redrawScheduled:
+                return
+            self.redrawScheduled = True
+        try:
+            self.canvas.after_idle(self.redraw)
+        except (TclError, RuntimeError): # the window has been closed
+            pass
+
+    # ValveMap.setStates: colors valves by state, green for open (1) and gray for closed (0).
+    #   Input:
+    #       states - dictionary of state by valve key
+    #   Output: None
+    def setStates(self, states):
+        self.setColors(dict((key, "green" if state else "gray") for key, state in states.items()))
+
+    # ValveMap.setAll: colors every valve of the board.
+    #   Input:
+    #       color - the color
+    #   Output: None
+    def setAll(self, color):
+        self.setColors(dict((key, color) for key in self.items))
+
+    # ValveMap.color: returns the color of a valve, including changes not yet drawn.
+    def color(self, key):
+        with self.lock:
+            return self.pending.get(key, self.drawn.get(key))
+
+    # ValveMap.redraw: draws the pending color changes, skipping valves already shown in their color. Runs on the GUI
+    #   thread (see ValveMap.setColors); call it directly to draw the changes immediately.
+    #   Inputs: None
+    #   Output: None
+    def redraw(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.redrawScheduled = False
+        for key, color in pending.items():
+            if self.drawn[key] != color:
+                self.canvas.itemconfig(self.items[key], fill = color)
+                self.drawn[key] = color
+
+    # ValveMap.click: calls the map's command with the key of the clicked valve. Bound to clicks on the canvas.
+    #   Input:
+    #       event - the click event passed by Tk
+    #   Output: None
+    def click(self, event):
+        x = int((event.x - self.gap) // (self.cellWidth + self.gap))
+        y = int((event.y - self.gap) // (self.cellHeight + self.gap))
+        if 0 <= y < len(self.keys) and 0 <= x < len(self.keys[y]) and self.keys[y][x] is not None:
+            self.command(self.keys[y][x])
@@ -0,0 +1,253 @@
+#MIT License
+#
+#Copyright (c) 2017 Jonathan A. White
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+
+import struct
+import threading
+import zlib
+import time
+import csv
+from array import array
+from SerialMetrics import clock
+
+# ValveTrace records every valve transition a controller makes so that runs can be analysed and audited afterwards.
+#
+# A ValveTraceRecorder is attached to a controller (ValveController.attachRecorder). Each setPins call and pump command
+# appends one fixed size record to a preallocated ring buffer: the monotonic time, the mask of energized pins after the
+# command, the pump event, and the protocol step and loop iterations that issued it. Appending is a single
+# struct.pack_into so the protocol executor is not slowed down. A background thread moves the records to a compact
+# columnar file: the file is a header followed by chunks, and each chunk holds every column of its records
+# contiguously, zlib compressed.
+#
+# Steps tell the recorder who they are with setStepContext; the context is per thread so that the branches of a
+# ParallelBlock are attributed correctly.
+
+# pump events
+NO_PUMP = 0
+PUMP_FORWARD = 1
+PUMP_REVERSE = 2
+PUMP_STOP = 3
+
+maxDepth = 4 # number of innermost loop iterations stored with each record
+
+magic = b'KVTRACE1'
+header = struct.Struct('<dd') # wall clock time and monotonic clock time when the recorder was created
+chunkHeader = struct.Struct('<I') # number of records in a chunk
+
+# columns: (name, array typecode, values per record). The record struct below lists the same fields in order.
+columns = (('time', 'd', 1), ('maskLow', 'Q', 1), ('maskHigh', 'Q', 1), ('pumpEvent', 'B', 1),
+           ('pumpValves', 'B', 3), ('stepId', 'I', 1), ('depth', 'B', 1), ('iterations', 'i', maxDepth))
+record = struct.Struct('<dQQB3BIB' + str(maxDepth) + 'i')
+
+stepContext = threading.local()
+stepListeners = [] # functions called, with no arguments, after each setStepContext (see StateExport)
+
+
+# setStepContext: Called by steps as they run so that the records they cause are tagged with the step and loop
+# iterations.
+#   Inputs:
+#       stepId - number of the step in its protocol (see Routine.numberSteps)
+#       iters - tuple of loop iterations, innermost first, or None if the step is not in a loop
+def setStepContext(stepId, iters = None):
+    stepContext.stepId = stepId
+    stepContext.iters = iters or ()
+    for listener in stepListeners:
+        listener()
+
+
+# ValveTraceRecorder: ring buffer of valve transition records, flushed to a file by a background thread.
+class ValveTraceRecorder:
+
+    # ValveTraceRecorder.__init__
+    #   Inputs:
+    #       path - the trace file to write
+    #       capacity - number of records the ring buffer holds. If the flush thread falls behind by more than this the
+    #           oldest records are dropped and counted in self.dropped.
+    #       flushInterval - seconds between flushes
+    def __init__(self, path, capacity = 65536, flushInterval = 1.0):
+        self.path = path
+        self.capacity = capacity
+        self.interval = flushInterval
+        self.buffer = bytearray(capacity*record.size)
+        self.head = 0 # number of records appended
+        self.tail = 0 # number of records flushed or dropped
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.fileLock = threading.Lock()
+        self.file = open(path, 'wb')
+        self.file.write(magic + header.pack(time.time(), clock()))
+        self.file.flush()
+        self.closed = False
+        self.stopEvent = threading.Event()
+        self.flusher = threading.Thread(target = self._flushLoop)
+        self.flusher.setDaemon(True)
+        self.flusher.start()
+
+    # ValveTraceRecorder.record: appends a record. Called by the controller after each command.
+    #   Inputs:
+    #       mask - integer bit mask of energized pins after the command (bit n is pin n)
+    #       pumpEvent - NO_PUMP, PUMP_FORWARD, PUMP_REVERSE or PUMP_STOP
+    #       pumpValves - the three valves of the pump for pump events
+    def record(self, mask, pumpEvent = NO_PUMP, pumpValves = (0, 0, 0)):
+        stepId = getattr(stepContext, 'stepId', 0)
+        iters = getattr(stepContext, 'iters', ())
+        padded = (tuple(iters[:maxDepth]) + (0,)*maxDepth)[:maxDepth]
+        with self.lock:
+            if self.head - self.tail >= self.capacity: # overwrite the oldest record
+                self.tail += 1
+                self.dropped += 1
+            record.pack_into(self.buffer, (self.head % self.capacity)*record.size, clock(),
+                             mask & 0xFFFFFFFFFFFFFFFF, mask >> 64, pumpEvent,
+                             pumpValves[0], pumpValves[1], pumpValves[2], stepId, min(len(iters), 255), *padded)
+            self.head += 1
+
+    # ValveTraceRecorder._flushLoop: target of the flush thread.
+    def _flushLoop(self):
+        while not self.stopEvent.wait(self.flushInterval()):
+            try:
+                self.flush()
+            except (IOError, OSError, ValueError) as E:
+                print("Could not write valve trace: " + str(E))
+
+    # ValveTraceRecorder.flushInterval: seconds between background flushes; shortened when the buffer fills up.
+    def flushInterval(self):
+        if self.head - self.tail > self.capacity/2:
+            return 0.01
+        return self.interval
+
+    # ValveTraceRecorder.flush: moves the records in the ring buffer to the file as one columnar chunk.
+    #   Input: None
+    #   Output: the number of records written
+    def flush(self):
+        with self.fileLock:
+            with self.lock:
+                n = self.head - self.tail
+                start = (self.tail % self.capacity)*record.size
+                end = start + n*record.size
+                if end <= len(self.buffer):
+                    rows = bytes(self.buffer[start:end])
+                else: # the records wrap around the end of the buffer
+                    rows = bytes(self.buffer[start:]) + bytes(self.buffer[:end - len(self.buffer)])
+                self.tail = self.head
+            if not n or self.file.closed:
+                return 0
+            self.file.write(chunkHeader.pack(n))
+            fields = [array(typecode) for name, typecode, width in columns]
+            for values in record.iter_unpack(rows):
+                f = 0
+                for column, (name, typecode, width) in zip(fields, columns):
+                    column.extend(values[f:f + width])
+                    f += width
+            for column in fields:
+                data = zlib.compress(column.tobytes())
+                self.file.write(chunkHeader.pack(len(data)) + data)
+            self.file.flush()
+            return n
+
+    # ValveTraceRecorder.close: flushes the remaining records, stops the flush thread and closes the file.
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.stopEvent.set()
+        self.flush()
+        with self.fileLock:
+            self.file.close()
+
+
+# readTrace: reads a trace file.
+#   Input:
+#       path - the trace file
+#   Output: dictionary with the header times ('wallStart', 'clockStart'), and for each column a list of values. Multi
+#       value columns (pumpValves, iterations) are lists of tuples. The 'mask' column combines maskLow and maskHigh.
+def readTrace(path):
+    with open(path, 'rb') as file:
+        data = file.read()
+    if data[:len(magic)] != magic:
+        raise ValueError("Error: " + path + " is not a KATARA valve trace.")
+    offset = len(magic)
+    wallStart, clockStart = header.unpack_from(data, offset)
+    offset += header.size
+    trace = {'wallStart': wallStart, 'clockStart': clockStart}
+    for name, typecode, width in columns:
+        trace[name] = []
+    while offset < len(data):
+        n, = chunkHeader.unpack_from(data, offset)
+        offset += chunkHeader.size
+        for name, typecode, width in columns:
+            size, = chunkHeader.unpack_from(data, offset)
+            offset += chunkHeader.size
+            values = array(typecode)
+            raw = zlib.decompress(data[offset:offset + size])
+            values.frombytes(raw)
+            offset += size
+            if width == 1:
+                trace[name].extend(values)
+            else:
+                trace[name].extend([tuple(values[k:k + width]) for k in range(0, len(values), width)])
+    trace['mask'] = [low | (high << 64) for low, high in zip(trace['maskLow'], trace['maskHigh'])]
+    return trace
+
+
+# maskToPins: lists the energized pins in a pin mask.
+#   Input:
+#       mask - integer pin mask
+#   Output: list of pin numbers
+def maskToPins(mask):
+    pins = []
+    pin = 0
+    while mask:
+        if mask & 1:
+            pins.append(pin)
+        mask >>= 1
+        pin += 1
+    return pins
+
+
+# traceToCSV: exports a trace file as CSV with one row per record. Times are seconds since the recorder started; pins
+# and iterations are space separated lists.
+#   Inputs:
+#       path - the trace file
+#       csvPath - the CSV file to write
+#   Output: None
+def traceToCSV(path, csvPath):
+    trace = readTrace(path)
+    with open(csvPath, 'w') as file:
+        writer = csv.writer(file)
+        writer.writerow(['time', 'energized_pins', 'pump_event', 'pump_valves', 'step_id', 'iterations'])
+        for k in range(len(trace['time'])):
+            writer.writerow(["%.6f" % (trace['time'][k] - trace['clockStart']),
+                             " ".join([str(p) for p in maskToPins(trace['mask'][k])]),
+                             trace['pumpEvent'][k],
+                             " ".join([str(v) for v in trace['pumpValves'][k]]) if trace['pumpEvent'][k] else "",
+                             trace['stepId'][k],
+                             " ".join([str(i) for i in trace['iterations'][k][:trace['depth'][k]]])])
+
+
+# traceToNumpy: loads a trace file as a NumPy structured array with one field per column. Requires NumPy.
+#   Input:
+#       path - the trace file
+#   Output: numpy structured array; 'time' is seconds since the recorder started and 'pins' is a boolean array of
+#       the 128 possible pins.
+def traceToNumpy(path):
+    import numpy
+    trace = readTrace(path)
+    n = len(trace['time'])
+    out = numpy.zeros(n, dtype=[('time', 'f8'), ('pins', '?', (128,)), ('pumpEvent', 'u1'), ('pumpValves', 'u1', (3,)),
+                                ('stepId', 'u4'), ('depth', 'u1'), ('iterations', 'i4', (maxDepth,))])
+    if not n:
+        return out
+    out['time'] = numpy.array(trace['time']) - trace['clockStart']
+    words = numpy.array([trace['maskLow'], trace['maskHigh']], dtype='u8').T.copy()
+    out['pins'] = numpy.unpackbits(words.view('u1').reshape(n, 16), axis=1, bitorder='little').astype(bool)
+    for name in ('pumpEvent', 'pumpValves', 'stepId', 'depth', 'iterations'):
+        out[name] = trace[name]
+    return out
@@ -10,4 +10,41 @@
 
 
 root = None
-stopEditing = False
\ No newline at end of file
+stopEditing = False
+
+# Serial link metrics (see SerialMetrics) are written to this file every metricsInterval seconds in the Prometheus text
+# format, e.g. "KATARA_metrics.prom". If metricsFile is None they are kept in memory only.
+metricsFile = None
+metricsInterval = 10.0
+
+# If True, valve controllers print every command they send and the device's replies to the console. Printing slows
+# down every command, so leave this off while running protocols.
+debugSerial = False
+
+# If set, the connected controller publishes its live state (pins, pumps, step and loop iterations) to this memory
+# mapped file for other programs to read (see StateExport).
+stateExportFile = None
+
+# If set, every controller records its valve transitions (see ValveTrace) to a new trace file in this directory.
+traceDirectory = None
+
+# If True, protocols are optimized before they run (see ProtocolOptimizer): pauses are merged, valve steps that run at
+# the same time are combined and trivial loops inlined, without changing when any valve changes.
+optimizeProtocols = True
+
+# If True, protocols started from their Run button run in a separate process that owns the serial port while they run
+# (see ProcessExecutor), so that work in the GUI cannot delay the valves. The protocol is compiled into timed events
+# first; protocols with more than processPlanLimit events, and protocols started while a pump or another protocol is
+# running, run in a thread of the GUI as before. The port is handed over with DTR kept deasserted so that the Arduino
+# does not reset, but some serial drivers still pulse DTR when a port is opened, which would briefly drop every valve;
+# check the board keeps its valves across a run before turning this on.
+runInProcess = False
+processPlanLimit = 1000000
+
+# Host and port on which ControlServer listens for HTTP/JSON requests from scripts. The default host only accepts
+# clients running on this computer.
+controlServerAddress = ("127.0.0.1", 8765)
+
+# If set, pin updates made with ValveController.setPinsLater, including clicks on the valve buttons, are merged into
+# one command per window of this many seconds, for example 0.002 (see PinCoalescer). None sends each update at once.
+coalesceWindow = None
@@ -10,33 +10,58 @@
 
 
 
-from KATARAGUI import KATARAGUI
+import time
+startTime = time.time()
+import sys
 try:
-    from Tkinter import Tk  #python 2.7
+    from Tkinter import Tk, Label  #python 2.7
 except:
-    from tkinter import Tk  #python 3
-import config
-try:
-    import tkMessageBox
-except:
-    from tkinter import messagebox
-    tkMessageBox = messagebox
-from no_wait_Dialog import no_wait_Dialog
+    from tkinter import Tk, Label  #python 3
 
-def disconnected(input=None):
-    tkMessageBox.showerror("Error", "The protocol failed; check your connection to the Arduino.")
+# The window is drawn before anything else is loaded: the GUI modules (and through them the step and serial modules)
+# are imported, and the main window built, once it is on screen. Run with --startup-time to print how long startup
+# took and exit once the main window is drawn (see the startup benchmarks in Benchmarks.py).
+# The program starts only when this file is run, not when it is imported: protocols run in worker processes that
+# import it again (see ProcessExecutor).
+def main():
+    root = Tk()
+    try:
+        root.iconbitmap('KATARA.ico')
+    except:
+        pass
+    root.wm_title("KATARA")
+    loading = Label(root, text = "Loading KATARA...", padx = 40, pady = 20)
+    loading.pack()
+    root.update()
+    windowTime = time.time()
 
-def warning(input=None):
-    no_wait_Dialog("Warning", "There was a problem in the connection. "
-                              "The connection has been reset and the valve states have been restored.")
+    import config
+    try:
+        import tkMessageBox
+    except:
+        from tkinter import messagebox
+        tkMessageBox = messagebox
+    from no_wait_Dialog import no_wait_Dialog
+    from KATARAGUI import KATARAGUI
 
-root = Tk()
-try:
-    root.iconbitmap('KATARA.ico')
-except:
-    pass
-config.root = root
-root.bind_all("<<connection_warning>>", warning)
-root.bind_all("<<disconnected_error>>", disconnected)
-app = KATARAGUI(root)
-root.mainloop()
+    def disconnected(input=None):
+        tkMessageBox.showerror("Error", "The protocol failed; check your connection to the Arduino.")
+
+    def warning(input=None):
+        no_wait_Dialog("Warning", "There was a problem in the connection. "
+                                  "The connection has been reset and the valve states have been restored.")
+
+    config.root = root
+    root.bind_all("<<connection_warning>>", warning)
+    root.bind_all("<<disconnected_error>>", disconnected)
+    loading.destroy()
+    app = KATARAGUI(root)
+    if "--startup-time" in sys.argv:
+        root.update()
+        print("window shown: %.3f s, main window drawn: %.3f s" % (windowTime - startTime, time.time() - startTime))
+        root.destroy()
+    else:
+        root.mainloop()
+
+if __name__ == "__main__":
+    main()
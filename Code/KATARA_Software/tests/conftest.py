@@ -0,0 +1,47 @@
+#MIT License
+#
+#Copyright (c) 2017 Jonathan A. White
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+
+import os
+import sys
+import pytest
+
+# The modules of KATARA_Software import each other by name, as they do when main.py is run from its directory.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+config.metricsFile = None # keep the controllers under test from writing metrics files
+config.traceDirectory = None
+
+
+# emulator: a FirmwareEmulator at the firmware's 9600 baud, closed after the test.
+@pytest.fixture
+def emulator():
+    from FirmwareEmulator import FirmwareEmulator
+    emulator = FirmwareEmulator()
+    yield emulator
+    emulator.close()
+
+
+# device: a KATARAValveController connected to the emulator, as the GUI connects to a board.
+@pytest.fixture
+def device(emulator):
+    from KATARAValveController import KATARAValveController
+    device = KATARAValveController(emulator.port)
+    yield device
+    device.ser.close()
+
+
+# simulated: a SimulatedValveController, which answers every command at once.
+@pytest.fixture
+def simulated():
+    from SimulatedDevice import SimulatedValveController
+    return SimulatedValveController("simulated")
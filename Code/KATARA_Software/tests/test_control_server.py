@@ -0,0 +1,128 @@
+#MIT License
+#
+#Copyright (c) 2017 Jonathan A. White
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+
+# Tests of ControlServer: commands, valve locks, protocol uploads and the checks that keep other web pages out.
+
+import json
+import pytest
+try:
+    from httplib import HTTPConnection #python 2.7
+except ImportError:
+    from http.client import HTTPConnection #python 3
+
+
+# server: a ControlServer for a simulated device, listening on a free local port.
+@pytest.fixture
+def server(simulated):
+    from ControlServer import ControlServer
+    server = ControlServer(simulated, ("127.0.0.1", 0))
+    server.start()
+    yield server
+    server.close()
+
+
+# request: sends a request to the server and returns (status, decoded JSON reply).
+def request(server, method, path, body = None, headers = None):
+    connection = HTTPConnection(*server.address, timeout = 10)
+    sent = {"Content-Type": "application/json"}
+    sent.update(headers or {})
+    connection.request(method, path, json.dumps(body) if body is not None else None, sent)
+    response = connection.getresponse()
+    reply = json.loads(response.read().decode('utf-8'))
+    connection.close()
+    return response.status, reply
+
+
+# commands: posts a batch of commands.
+def commands(server, *batch):
+    return request(server, "POST", "/commands", {"commands": list(batch)})
+
+
+# protocol: returns a saved protocol that opens valves, holds them for a time and closes them.
+def protocol(valves, seconds):
+    from ProtocolBuilder import ProtocolBuilder
+    builder = ProtocolBuilder()
+    builder.valves(valves, 1).pause(seconds).valves(valves, 0)
+    return builder.saved()
+
+
+def test_commands_set_pins(server, simulated):
+    status, reply = commands(server, {"op": "pins", "pins": [5, "6"], "states": [1, 1]})
+    assert status == 200 and reply["results"] == [{"pins": ["5", "6"]}]
+    assert simulated.model.pins[5] == 1 and simulated.model.pins[6] == 1
+    assert request(server, "GET", "/status")[1]["pins"]["5"] == 1
+
+
+# A batch with an invalid command is rejected before any command of it is sent.
+def test_invalid_batch_sends_nothing(server, simulated):
+    status, reply = commands(server, {"op": "pins", "pins": [7], "states": [1]}, {"op": "pins", "pins": [1]})
+    assert status == 400
+    assert simulated.model.pins[7] == 0
+
+
+# Valves of a running protocol are locked until the protocol is stopped; other valves stay free.
+def test_protocol_locks_its_valves_until_stopped(server, simulated):
+    status, run = request(server, "POST", "/protocols", {"protocol": protocol([2, 3], 30), "name": "hold"})
+    assert status == 200 and run["state"] == "running"
+    status, reply = commands(server, {"op": "pins", "pins": [3], "states": [0]})
+    assert status == 400 and "protocol hold" in reply["error"]
+    status, reply = commands(server, {"op": "pump", "valves": [3, 20, 21], "rate": 5, "cycles": 1})
+    assert status == 400
+    assert commands(server, {"op": "pins", "pins": [10], "states": [1]})[0] == 200
+    assert simulated.model.pins[2] == 1 and simulated.model.pins[3] == 1
+
+    status, stopped = request(server, "POST", "/protocols/%d/stop" % run["id"], {})
+    assert status == 200 and stopped["state"] == "cancelled"
+    assert commands(server, {"op": "pins", "pins": [3], "states": [0]})[0] == 200
+    assert simulated.model.pins[3] == 0
+
+
+# An uploaded protocol runs its steps on time and frees its valves once it is done.
+def test_protocol_runs_to_completion(server, simulated):
+    status, run = request(server, "POST", "/protocols", {"protocol": protocol([4], 0.05), "name": "pulse"})
+    assert status == 200
+    status, done = request(server, "GET", "/protocols/%d?wait=5" % run["id"])
+    assert status == 200 and done["state"] == "done" and done["eventsDone"] == done["events"]
+    changes = simulated.model.pinTimeline(4)
+    assert [state for when, pin, state in changes] == [1, 0]
+    assert changes[1][0] - changes[0][0] == pytest.approx(0.05, abs = 0.02)
+    assert commands(server, {"op": "pins", "pins": [4], "states": [1]})[0] == 200
+
+
+# A pump started by a client holds its valves until it is stopped.
+def test_client_pump_locks_its_valves(server):
+    pump = {"op": "pump", "valves": [20, 21, 22], "rate": 5, "cycles": -1}
+    assert commands(server, pump)[0] == 200
+    assert commands(server, {"op": "pins", "pins": [21], "states": [1]})[0] == 400
+    assert commands(server, {"op": "stopPump", "valves": [20, 21, 22]})[0] == 200
+    assert commands(server, {"op": "pins", "pins": [21], "states": [1]})[0] == 200
+
+
+def test_unknown_run(server):
+    assert request(server, "GET", "/protocols/99")[0] == 404
+    assert request(server, "POST", "/protocols/99/stop", {})[0] == 404
+
+
+# Requests that a web page in a browser could send are refused.
+def test_requests_from_web_pages_are_refused(server, simulated):
+    pins = {"commands": [{"op": "pins", "pins": [8], "states": [1]}]}
+    assert request(server, "POST", "/commands", pins, {"Content-Type": "text/plain"})[0] == 415
+    assert request(server, "POST", "/commands", pins, {"Origin": "http://example.com"})[0] == 403
+    assert request(server, "POST", "/commands", pins, {"Host": "example.com"})[0] == 403
+    assert simulated.model.pins[8] == 0
+
+
+# Protocol entries are evaluated as arithmetic of the loop iterations only, never as python.
+def test_protocol_entries_are_not_python(server):
+    saved = [["PauseStep", "__import__('os').getcwd() and 1"]]
+    status, reply = request(server, "POST", "/protocols", {"protocol": saved, "name": "exploit"})
+    assert status == 400
@@ -0,0 +1,59 @@
+#MIT License
+#
+#Copyright (c) 2017 Jonathan A. White
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+
+# Tests of FirmwareEmulator: the unmodified controller talking to the emulated firmware over a pseudo-terminal.
+
+import time
+import pytest
+
+
+# The controller identifies the firmware when it connects.
+def test_controller_connects_and_identifies(device, emulator):
+    assert [frame for sent, frame in emulator.model.frames][:1] == ["1"]
+    assert device.ser.isOpen()
+
+
+# Frames and replies take the time they would take at 9600 baud.
+def test_transfer_takes_line_time(device, emulator):
+    start = time.time()
+    response = device.setPins([5], [1])
+    elapsed = time.time() - start
+    assert response.strip() == "2051Set Pins"
+    assert elapsed >= (len("2051c") + len(response))*emulator.byteTime
+    assert emulator.model.pins[5] == 1
+
+
+# A pump steps through the six phases of each cycle on the firmware's schedule and returns its valves to 0.
+def test_pump_phases_follow_firmware_timing(device, emulator):
+    valves = (20, 21, 22)
+    device.specifyPump(*valves).forward(10, 2)
+    time.sleep(0.35)
+    changes = emulator.timeline()
+    phaseTimes = sorted(set(when for when, pin, state in changes if pin in valves))
+    period = (1000000//60)*1e-6
+    assert len(phaseTimes) == 2*6 + 1 # two cycles of six phases, then the valves close
+    assert [b - a for a, b in zip(phaseTimes, phaseTimes[1:])] == pytest.approx([period]*12, abs = 1e-6)
+    assert [emulator.model.pins[v] for v in valves] == [0, 0, 0]
+    assert emulator.model.pumps == [None]*len(emulator.model.pumps)
+
+
+# A lone 'c' interrupts every running pump.
+def test_lone_c_interrupts_pumps(device, emulator):
+    device.specifyPump(20, 21, 22).forward(5, -1)
+    device.specifyPump(30, 31, 32).reverse(5, -1)
+    time.sleep(0.1)
+    with device.serLock:
+        device._serialWrite("c")
+    time.sleep(0.05)
+    assert emulator.model.pumps == [None]*len(emulator.model.pumps)
+    assert [emulator.model.pins[v] for v in (20, 21, 22, 30, 31, 32)] == [0]*6
+    assert device.verify() == []
@@ -0,0 +1,82 @@
+#MIT License
+#
+#Copyright (c) 2017 Jonathan A. White
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+
+# Tests of MultiValveController, which groups several boards under namespaced pins such as "B:12".
+
+import os
+import pytest
+from SimulatedDevice import SimulatedValveController
+from MultiValveController import MultiValveController
+
+
+# group: two simulated boards, A and B.
+@pytest.fixture
+def group():
+    group = MultiValveController([SimulatedValveController("A"), SimulatedValveController("B")])
+    yield group
+    group.close()
+
+
+def test_set_pins_across_boards(group):
+    group.setPins([5, "B:5", "B:69"], [1, 1, 1])
+    a, b = group.boards["A"], group.boards["B"]
+    assert a.model.pins[5] == 1 and b.model.pins[5] == 1 and b.model.pins[69] == 1
+    assert group.pinStates["B:69"] == 1 and group.pinStates[5] == 1
+    assert dict(group.pinStates.items())["B:5"] == 1
+    assert len(group.pinStates.items()) == len(group.pinStates) == 2*68
+
+
+def test_verify_and_sync_across_boards(group):
+    group.setPins([3, "B:4"], [1, 1])
+    assert group.verify() == []
+    group.boards["B"].model.writePins(0, [4, 7], [0, 1])
+    assert group.verify() == ["B:4", "B:7"]
+    assert group.sync() == ["B:4", "B:7"]
+    assert group.pinStates["B:7"] == 1 and group.verify() == []
+
+
+# Masks hold plain integer pins, which are board A's.
+def test_pin_mask_and_readback_are_board_a(group):
+    group.setPins([2, 10, "B:11"], [1, 1, 1])
+    assert group.pinMask() == (1 << 2) | (1 << 10)
+    assert group.readPins() == group.pinMask()
+
+
+def test_recorder_and_exporter_attach_to_board_a(group, tmp_path):
+    from ValveTrace import ValveTraceRecorder, readTrace
+    from StateExport import StateExporter, StateReader
+    group.attachRecorder(None)
+    path = str(tmp_path / "group.kvt")
+    group.attachRecorder(ValveTraceRecorder(path))
+    group.setPins([6, "B:6"], [1, 1])
+    group.attachRecorder(None)
+    assert group.recorder is None and group.boards["A"].recorder is None
+    records = readTrace(path)
+    assert list(records['maskLow']) == [1 << 6] and list(records['maskHigh']) == [0]
+
+    path = str(tmp_path / "state.bin")
+    group.attachExporter(StateExporter(path))
+    reader = StateReader(path)
+    assert reader.read()['mask'] == 1 << 6
+    group.setPins([8, "B:9"], [1, 1])
+    assert reader.read()['mask'] == (1 << 6) | (1 << 8)
+    reader.close()
+    group.attachExporter(None)
+    assert group.exporter is None and group.boards["A"].exporter is None
+
+
+def test_pumps_run_on_their_board(group):
+    pump = group.specifyPump("B:20", "B:21", "B:22")
+    assert pump.valveKeys == ("B:20", "B:21", "B:22")
+    assert group.specifyPump("B:20", "B:21", "B:22").ctlr is group.boards["B"]
+    with pytest.raises(ValueError):
+        group.specifyPump(20, "B:21", "B:22")
@@ -0,0 +1,49 @@
+#MIT License
+#
+#Copyright (c) 2017 Jonathan A. White
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+
+# Tests of reading the pin states back from the device (opcode 4) and of ValveController.verify and sync.
+
+
+# The readback holds one bit per pin, at the pin's number, for every pin of the board.
+def test_read_pins_reports_the_board_states(device, emulator):
+    device.setPins([2, 37, 69], [1, 1, 1])
+    assert device.readPins() == (1 << 2) | (1 << 37) | (1 << 69)
+    assert [frame for sent, frame in emulator.model.frames][-1] == "4"
+
+
+# verify finds nothing wrong while the host's record matches the board.
+def test_verify_agrees_with_the_host(device):
+    device.setPins([3, 4, 60], [1, 0, 1])
+    assert device.verify() == []
+
+
+# Pins the board changed without the host knowing, e.g. after a reset, are reported by verify and corrected in the
+# host's record by sync.
+def test_sync_takes_the_board_states(device, emulator):
+    device.setPins([10, 11], [1, 1])
+    with emulator.model.lock:
+        emulator.model.writePins(0, [10, 12], [0, 1])
+    assert device.verify() == [10, 12]
+    assert device.sync() == [10, 12]
+    assert device.pinStates[10] == 0 and device.pinStates[11] == 1 and device.pinStates[12] == 1
+    assert device.verify() == []
+    assert device.sync() == []
+
+
+# A pump's valves are read back in the phase the pump has reached.
+def test_read_pins_sees_pump_phase(simulated):
+    pump = simulated.specifyPump(20, 21, 22)
+    pump.forward(1, -1)
+    mask = simulated.readPins()
+    assert [(mask >> pin) & 1 for pin in (20, 21, 22)] == [simulated.model.pins[pin] for pin in (20, 21, 22)]
+    assert any((mask >> pin) & 1 for pin in (20, 21, 22))
+    pump.stop()
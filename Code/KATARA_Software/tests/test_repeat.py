@@ -0,0 +1,71 @@
+#MIT License
+#
+#Copyright (c) 2017 Jonathan A. White
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+
+# Tests of loops run on the board as one repeat command (opcode 6, see KATARAValveController.runRepeat).
+
+import time
+
+# a loop body: valve steps with pauses between them
+actions = [("pins", [2, 3], [1, 0]), ("pause", 0.02), ("pins", [3, 4], [1, 1]), ("pause", 0.01),
+           ("pins", [2, 40], [0, 1]), ("pause", 0.01)]
+
+
+# runOnHost: runs the actions count times the way a protocol loop does without the repeat command.
+def runOnHost(ctlr, actions, count):
+    for k in range(count):
+        for action in actions:
+            if action[0] == "pins":
+                ctlr.setPins(action[1], action[2])
+            else:
+                time.sleep(action[1])
+
+
+# The board leaves every pin in the state the same loop run from the host leaves it in, and the host's record agrees.
+def test_repeat_on_device_matches_host_loop(device, emulator, simulated):
+    duration = device.runRepeat(actions, 3)
+    assert duration == 3*0.04
+    time.sleep(duration + 0.2)
+    runOnHost(simulated, actions, 3)
+    assert emulator.model.program is None # finished
+    assert emulator.model.pins == simulated.model.pins
+    assert device.pinStates == simulated.pinStates
+    assert device.verify() == []
+
+
+# Every pass changes the pins in the same order as the host loop does.
+def test_repeat_on_device_makes_the_host_loop_changes(simulated):
+    from SimulatedDevice import SimulatedValveController
+    host = SimulatedValveController("host")
+    duration = simulated.runRepeat(actions, 4)
+    time.sleep(duration + 0.05)
+    simulated.readPins() # lets the model catch up with the time
+    runOnHost(host, actions, 4)
+    assert [(pin, state) for when, pin, state in simulated.model.pinTimeline()] == \
+           [(pin, state) for when, pin, state in host.model.pinTimeline()]
+
+
+# A body without a pause would run every pass inside one pass of the firmware's loop, so it is run from the host.
+def test_repeat_without_pause_is_refused(device, emulator):
+    assert device.runRepeat([("pins", [5], [1]), ("pins", [5], [0])], 999999) is None
+    assert not [frame for sent, frame in emulator.model.frames if frame.startswith("6")]
+
+
+# Stopping the program leaves the pins as they are and lets another program start.
+def test_stop_repeat(device, emulator):
+    assert device.runRepeat(actions, 999) is not None
+    assert device.runRepeat(actions, 1) is None # one program at a time
+    time.sleep(0.1)
+    device.stopRepeat()
+    assert emulator.model.program is None
+    device.sync()
+    assert device.verify() == []
+    assert device.runRepeat(actions, 1) is not None
@@ -0,0 +1,137 @@
+#MIT License
+#
+#Copyright (c) 2017 Jonathan A. White
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+
+# Tests of RunQueue, which runs queued protocols one after another. Widgets are replaced by stand-ins and the GUI
+# thread by a thread calling runGUICalls, so no display is needed.
+
+import threading
+import time
+import pytest
+import Protocol_Tools
+from Protocol_Tools import RunQueue, RoutineThread, Routine
+from Step import Step
+from SerialMetrics import clock
+
+
+# Widget: stands in for the Tkinter widgets the queue and steps configure.
+class Widget(object):
+    def config(self, **options):
+        pass
+
+    def grid_forget(self):
+        pass
+
+
+# TimedStep: a step that records when it starts and then pauses like a step of the GUI.
+class TimedStep(Step):
+    def __init__(self, log, name, seconds):
+        self.box = Widget()
+        self.log, self.name, self.seconds = log, name, seconds
+
+    def run(self, iter = None):
+        self.log.append((self.name, clock()))
+        Step.pause(self, self.seconds)
+
+
+# FakeProtocol: a protocol with the attributes RunQueue uses.
+class FakeProtocol(Routine):
+    def __init__(self, name, steps, valves = (), error = None):
+        self.name, self.steps, self.valves, self.error = name, steps, set(valves), error
+        self.runSteps = None
+        self.connected = True
+        self.running = False
+        self.writable = False
+        self.runbtn = Widget()
+        self.controlbox = Widget()
+
+    def usedValves(self):
+        if self.error:
+            raise self.error
+        return self.valves
+
+    def saveEntries(self):
+        pass
+
+    def numberSteps(self):
+        pass
+
+    def optimize(self):
+        pass
+
+
+# runQueue: a RunQueue whose GUI calls are made by a thread standing in for the GUI thread; errors shown to the user
+#   are collected in runQueue.errors.
+@pytest.fixture
+def runQueue(monkeypatch):
+    monkeypatch.setattr(Protocol_Tools, "Label", lambda master: Widget())
+    errors = []
+    monkeypatch.setattr(Protocol_Tools.tkMessageBox, "showerror", lambda title, message: errors.append(message))
+    runQueue = RunQueue(threading.current_thread())
+    runQueue.errors = errors
+    stop = threading.Event()
+
+    def gui():
+        while not stop.is_set():
+            runQueue.runGUICalls()
+            time.sleep(RunQueue.pollInterval*1e-3)
+
+    thread = threading.Thread(target = gui)
+    thread.daemon = True
+    thread.start()
+    yield runQueue
+    stop.set()
+    thread.join()
+
+
+# waitFor: waits up to a timeout for a condition to hold.
+def waitFor(condition, timeout = 2):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.005)
+    return condition()
+
+
+# Each queued protocol starts its first timed step at the previous protocol's final deadline, so hand-over time
+# does not add up.
+def test_protocols_start_at_previous_deadline(runQueue):
+    log = []
+    protocols = [FakeProtocol("p%d" % k, [TimedStep(log, "p%d" % k, 0.1)]) for k in range(4)]
+    for protocol in protocols:
+        runQueue.enqueue(protocol)
+    assert waitFor(lambda: len(log) == 4 and runQueue.current is None and not runQueue.items)
+    threads = [protocol.pRun for protocol in protocols]
+    for previous, thread in zip(threads, threads[1:]):
+        assert thread.deadline == pytest.approx(previous.deadline + 0.1, abs = 1e-9)
+
+
+# A protocol whose valves are held waits until they are released, without polling.
+def test_protocol_waits_for_its_valves(runQueue):
+    log = []
+    owner = object()
+    RoutineThread.valveLocks.acquire(owner, [7], "pump")
+    try:
+        runQueue.enqueue(FakeProtocol("held", [TimedStep(log, "held", 0.01)], valves = [7]))
+        time.sleep(0.1)
+        assert log == []
+    finally:
+        RoutineThread.valveLocks.release(owner)
+    assert waitFor(lambda: log and log[0][0] == "held")
+
+
+# A protocol that cannot be run is dropped and reported, and the queue goes on with the next one.
+def test_failing_protocol_is_dropped(runQueue):
+    log = []
+    runQueue.enqueue(FakeProtocol("broken", [TimedStep(log, "broken", 0.01)], error = TypeError("bad entry")))
+    runQueue.enqueue(FakeProtocol("next", [TimedStep(log, "next", 0.01)]))
+    assert waitFor(lambda: [name for name, when in log] == ["next"] and runQueue.current is None)
+    assert runQueue.errors == ["Could not run broken: bad entry"]
+    assert runQueue.worker.is_alive()
@@ -0,0 +1,82 @@
+#MIT License
+#
+#Copyright (c) 2017 Jonathan A. White
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+
+# Tests of set pins commands too long for one frame, which are sent as staged chunks (see
+# KATARAValveController._sendPins).
+
+import pytest
+
+allPins = list(range(2, 70))
+
+
+# framesOf: returns the frames the model received that start with one of the given opcodes.
+def framesOf(model, opcodes):
+    return [frame for sent, frame in model.frames if frame[:1] in opcodes]
+
+
+# A command setting every pin of the board is staged in chunks, acknowledged chunk by chunk, and applied at once.
+def test_full_board_is_staged_and_applied_together(device, emulator):
+    response = device.setPins(allPins, [1]*len(allPins))
+    assert "Set Pins" in response
+    frames = framesOf(emulator.model, "28")
+    assert len(frames) >= 2
+    assert [frame[0] for frame in frames] == ["8"]*(len(frames) - 1) + ["2"]
+    assert all(len(frame) + 1 <= device.maxCommandFrame for frame in frames)
+    assert sorted(int(frame[k:k + 2]) for frame in frames for k in range(1, len(frame), 3)) == allPins
+    changes = emulator.timeline()
+    assert sorted(pin for when, pin, state in changes) == allPins
+    assert len(set(when for when, pin, state in changes)) == 1 # every pin changed on the same frame
+    assert emulator.model.staged == []
+    assert device.verify() == []
+
+
+# Maximum size commands sent back to back at the firmware's baud rate each arrive whole.
+def test_full_board_batches_at_full_rate(device, emulator):
+    for k in range(5):
+        states = [(pin + k) % 2 for pin in allPins]
+        device.setPins(allPins, states)
+        assert dict((pin, emulator.model.pins[pin]) for pin in allPins) == dict(zip(allPins, states))
+    assert len(framesOf(emulator.model, "2")) == 5
+    assert device.verify() == []
+
+
+# If writing a chunk fails, the connection is restored, the staged pins are dropped and the whole command is sent
+# again, so that no chunk is applied twice or by a later command.
+@pytest.mark.parametrize("failing", ["8", "2"])
+def test_failed_chunk_drops_staged_pins_and_resends_command(simulated, failing):
+    model = simulated.model
+    write = simulated._serialWrite
+    failed = []
+
+    def flakyWrite(out):
+        if out.startswith(failing) and len(out) > 2 and not failed:
+            failed.append(out)
+            raise IOError("write failed")
+        return write(out)
+
+    simulated._serialWrite = flakyWrite
+    with pytest.raises(Warning):
+        simulated.setPins(allPins, [1]*len(allPins))
+    assert failed
+    frames = [frame for sent, frame in model.frames]
+    reconnect = frames.index("1")
+    assert "8" in frames[reconnect:] # the bare 8 that drops the staged pins
+    resent = frames[frames.index("8", reconnect) + 1:]
+    assert any(frame == failed[0][:-1] for frame in resent) # the failed chunk, within the whole command
+    assert resent[-1].startswith("2")
+    assert model.staged == []
+    assert all(model.pins[pin] == 1 for pin in allPins)
+
+    simulated._serialWrite = write
+    simulated.setPins([5], [0])
+    assert model.pins[5] == 0 and model.pins[6] == 1
+    assert simulated.verify() == []